@@ -1,4 +1,12 @@
+import os
+import re
+import base64
 import logging
+import datetime
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
 from ckan.types import Context, DataDict, AuthResult
 from ckan.model.types import make_uuid
 import ckan.lib.uploader as uploader
@@ -7,6 +15,11 @@ from botocore.exceptions import ClientError
 from ckan.common import _
 from ckan.logic import ValidationError, NotAuthorized, NotFound
 
+from ckanext.s3filestore import metrics, preview, replicas, transfer
+from ckanext.s3filestore.uploader import (
+    TARGET_FIELD, check_size, get_max_resource_size, max_part_number,
+    resource_uploaders)
+
 log = logging.getLogger(__name__)
 
 @toolkit.chained_action
@@ -17,7 +30,13 @@ def resource_create(up_func, context: Context, data_dict: DataDict):
     return res
 
 def get_signed_url(context: Context, data_dict: DataDict) -> AuthResult:
-    """Generate a signed URL for single file upload"""
+    """Generate a signed URL for single file upload
+
+    :param package_id: Package ID the file is uploaded to
+    :param filename: Name of the file
+    :param size: Optional size of the file in bytes, refused if over
+        ``ckan.max_resource_size`` and enforced by S3 on upload
+    """
 
     user = context.get('user')
     if not user:
@@ -31,21 +50,13 @@ def get_signed_url(context: Context, data_dict: DataDict) -> AuthResult:
     if filename is None:
         raise ValidationError({"filename": _("Filename is required")})
 
-    try:
-        toolkit.get_action('package_show')(context, {'id': package_id})
-    except NotFound:
-        raise NotFound(_('Package not found'))
-    except NotAuthorized:
-        raise NotAuthorized(_('You are not authorized to access this package'))
-
-    try:
-        toolkit.check_access('resource_create', context, {'package_id': package_id})
-    except NotAuthorized:
-        raise NotAuthorized(_('You are not authorized to create resources for this package'))
+    _check_upload_access(context, package_id)
 
     if not _is_valid_filename(filename):
         raise ValidationError({"filename": _("Invalid filename")})
 
+    size = _declared_size(data_dict)
+
     url_type = 'upload'
     resource_id = make_uuid()
 
@@ -57,7 +68,9 @@ def get_signed_url(context: Context, data_dict: DataDict) -> AuthResult:
         })
 
         key_path = upload.get_path(resource_id, filename)
-        signed_url = upload.generate_put_presigned_url(key_path)
+        # S3 refuses uploads of another size than the signed one
+        extra_params = {} if size is None else {'ContentLength': size}
+        signed_url = upload.generate_put_presigned_url(key_path, extra_params)
         
         log.info(f"Generated signed URL for user {user} on package {package_id}: {key_path}")
 
@@ -71,6 +84,102 @@ def get_signed_url(context: Context, data_dict: DataDict) -> AuthResult:
         raise ValidationError({"upload": _("Failed to generate upload URL")})
 
 
+def get_signed_urls(context: Context, data_dict: DataDict) -> AuthResult:
+    """Generate signed URLs for uploading several files to one package.
+
+    Access to the package is checked once for the whole batch.
+
+    :param package_id: Package ID the files are uploaded to
+    :param files: List of files, each either a filename or a dict with a
+        ``filename`` and optionally the ``content_type``, ``content_md5``
+        (base64 encoded MD5 digest) and ``size`` the upload must match
+
+    :returns: List of ``resource_id``, ``filename`` and ``signed_url`` dicts,
+        in the order of ``files``
+    """
+
+    user = context.get('user')
+    if not user:
+        raise NotAuthorized(_('You must be logged in to upload files'))
+
+    package_id = data_dict.get("package_id", None)
+    files = data_dict.get("files", None)
+
+    if package_id is None:
+        raise ValidationError({"package_id": _("Package ID is required")})
+    if not files or not isinstance(files, list):
+        raise ValidationError({"files": _("A list of files is required")})
+
+    max_files = int(toolkit.config.get(
+        'ckanext.s3filestore.max_signed_urls_per_request', 1000))
+    if len(files) > max_files:
+        raise ValidationError({"files": _(
+            "At most {0} files can be signed at once").format(max_files)})
+
+    files = [f if isinstance(f, dict) else {"filename": f} for f in files]
+    invalid = [f.get("filename") for f in files
+               if not _is_valid_filename(f.get("filename"))]
+    if invalid:
+        raise ValidationError({"files": [
+            _("Invalid filename: {0}").format(filename)
+            for filename in invalid]})
+
+    sizes = [_declared_size(f) for f in files]
+
+    _check_upload_access(context, package_id)
+
+    try:
+        upload = uploader.get_resource_uploader({
+            "package_id": package_id,
+            "url_type": 'upload',
+        })
+
+        signed_urls = []
+        for f, size in zip(files, sizes):
+            resource_id = make_uuid()
+            extra_params = {}
+            if size is not None:
+                extra_params['ContentLength'] = size
+            if f.get("content_type"):
+                extra_params['ContentType'] = f["content_type"]
+            if f.get("content_md5"):
+                extra_params['ContentMD5'] = f["content_md5"]
+
+            key_path = upload.get_path(resource_id, f["filename"])
+            signed_urls.append({
+                "resource_id": resource_id,
+                "filename": f["filename"],
+                "signed_url": upload.generate_put_presigned_url(
+                    key_path, extra_params),
+            })
+
+        log.info(f"Generated {len(signed_urls)} signed URLs for user {user} "
+                 f"on package {package_id}")
+
+        return signed_urls
+
+    except Exception as e:
+        log.error(f"Failed to generate signed URLs: {str(e)}")
+        raise ValidationError({"upload": _("Failed to generate upload URLs")})
+
+
+def _check_upload_access(context: Context, package_id: str) -> None:
+    """
+    Check that the package exists and that the user can add resources to it
+    """
+    try:
+        toolkit.get_action('package_show')(context, {'id': package_id})
+    except NotFound:
+        raise NotFound(_('Package not found'))
+    except NotAuthorized:
+        raise NotAuthorized(_('You are not authorized to access this package'))
+
+    try:
+        toolkit.check_access('resource_create', context, {'package_id': package_id})
+    except NotAuthorized:
+        raise NotAuthorized(_('You are not authorized to create resources for this package'))
+
+
 def _is_valid_filename(filename: str) -> bool:
     """
     Validate filename to prevent security issues
@@ -79,7 +188,7 @@ def _is_valid_filename(filename: str) -> bool:
     import re
     
     # Basic checks
-    if not filename or len(filename) > 255:
+    if not isinstance(filename, str) or not filename or len(filename) > 255:
         return False
     
     # Check for dangerous characters or patterns
@@ -101,6 +210,42 @@ def _is_valid_filename(filename: str) -> bool:
     return True
 
 
+def _declared_size(data_dict, field='size'):
+    """
+    Return the size in bytes declared for the file to upload, or None if
+    there is none, refusing sizes over ``ckan.max_resource_size``
+    """
+    size = data_dict.get(field)
+    if size in (None, ''):
+        if toolkit.asbool(toolkit.config.get(
+                'ckanext.s3filestore.require_declared_size', False)):
+            raise ValidationError(
+                {field: [_('The size of the file is required')]})
+        return None
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        size = -1
+    if size < 0:
+        raise ValidationError({field: [_('Must be a number of bytes')]})
+    check_size(size, get_max_resource_size())
+    return size
+
+
+def _check_part_number(part_number):
+    """
+    Refuse the part numbers which only uploads larger than
+    ``ckan.max_resource_size`` can have
+    """
+    try:
+        part_number = int(part_number)
+    except (TypeError, ValueError):
+        part_number = 0
+    if not 1 <= part_number <= max_part_number(get_max_resource_size()):
+        raise ValidationError({'part_number': [_('Invalid part number')]})
+    return part_number
+
+
 @toolkit.side_effect_free
 def create_multipart_upload(context, data_dict):
     """
@@ -110,6 +255,8 @@ def create_multipart_upload(context, data_dict):
     :param content_type: MIME type of the file
     :param resource_id: Optional resource ID to associate with upload
     :param package_id: Package ID for the resource
+    :param size: Optional size of the file in bytes, refused if over
+        ``ckan.max_resource_size``
 
     :returns: Dictionary containing uploadId and key
     """
@@ -127,6 +274,7 @@ def create_multipart_upload(context, data_dict):
     if not package_id:
         raise toolkit.ValidationError(
             {'package_id': ['Package ID is required']})
+    _declared_size(data_dict)
 
     try:
         # Create uploader instance using your factory function
@@ -196,6 +344,7 @@ def prepare_upload_parts(context, data_dict):
             part_number = part_info.get('number')
             if not part_number:
                 continue
+            part_number = _check_part_number(part_number)
 
             # Use your class method to generate presigned URL
             presigned_url = upload.generate_multipart_presigned_url(
@@ -300,6 +449,12 @@ def complete_multipart_upload(context, data_dict):
             "url_type": 'upload',
         })
 
+        # The parts may add up to more than the declared size
+        if upload.uploaded_size(key, upload_id) > get_max_resource_size():
+            upload.abort_multipart_upload(key, upload_id)
+            raise toolkit.ValidationError(
+                {'upload': ['File upload too large']})
+
         # Use your class method to complete multipart upload
         response = upload.complete_multipart_upload(key, upload_id, parts)
 
@@ -393,7 +548,9 @@ def sign_part(context, data_dict):
 
     :param upload_id: Upload ID
     :param key: Object key
-    :param part_number: Part number to sign
+    :param part_number: Part number to sign, refused if only files over
+        ``ckan.max_resource_size`` have that many parts
+    :param size: Optional size of the part in bytes, enforced by S3
     :param package_id: Package ID for authorization
 
     :returns: Presigned URL for the part
@@ -412,6 +569,8 @@ def sign_part(context, data_dict):
             'key': ['Key is required'],
             'part_number': ['Part number is required']
         })
+    part_number = _check_part_number(part_number)
+    part_size = _declared_size(data_dict)
 
     try:
         # Create uploader instance
@@ -425,8 +584,9 @@ def sign_part(context, data_dict):
         url = upload.generate_multipart_presigned_url(
             key=key,
             upload_id=upload_id,
-            part_number=int(part_number),
-            expires_in=3600  # 1 hour
+            part_number=part_number,
+            expires_in=3600,  # 1 hour
+            content_length=part_size
         )
 
         return {
@@ -439,6 +599,422 @@ def sign_part(context, data_dict):
         raise toolkit.ValidationError(
             {'error': [f'Failed to sign part: {str(e)}']})
 
+
+def _download_url_ids(data_dict):
+    '''Return the package ids or names requested from get_download_urls.'''
+    ids = data_dict.get('ids') or [data_dict.get('id')]
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    if not isinstance(ids, list) or not all(ids):
+        raise toolkit.ValidationError(
+            {'id': ['A package ID or a list of package IDs is required']})
+
+    max_packages = int(toolkit.config.get(
+        'ckanext.s3filestore.max_download_url_packages', 100))
+    if len(ids) > max_packages:
+        raise toolkit.ValidationError(
+            {'ids': [f'At most {max_packages} packages can be requested']})
+    return ids
+
+
+def _download_url_expiry(data_dict):
+    '''Return the validity of the URLs requested from get_download_urls,
+    None for the default one.'''
+    expires_in = data_dict.get('expires_in')
+    if expires_in is None:
+        return None
+    max_expiry = int(toolkit.config.get(
+        'ckanext.s3filestore.max_download_url_expiry', 3600))
+    try:
+        expires_in = int(expires_in)
+    except (TypeError, ValueError):
+        expires_in = 0
+    if expires_in <= 0:
+        raise toolkit.ValidationError(
+            {'expires_in': ['Must be a positive number of seconds']})
+    return min(expires_in, max_expiry)
+
+
+def _package_download_urls(package, expires_in, request):
+    '''Return the ``id``, ``name``, ``filename`` and signed ``url`` of each
+    uploaded resource of `package`.'''
+    # The files stay in the bucket they were uploaded to
+    get_uploader = resource_uploaders()
+    resources = []
+    for resource in package.get('resources', []):
+        if resource.get('url_type') != 'upload' or not resource.get('url'):
+            continue
+        upload = get_uploader(resource)
+        filename = os.path.basename(resource['url'])
+        try:
+            key_path = upload.resolve_path(resource['id'], filename)
+            url = replicas.get_signed_url(
+                upload, key_path,
+                {'ResponseContentDisposition':
+                    'attachment; filename=' + filename},
+                read_only=True, check_exists=False,
+                expires_in=expires_in, request=request)
+        except ClientError as e:
+            log.error(f"Error signing resource {resource['id']}: {e}")
+            raise toolkit.ValidationError(
+                {'error': [f'Failed to sign download URLs: {str(e)}']})
+        resources.append({
+            'id': resource['id'],
+            'name': resource.get('name'),
+            'filename': filename,
+            'url': url,
+        })
+    return resources
+
+
+@toolkit.side_effect_free
+def get_download_urls(context, data_dict):
+    """
+    Generate signed download URLs for all the uploaded resources of one or
+    more packages, e.g. to mirror a dataset with a single call.
+
+    Access is checked once per package and the URLs are signed without
+    checking that each object exists, for the replica closest to the caller
+    when replicas are configured.
+
+    :param id: Package ID or name
+    :param ids: List of package IDs or names, instead of ``id``
+    :param expires_in: Validity of the URLs in seconds, defaults to
+        ``ckanext.s3filestore.signed_url_expiry`` and is capped by
+        ``ckanext.s3filestore.max_download_url_expiry``
+
+    :returns: List with, for each package, its ``id``, ``name`` and
+        ``resources`` (``id``, ``name``, ``filename`` and ``url`` of each
+        uploaded resource), or an ``error`` if it couldn't be read
+    """
+    ids = _download_url_ids(data_dict)
+    expires_in = _download_url_expiry(data_dict)
+
+    # Sign for the replicas closest to the caller when called through the API
+    request = flask.request if flask.has_request_context() else None
+
+    results = []
+    for package_id in ids:
+        try:
+            package = toolkit.get_action('package_show')(
+                dict(context), {'id': package_id})
+        except NotFound:
+            results.append({'id': package_id, 'error': 'Package not found'})
+            continue
+        except NotAuthorized:
+            results.append({'id': package_id,
+                            'error': 'Not authorized to read package'})
+            continue
+
+        results.append({
+            'id': package['id'],
+            'name': package['name'],
+            'resources': _package_download_urls(package, expires_in,
+                                                request),
+        })
+
+    return results
+
+
+@toolkit.side_effect_free
+def get_resource_preview(context, data_dict):
+    """
+    Return the first lines of an uploaded text resource, fetching only the
+    start of the file.
+
+    :param id: Resource ID
+    :param bytes: Number of bytes to fetch, defaults to
+        ``ckanext.s3filestore.preview_bytes`` and is capped by
+        ``ckanext.s3filestore.preview_max_bytes``
+    :param rows: Optional number of rows to return after the header row
+
+    :returns: Dictionary with the ``text`` of the complete lines (or CSV
+        records), the ``size`` of the file, whether the text is
+        ``truncated`` and the ``etag`` of the object
+    """
+    resource_id = data_dict.get('id')
+    if not resource_id:
+        raise toolkit.ValidationError({'id': ['Resource ID is required']})
+
+    resource = toolkit.get_action('resource_show')(
+        dict(context), {'id': resource_id})
+    if resource.get('url_type') != 'upload' or not resource.get('url'):
+        raise toolkit.ValidationError(
+            {'id': ['The resource has no uploaded file']})
+
+    config = toolkit.config
+    max_bytes = int(config.get('ckanext.s3filestore.preview_max_bytes',
+                               1024 * 1024))
+    try:
+        size = min(int(data_dict.get('bytes') or config.get(
+            'ckanext.s3filestore.preview_bytes', 256 * 1024)), max_bytes)
+        rows = data_dict.get('rows')
+        rows = int(rows) if rows not in (None, '') else None
+    except ValueError:
+        raise toolkit.ValidationError(
+            {'bytes': ['bytes and rows must be numbers']})
+    if size < 1:
+        raise toolkit.ValidationError({'bytes': ['Must be positive']})
+
+    quoted = (resource.get('format') or '').lower() in ('csv', 'tsv') or \
+        resource.get('mimetype') in ('text/csv', 'text/tab-separated-values')
+    upload = uploader.get_resource_uploader(resource)
+    key_path = upload.resolve_path(resource['id'],
+                                   os.path.basename(resource['url']))
+    try:
+        sample = dict(preview.get_sample(upload, key_path, size, quoted))
+    except ClientError as e:
+        log.error(f"Error fetching the preview of {key_path}: {e}")
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            raise NotFound(_('Resource data not found'))
+        raise toolkit.ValidationError(
+            {'error': [f'Failed to fetch the preview: {str(e)}']})
+
+    if rows is not None:
+        text = preview.first_records(sample['text'], rows + 1, quoted)
+        sample['truncated'] = sample['truncated'] or text != sample['text']
+        sample['text'] = text
+    return sample
+
+
+# Content types S3 gives to objects uploaded without one
+_GENERIC_CONTENT_TYPES = ('binary/octet-stream', 'application/octet-stream')
+
+
+def resource_file_metadata(upload, resource):
+    """
+    Return the ``size``, ``hash``, ``mimetype``, ``last_modified`` and
+    ``s3_etag`` fields of the resource, read from its object with a single
+    HEAD request.
+
+    The hash is the SHA-256 checksum of the object if it was uploaded with
+    one, else its MD5 digest if the ETag is one (single part uploads without
+    KMS encryption), e.g. ``md5:0cc175b9c0f1b6a831c399e269772661``.
+    """
+    filename = os.path.basename(resource['url'])
+    key_path = upload.resolve_path(resource['id'], filename)
+    # The object may have been replaced directly in S3
+    upload.invalidate(key_path)
+    client = upload.get_s3_client(read_only=True)
+    with metrics.timed('head_object'):
+        head = client.head_object(Bucket=upload.bucket_name, Key=key_path,
+                                  ChecksumMode='ENABLED')
+
+    etag = head['ETag'].strip('"')
+    fields = {
+        'size': head['ContentLength'],
+        's3_etag': etag,
+        'last_modified': head['LastModified'].astimezone(
+            datetime.timezone.utc).replace(tzinfo=None).isoformat(),
+    }
+    if head.get('ChecksumSHA256') and '-' not in head['ChecksumSHA256']:
+        fields['hash'] = 'sha256:' + \
+            base64.b64decode(head['ChecksumSHA256']).hex()
+    elif re.match(r'^[0-9a-f]{32}$', etag):
+        fields['hash'] = 'md5:' + etag
+
+    content_type = (head.get('ContentType') or '').split(';')[0]
+    if content_type and content_type not in _GENERIC_CONTENT_TYPES:
+        fields['mimetype'] = content_type
+    elif not resource.get('mimetype'):
+        mimetype = mimetypes.guess_type(filename, strict=False)[0]
+        if mimetype:
+            fields['mimetype'] = mimetype
+    return fields
+
+
+def finalize_upload(context, data_dict):
+    """
+    Record the size, checksum and MIME type of the file of a resource
+    uploaded directly to S3, e.g. with a URL from ``get_signed_url``, once
+    the upload is done.
+
+    :param id: Resource ID
+
+    :returns: The resource, only updated if its file metadata changed
+    """
+    resource_id = data_dict.get('id')
+    if not resource_id:
+        raise toolkit.ValidationError({'id': ['Resource ID is required']})
+
+    resource = toolkit.get_action('resource_show')(
+        dict(context), {'id': resource_id})
+    toolkit.check_access('resource_update', dict(context),
+                         {'id': resource_id})
+    if resource.get('url_type') != 'upload' or not resource.get('url'):
+        raise toolkit.ValidationError(
+            {'id': ['The resource has no uploaded file']})
+
+    upload = uploader.get_resource_uploader(resource)
+    try:
+        fields = resource_file_metadata(upload, resource)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            raise NotFound(_('Resource data not found'))
+        log.error(f"Error reading the metadata of resource {resource_id}: {e}")
+        raise toolkit.ValidationError(
+            {'error': [f'Failed to read the file metadata: {str(e)}']})
+
+    changes = dict((k, v) for k, v in fields.items()
+                   if resource.get(k) != v)
+    if not changes:
+        return resource
+    changes['id'] = resource_id
+    return toolkit.get_action('resource_patch')(dict(context), changes)
+
+
+# Fields set by CKAN itself, which copies must not inherit
+_PACKAGE_COPY_EXCLUDED = (
+    'id', 'name', 'resources', 'num_resources', 'num_tags', 'organization',
+    'metadata_created', 'metadata_modified', 'revision_id', 'state',
+    'creator_user_id', 'relationships_as_object', 'relationships_as_subject',
+    'tracking_summary',
+)
+_RESOURCE_COPY_EXCLUDED = (
+    'id', 'package_id', 'position', 'created', 'metadata_modified',
+    'revision_id', 'state', 'tracking_summary', 'datastore_active',
+    # Copies are pinned to the routing target of their own package
+    TARGET_FIELD,
+    # Describe the objects of the source, of which only the primary one is
+    # copied, see _copy_uploads
+    's3_compression', 's3_etag', 's3_upload_status', 's3_upload_progress',
+    's3_upload_error',
+)
+
+
+def _copy_resource_dict(resource):
+    copy = dict((k, v) for k, v in resource.items()
+                if k not in _RESOURCE_COPY_EXCLUDED)
+    if copy.get('url_type') == 'upload':
+        # CKAN builds the download URL of uploads from their filename
+        copy['url'] = os.path.basename(resource['url'])
+    return copy
+
+
+def _copy_uploads(pairs):
+    """Copy the objects of the uploaded resources in `pairs` of source and
+    copied resource dicts, in parallel, from the bucket of each source to
+    the bucket of its copy, server-side if possible, else streamed through
+    this host."""
+    # The uploaders are created here, as routing them reads the database
+    copies = [(uploader.get_resource_uploader(dict(source)),
+               uploader.get_resource_uploader(dict(copy)), source, copy)
+              for source, copy in pairs
+              if source.get('url_type') == 'upload' and source.get('url')]
+
+    def copy_object(args):
+        source_upload, upload, source, copy = args
+        filename = os.path.basename(source['url'])
+        source_key = source_upload.resolve_path(source['id'], filename)
+        key = upload.get_path(copy['id'], filename)
+        # Buckets of routing targets on other endpoints or with other
+        # credentials can't be copied from server-side
+        if upload.shares_endpoint(source_upload):
+            return upload.copy_key(source_key, key,
+                                   source_bucket=source_upload.bucket_name)
+        head = source_upload.head_object(source_key)
+        transfer.copy_object(
+            source_upload, upload,
+            {'Key': source_key, 'Size': head['size'], 'ETag': head['etag']},
+            key)
+        return head['size']
+
+    if not copies:
+        return 0
+    with ThreadPoolExecutor(
+            max_workers=copies[0][1].copy_workers) as executor:
+        return sum(executor.map(copy_object, copies))
+
+
+def copy_resource(context, data_dict):
+    """
+    Copy a resource, and its uploaded file with a server-side S3 copy, to
+    the same or another package.
+
+    :param id: ID of the resource to copy
+    :param package_id: Package to copy the resource to, defaults to the
+        package of the resource
+    :param name: Optional name of the copy
+
+    :returns: The new resource
+    """
+    resource_id = data_dict.get('id')
+    if not resource_id:
+        raise toolkit.ValidationError({'id': ['Resource ID is required']})
+
+    source = toolkit.get_action('resource_show')(
+        dict(context), {'id': resource_id})
+    package_id = data_dict.get('package_id') or source['package_id']
+    _check_upload_access(dict(context), package_id)
+
+    copy = _copy_resource_dict(source)
+    copy['package_id'] = package_id
+    if data_dict.get('name'):
+        copy['name'] = data_dict['name']
+    new_resource = toolkit.get_action('resource_create')(dict(context), copy)
+
+    try:
+        _copy_uploads([(source, new_resource)])
+    except ClientError as e:
+        log.error(f"Error copying resource {resource_id}: {e}")
+        toolkit.get_action('resource_delete')(
+            dict(context), {'id': new_resource['id']})
+        raise toolkit.ValidationError(
+            {'error': [f'Failed to copy resource: {str(e)}']})
+
+    log.info(f"Copied resource {resource_id} to {new_resource['id']}")
+    return new_resource
+
+
+def clone_package(context, data_dict):
+    """
+    Create a copy of a package and its resources, the uploaded files being
+    copied with server-side S3 copies.
+
+    :param id: ID or name of the package to clone
+    :param name: Name of the new package
+    :param title: Optional title of the new package
+    :param owner_org: Optional organization of the new package, defaults to
+        the organization of the package
+
+    :returns: The new package
+    """
+    package_id = data_dict.get('id')
+    name = data_dict.get('name')
+    if not package_id or not name:
+        raise toolkit.ValidationError({
+            'id': ['Package ID is required'],
+            'name': ['Name of the new package is required'],
+        })
+
+    source = toolkit.get_action('package_show')(
+        dict(context), {'id': package_id})
+
+    copy = dict((k, v) for k, v in source.items()
+                if k not in _PACKAGE_COPY_EXCLUDED)
+    copy['name'] = name
+    for key in ('title', 'owner_org'):
+        if data_dict.get(key):
+            copy[key] = data_dict[key]
+    copy['resources'] = [_copy_resource_dict(res)
+                         for res in source.get('resources', [])]
+    new_package = toolkit.get_action('package_create')(dict(context), copy)
+
+    try:
+        # Resources are created in the order of the source package
+        size = _copy_uploads(zip(source.get('resources', []),
+                                 new_package['resources']))
+    except ClientError as e:
+        log.error(f"Error cloning package {package_id}: {e}")
+        toolkit.get_action('package_delete')(
+            dict(context), {'id': new_package['id']})
+        raise toolkit.ValidationError(
+            {'error': [f'Failed to clone package: {str(e)}']})
+
+    log.info(f"Cloned package {package_id} to {new_package['name']}, "
+             f"copying {size} bytes")
+    return new_package
+
 # Helper function to get bucket name from uploader config
 
 
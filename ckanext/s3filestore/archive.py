@@ -0,0 +1,131 @@
+# encoding: utf-8
+'''Streaming ZIP archives of the uploaded resources of a dataset.
+
+The archive is written on the fly to the response: entries are stored
+uncompressed, their sizes and CRCs being sent in data descriptors after the
+data, and ZIP64 records are used as needed, so memory use doesn't depend on
+the size of the objects. The object of the next entry is requested from S3
+in a background thread while the current one is streamed.
+
+Entries follow the order of the resources in the dataset, so an interrupted
+download can be resumed by requesting the entries after the last complete
+one.
+'''
+import os
+import logging
+import zipfile
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class _StreamBuffer(object):
+    '''Unseekable file object collecting what zipfile writes, so that it can
+    be handed out chunk by chunk.'''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        '''Return the data written since the last call, if any.'''
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return [data] if data else []
+
+
+def archive_entries(resources):
+    '''Return the `(resource, name)` entries of the archive of the uploaded
+    `resources`, in a stable order. Duplicate filenames get the resource id
+    appended.'''
+    entries = []
+    seen = set()
+    for resource in resources:
+        if resource.get('url_type') != 'upload' or not resource.get('url'):
+            continue
+        name = os.path.basename(resource['url'])
+        if name in seen:
+            root, ext = os.path.splitext(name)
+            name = '{0}-{1}{2}'.format(root, resource['id'], ext)
+        seen.add(name)
+        entries.append((resource, name))
+    return entries
+
+
+def skip_entries(entries, after):
+    '''Return the entries following the resource with id `after`.'''
+    for i, (resource, _name) in enumerate(entries):
+        if resource['id'] == after:
+            return entries[i + 1:]
+    raise ValueError('Resource {0} is not part of the archive'.format(after))
+
+
+def _entry_info(resource, name, size):
+    modified = resource.get('last_modified') or resource.get('created')
+    try:
+        date_time = datetime.datetime.strptime(
+            modified[:19], '%Y-%m-%dT%H:%M:%S').timetuple()[:6]
+    except (TypeError, ValueError):
+        date_time = (1980, 1, 1, 0, 0, 0)
+    info = zipfile.ZipInfo(name, date_time=max(date_time,
+                                               (1980, 1, 1, 0, 0, 0)))
+    info.compress_type = zipfile.ZIP_STORED
+    info.file_size = size
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def stream_zip(entries, open_entry, chunk_size=CHUNK_SIZE):
+    '''Generate the chunks of a ZIP archive of `entries`.
+
+    `open_entry(resource)` must return a `(size, stream)` tuple, the stream
+    having `read(size)` and `close()` methods. It is called for the next
+    entry while the current one is being streamed.
+    '''
+    buf = _StreamBuffer()
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    try:
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED,
+                             allowZip64=True) as archive:
+            if entries:
+                pending = executor.submit(open_entry, entries[0][0])
+            for i, (resource, name) in enumerate(entries):
+                size, stream = pending.result()
+                pending = None
+                if i + 1 < len(entries):
+                    pending = executor.submit(open_entry, entries[i + 1][0])
+                try:
+                    info = _entry_info(resource, name, size)
+                    with archive.open(info, 'w') as entry:
+                        while True:
+                            data = stream.read(chunk_size)
+                            if not data:
+                                break
+                            entry.write(data)
+                            for chunk in buf.pop():
+                                yield chunk
+                finally:
+                    stream.close()
+                for chunk in buf.pop():
+                    yield chunk
+        # The central directory is written when the archive is closed
+        for chunk in buf.pop():
+            yield chunk
+    finally:
+        if pending is not None:
+            # The download was interrupted, release the prefetched object
+            try:
+                pending.result()[1].close()
+            except Exception:
+                pass
+        executor.shutdown(wait=False)
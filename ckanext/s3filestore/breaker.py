@@ -0,0 +1,140 @@
+# encoding: utf-8
+'''A per-process circuit breaker for the requests sent to S3.
+
+When the share of failed S3 requests (server errors, throttling, timeouts and
+connection errors) within a rolling window crosses a threshold, the breaker
+opens and further requests fail immediately with `CircuitOpenError` instead
+of tying up the worker until they time out. After `reset_timeout` seconds a
+single probe request is let through, closing the breaker if it succeeds.
+'''
+import time
+import logging
+import threading
+from collections import deque
+
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from botocore.exceptions import HTTPClientError
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# HTTP statuses which mean that the service is unhealthy, as opposed to a
+# problem with the request itself (e.g. a missing key)
+FAILURE_STATUSES = (429, 500, 502, 503, 504)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    '''Raised instead of sending a request to S3 while the breaker is
+    open.'''
+    pass
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failure_rate=0.5, min_calls=20, window=30,
+                 reset_timeout=30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._opened_at = None
+        self._probe_started_at = None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if self._probe_started_at is not None:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        '''Return True if a request may be sent to S3.'''
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.time()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            # Let a single probe through, or another one if the previous
+            # probe never reported back
+            if self._probe_started_at is None or \
+                    now - self._probe_started_at >= self.reset_timeout:
+                self._probe_started_at = now
+                return True
+            return False
+
+    def record(self, failed):
+        '''Record the outcome of a request sent to S3.'''
+        with self._lock:
+            now = time.time()
+            if self._opened_at is not None:
+                if self._probe_started_at is None:
+                    return
+                self._probe_started_at = None
+                if failed:
+                    self._opened_at = now
+                else:
+                    log.info('S3 circuit breaker {0} closed'
+                             .format(self.name))
+                    self._opened_at = None
+                    self._calls.clear()
+                return
+
+            self._calls.append((now, failed))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for _at, call_failed in self._calls
+                           if call_failed)
+            if failures >= self.failure_rate * len(self._calls):
+                log.warning('S3 circuit breaker {0} opened, {1} of the last '
+                            '{2} requests failed'.format(
+                                self.name, failures, len(self._calls)))
+                self._opened_at = now
+                self._calls.clear()
+
+    def _before_call(self, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(
+                'S3 circuit breaker {0} is open'.format(self.name))
+
+    def _after_call(self, http_response=None, **kwargs):
+        self.record(http_response is not None and
+                    http_response.status_code in FAILURE_STATUSES)
+
+    def _after_call_error(self, exception=None, **kwargs):
+        if isinstance(exception, (BotoConnectionError, HTTPClientError)):
+            self.record(True)
+
+    def register(self, events):
+        '''Hook the breaker into the event system of a boto3 S3 client.'''
+        events.register('before-call.s3', self._before_call)
+        events.register('after-call.s3', self._after_call)
+        events.register('after-call-error.s3', self._after_call_error)
+
+
+def get_breaker(name, **options):
+    '''Return the process-wide breaker named `name`, e.g. one per S3
+    endpoint, creating it with `options` on first use.'''
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name, **options)
+        return breaker
+
+
+def reset():
+    '''Forget all the breakers and their state.'''
+    with _breakers_lock:
+        _breakers.clear()
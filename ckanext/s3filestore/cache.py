@@ -0,0 +1,189 @@
+# encoding: utf-8
+'''Caches used by the extension, in-process or shared between processes.'''
+import time
+import json
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+
+import ckantoolkit as toolkit
+
+from ckanext.s3filestore import metrics
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    '''A thread-safe, size-bounded cache evicting the least recently used
+    entries, whose entries optionally expire after `ttl` seconds.
+
+    Lookups are counted in the ``s3filestore_cache_requests_total`` metric
+    under the cache `name`.
+    '''
+
+    def __init__(self, name, max_size=1024, ttl=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is not None and expires_at <= time.time():
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+        metrics.record_cache_lookup(self.name, entry is not None)
+        return value if entry is not None else default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheBackend(object):
+    '''Interface of the caches of object metadata and signed URLs, see
+    `get_metadata_cache`. Values are JSON-serializable and a failing backend
+    behaves as a cache miss.'''
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    '''Cache of the process, in an `LRUCache`.'''
+
+    def __init__(self, name, max_size=10000):
+        self._cache = LRUCache(name, max_size=max_size)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl=ttl)
+
+    def delete(self, *keys):
+        for key in keys:
+            self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class RedisBackend(CacheBackend):
+    '''Cache shared by all the processes using the same Redis, CKAN's own
+    (``ckan.redis.url``) unless another `client` is given.'''
+
+    def __init__(self, name, client=None, prefix=None):
+        import redis
+        from ckan.lib.redis import connect_to_redis
+
+        self.name = name
+        self.client = client if client is not None else connect_to_redis()
+        self.prefix = prefix if prefix is not None else \
+            'ckanext-s3filestore:{0}:{1}:'.format(
+                toolkit.config.get('ckan.site_id', ''), name)
+        self._errors = redis.RedisError
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except self._errors as e:
+            log.warning('Could not read the {0} cache: {1}'.format(
+                self.name, e))
+            value = None
+        metrics.record_cache_lookup(self.name, value is not None)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(self.prefix + key, json.dumps(value),
+                            px=max(int(ttl * 1000), 1))
+        except self._errors as e:
+            log.warning('Could not write the {0} cache: {1}'.format(
+                self.name, e))
+
+    def delete(self, *keys):
+        try:
+            self.client.delete(*[self.prefix + key for key in keys])
+        except self._errors as e:
+            # Entries which couldn't be invalidated expire with their TTL
+            log.error('Could not invalidate {0} in the {1} cache: {2}'.format(
+                keys, self.name, e))
+
+
+# Factories of the metadata cache backends, by name
+BACKENDS = {
+    'memory': lambda name: MemoryBackend(name, int(toolkit.config.get(
+        'ckanext.s3filestore.metadata_cache_size', 10000))),
+    'redis': RedisBackend,
+}
+
+_metadata_caches = {}
+_metadata_caches_lock = threading.Lock()
+
+
+def get_cache(name, default='memory'):
+    '''Return the cache `name` of the backend set by
+    ``ckanext.s3filestore.metadata_cache``: ``memory``, ``redis`` or the
+    ``package.module:factory`` of another `CacheBackend`, called with the
+    cache name. The `default` backend is used when none is set, and None
+    returned if there is none.'''
+    backend = toolkit.config.get('ckanext.s3filestore.metadata_cache') or \
+        default
+    if not backend:
+        return None
+    with _metadata_caches_lock:
+        cache = _metadata_caches.get((backend, name))
+        if cache is None:
+            if backend in BACKENDS:
+                factory = BACKENDS[backend]
+            else:
+                module, _, attr = backend.partition(':')
+                factory = getattr(importlib.import_module(module), attr)
+            cache = _metadata_caches[(backend, name)] = factory(name)
+        return cache
+
+
+def get_metadata_cache():
+    '''Return the cache of the object metadata and signed URLs, None when
+    ``ckanext.s3filestore.metadata_cache`` is not set, see `get_cache`.'''
+    return get_cache('object_metadata', default=None)
+
+
+def reset_metadata_caches():
+    '''Forget the cache backends, and the entries of the in-process
+    ones.'''
+    with _metadata_caches_lock:
+        for cache in _metadata_caches.values():
+            if isinstance(cache, MemoryBackend):
+                cache.clear()
+        _metadata_caches.clear()
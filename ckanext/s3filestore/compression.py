@@ -0,0 +1,113 @@
+# encoding: utf-8
+'''Compressed variants of text-like resources.
+
+With ``ckanext.s3filestore.compression`` set to ``gzip`` or ``zstd``, uploads
+of text MIME types (CSV, JSON, XML...) are also stored compressed next to the
+original object, e.g. ``data.csv.gz`` next to ``data.csv``, with the matching
+``Content-Encoding``. Downloads redirect to the compressed variant when the
+client accepts its encoding, and to the original object otherwise.
+
+zstd requires the optional ``zstandard`` package, gzip being used instead
+when it isn't installed.
+'''
+import zlib
+import logging
+import tempfile
+
+import ckantoolkit as toolkit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+EXTENSIONS = {GZIP: '.gz', ZSTD: '.zst'}
+
+DEFAULT_MIMETYPES = (
+    'text/* application/json application/xml application/geo+json '
+    'application/ld+json application/javascript application/x-ndjson')
+
+CHUNK_SIZE = 1024 * 1024
+# Compressed data is kept in memory up to this size, then spooled to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def get_encoding():
+    '''Return the configured encoding of the compressed variants, or None if
+    they are disabled.'''
+    encoding = toolkit.config.get('ckanext.s3filestore.compression')
+    if not encoding:
+        return None
+    if encoding not in EXTENSIONS:
+        log.warning('Unknown compression {0}, using {1}'.format(
+            encoding, GZIP))
+        return GZIP
+    if encoding == ZSTD and zstandard is None:
+        log.warning('zstandard is not installed, using {0}'.format(GZIP))
+        return GZIP
+    return encoding
+
+
+def should_compress(mimetype):
+    '''Return True if uploads of `mimetype` get a compressed variant.'''
+    if not mimetype:
+        return False
+    mimetype = mimetype.split(';')[0].strip().lower()
+    patterns = toolkit.aslist(toolkit.config.get(
+        'ckanext.s3filestore.compression_mimetypes', DEFAULT_MIMETYPES))
+    for pattern in patterns:
+        if pattern == mimetype or (pattern.endswith('/*') and
+                                   mimetype.startswith(pattern[:-1])):
+            return True
+    return False
+
+
+def variant_key(key, encoding):
+    '''Return the key of the `encoding` variant of `key`.'''
+    return key + EXTENSIONS[encoding]
+
+
+def _compressor(encoding):
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor().compressobj()
+    # wbits=31 writes the gzip header and trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def compress(fileobj, encoding):
+    '''Compress `fileobj` from its current position, chunk by chunk, into a
+    temporary file which is returned at its start.'''
+    compressor = _compressor(encoding)
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for data in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+        output.write(compressor.compress(data))
+    output.write(compressor.flush())
+    output.seek(0)
+    return output
+
+
+def accepts(accept_encoding, encoding):
+    '''Return True if the `Accept-Encoding` header value allows
+    `encoding`.'''
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _sep, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    if encoding in accepted:
+        return accepted[encoding] > 0
+    return accepted.get('*', 0) > 0
@@ -0,0 +1,151 @@
+# encoding: utf-8
+'''Process-wide cache of the instance role credentials.
+
+With ``ckanext.s3filestore.aws_use_ami_role`` the role credentials are
+fetched once from the instance metadata service and shared by every S3
+session of the process. A background timer fetches new credentials
+``credentials_refresh_margin`` seconds before they expire (before botocore
+itself would try to refresh them), so that requests never wait for the
+metadata service once the first credentials are cached.
+'''
+import os
+import time
+import logging
+import threading
+
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+from botocore.exceptions import CredentialRetrievalError
+from botocore.utils import InstanceMetadataFetcher, METADATA_BASE_URL
+from botocore.utils import parse_timestamp
+
+log = logging.getLogger(__name__)
+
+# Delay before trying again when the metadata service couldn't be reached or
+# still returns the credentials about to expire
+RETRY_INTERVAL = 30
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class RoleCredentialsCache(object):
+    '''Fetches the role credentials from the instance metadata service at
+    `metadata_url` and keeps them fresh in the background.'''
+
+    METHOD = 's3filestore-role-cache'
+
+    def __init__(self, metadata_url=None, refresh_margin=1200, timeout=1.0,
+                 num_attempts=3):
+        self.refresh_margin = refresh_margin
+        self._fetcher = InstanceMetadataFetcher(
+            timeout=timeout, num_attempts=num_attempts,
+            base_url=metadata_url or METADATA_BASE_URL)
+        self._lock = threading.Lock()
+        self._metadata = None
+        self._credentials = None
+        self._timer = None
+        self._pid = None
+
+    def _fetch(self):
+        metadata = self._fetcher.retrieve_iam_role_credentials()
+        if not metadata:
+            raise CredentialRetrievalError(
+                provider=self.METHOD,
+                error_msg='No role credentials found in the instance '
+                          'metadata')
+        log.debug('Fetched credentials of role {0}, expiring at {1}'.format(
+            metadata.get('role_name'), metadata['expiry_time']))
+        return metadata
+
+    def _seconds_to_expiry(self, metadata):
+        return parse_timestamp(metadata['expiry_time']).timestamp() - \
+            time.time()
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.refresh)
+        self._timer.daemon = True
+        self._timer.start()
+        self._pid = os.getpid()
+
+    def _schedule_refresh(self):
+        delay = self._seconds_to_expiry(self._metadata) - self.refresh_margin
+        self._schedule(max(delay, RETRY_INTERVAL))
+
+    def refresh(self):
+        '''Fetch new credentials from the metadata service.'''
+        try:
+            metadata = self._fetch()
+        except Exception as e:
+            log.warning('Could not refresh the role credentials, retrying '
+                        'in {0}s: {1}'.format(RETRY_INTERVAL, e))
+            with self._lock:
+                self._schedule(RETRY_INTERVAL)
+            return
+        with self._lock:
+            self._metadata = metadata
+            self._schedule_refresh()
+
+    def get_metadata(self):
+        '''Return the cached credentials, as expected by the `refresh_using`
+        callback of botocore's RefreshableCredentials.'''
+        with self._lock:
+            if self._metadata is None or \
+                    self._seconds_to_expiry(self._metadata) <= 0:
+                self._metadata = self._fetch()
+                self._schedule_refresh()
+            elif self._pid != os.getpid():
+                # The refresh timer doesn't survive forking workers
+                self._schedule_refresh()
+            return self._metadata
+
+    def get_credentials(self):
+        with self._lock:
+            credentials = self._credentials
+        if credentials is None:
+            credentials = RefreshableCredentials.create_from_metadata(
+                self.get_metadata(), refresh_using=self.get_metadata,
+                method=self.METHOD)
+            with self._lock:
+                self._credentials = credentials
+        return credentials
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+class CachedRoleCredentialProvider(CredentialProvider):
+    '''botocore credential provider serving the credentials cached by a
+    `RoleCredentialsCache`.'''
+
+    METHOD = RoleCredentialsCache.METHOD
+    CANONICAL_NAME = None
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def load(self):
+        return self._cache.get_credentials()
+
+
+def get_role_credentials_cache(metadata_url=None, refresh_margin=1200):
+    '''Return the process-wide cache of the role credentials.'''
+    key = (metadata_url, refresh_margin)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = RoleCredentialsCache(
+                metadata_url=metadata_url, refresh_margin=refresh_margin)
+        return cache
+
+
+def reset():
+    '''Stop and forget all the cached credentials.'''
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.stop()
+        _caches.clear()
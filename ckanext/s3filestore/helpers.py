@@ -1,60 +1,197 @@
+import copy
 import logging
+import datetime
+import functools
+
+import flask
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.s3filestore.cache import get_cache
+
 log = logging.getLogger(__name__)
 
-def get_package_by_name(pkg_name: str): 
-    return toolkit.get_action('package_show')({'ignore_auth': True}, {'id': pkg_name})
+FRONTEND_TOKEN_NAME = 'frontend_token'
 
+# Name of the cache of the frontend tokens and their id, by user id, shared
+# by the processes with a shared metadata_cache backend. Entries expire
+# before the token itself so that a form is never rendered with a stale
+# token, and revoked tokens are checked for before reuse.
+FRONTEND_TOKEN_CACHE = 'frontend_token'
 
-log = logging.getLogger(__name__)
+# Name of the cache of the packages shown by get_package_by_name, by name
+# or id, shared by the requests for ckanext.s3filestore.helper_cache_ttl
+# seconds, and by the processes with a shared metadata_cache backend
+PACKAGE_CACHE = 'package_by_name'
+
+MEMO_ATTR = '_s3filestore_helpers'
+# Keys of the packages changed by the request, evicted again once committed
+CHANGED_PACKAGES_ATTR = '_s3filestore_changed_packages'
+
+
+def request_memoized(fn):
+    '''Memoize the template helper `fn` for the current request, on
+    ``flask.g``, as a template can call it several times per render.'''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not flask.has_request_context():
+            return fn(*args, **kwargs)
+        memo = flask.g.get(MEMO_ATTR)
+        if memo is None:
+            memo = {}
+            setattr(flask.g, MEMO_ATTR, memo)
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in memo:
+            memo[key] = fn(*args, **kwargs)
+        return memo[key]
+    return wrapper
+
+
+def invalidate_package_cache(pkg_dict):
+    '''Drop the copies of the package of `pkg_dict` cached by
+    get_package_by_name, called when it is changed.
+
+    The package is evicted again at the end of the request, as the hooks
+    calling this run before the change is committed and another process may
+    cache the former version meanwhile.'''
+    import ckan.model as model
+
+    keys = set(key for key in (pkg_dict.get('id'), pkg_dict.get('name'))
+               if key)
+    package = model.Package.get(pkg_dict.get('id')) \
+        if pkg_dict.get('id') else None
+    if package is not None:
+        keys.update((package.id, package.name))
+    if not keys:
+        return
+    get_cache(PACKAGE_CACHE).delete(*keys)
+    if flask.has_request_context():
+        changed = flask.g.get(CHANGED_PACKAGES_ATTR)
+        if changed is None:
+            changed = set()
+            setattr(flask.g, CHANGED_PACKAGES_ATTR, changed)
+        changed.update(keys)
+        memo = flask.g.get(MEMO_ATTR)
+        if memo:
+            for key in [key for key in memo
+                        if key[0] == get_package_by_name.__name__ and
+                        key[1] and key[1][0] in keys]:
+                del memo[key]
+
+
+def evict_changed_packages():
+    '''Evict the packages changed by the request once it is done.'''
+    if not flask.has_request_context():
+        return
+    changed = flask.g.get(CHANGED_PACKAGES_ATTR)
+    if changed:
+        get_cache(PACKAGE_CACHE).delete(*changed)
+
+
+@request_memoized
+def get_package_by_name(pkg_name: str):
+    ttl = float(toolkit.config.get(
+        'ckanext.s3filestore.helper_cache_ttl', 0))
+    if ttl:
+        package = get_cache(PACKAGE_CACHE).get(pkg_name)
+        if package is not None:
+            # The dicts of the memory backend are shared with the other
+            # requests
+            return copy.deepcopy(package)
+    package = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': pkg_name})
+    if ttl:
+        get_cache(PACKAGE_CACHE).set(pkg_name, copy.deepcopy(package), ttl)
+    return package
 
+
+def get_frontend_token_ttl():
+    '''Return the lifetime in seconds of the frontend tokens.'''
+    return int(toolkit.config.get(
+        'ckanext.s3filestore.frontend_token_ttl', 24 * 3600))
+
+
+@request_memoized
 def get_or_create_user_api_key_safe():
     """
     Safe version that handles database transactions more carefully.
-    
+
+    Frontend tokens are cached per user until shortly before they expire, so
+    that rendering the upload form doesn't write to the database.
+
     Returns:
         str: The user's API key, or None if no user is logged in or error occurs
     """
+    import ckan.model as model
+    from ckan.lib import api_token
+
     try:
         # Get current user
         user = toolkit.c.userobj
-        
+
         if not user:
-            log.info(f'user not signed in')
+            log.debug('user not signed in')
             return None
-        
+
         if user.apikey:
-            log.info(f'user already have an api key')
+            log.debug('user already have an api key')
             return user.apikey
-        
-        return generate_token(user)
+
+        cache = get_cache(FRONTEND_TOKEN_CACHE)
+        cached = cache.get(user.id)
+        if cached is not None and \
+                model.ApiToken.get(cached['jti']) is not None:
+            return cached['token']
+        token = generate_token(user)
+        if token:
+            cache.set(user.id, {
+                'token': token,
+                'jti': api_token.decode(token)['jti'],
+            }, ttl=get_frontend_token_ttl() * 0.9)
+        return token
     except Exception as e:
         log.error(f"Error in get_or_create_user_api_key_safe: {str(e)}")
         return None
 
+
+def _is_expired(token, ttl):
+    created = token.get('created_at')
+    if not created:
+        return False
+    created = datetime.datetime.fromisoformat(created)
+    return datetime.datetime.utcnow() - created > datetime.timedelta(
+        seconds=ttl)
+
+
 def generate_token(user):
+    """
+    Mint a new frontend token for `user`, revoking their expired ones only,
+    so that the token of another open form or worker process keeps working.
+    """
     context = {}
     context['ignore_auth'] = True
-    log.info(user)
-    log.info(user.name)
+    ttl = get_frontend_token_ttl()
     try:
         api_tokens = toolkit.get_action('api_token_list')(
             context, {'user_id': user.name}
         )
 
         for token in api_tokens:
-            if token['name'] == 'frontend_token':
+            if token['name'] == FRONTEND_TOKEN_NAME and \
+                    _is_expired(token, ttl):
                 toolkit.get_action('api_token_revoke')(
                     context, {'jti': token['id']})
 
+        data_dict = {'user': user.name, 'name': FRONTEND_TOKEN_NAME}
+        if toolkit.plugin_loaded('expire_api_token'):
+            # Also enforce the lifetime when the token is used
+            data_dict.update(expires_in=ttl, unit=1)
         frontend_token = toolkit.get_action('api_token_create')(
-            context, {'user': user.name, 'name': 'frontend_token'}
+            context, data_dict
         )
+        log.info(f'Created a frontend token for user {user.name}')
 
         return frontend_token.get('token')
 
     except Exception as e:
         log.error(e)
 
-    return None
\ No newline at end of file
+    return None
@@ -0,0 +1,156 @@
+# encoding: utf-8
+'''Background transfer of the files uploaded with the resource form.
+
+With ``ckanext.s3filestore.async_uploads`` enabled, files uploaded through
+CKAN are copied to a staging directory shared with the background workers
+(``ckan jobs worker``) instead of being sent to S3 within the request. The
+resource is flagged with ``s3_upload_status`` ``pending`` until the job
+uploads the file, then ``complete``, or ``failed`` with the error in
+``s3_upload_error``. Meanwhile the job records the share of the file sent
+in ``s3_upload_progress``.
+'''
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from boto3.s3.transfer import TransferConfig
+import ckantoolkit as toolkit
+import ckan.model as model
+
+from ckanext.s3filestore import metrics
+from ckanext.s3filestore.uploader import (
+    S3ResourceUploader, UPLOAD_COMPLETE, UPLOAD_FAILED)
+
+config = toolkit.config
+log = logging.getLogger(__name__)
+
+
+def _update_resource(resource_id, filename, reindex=False, **fields):
+    '''Write `fields` to the resource, unless another file was uploaded to
+    it in the meantime, and reindex its package if `reindex`.
+
+    Only these fields of the resource row are updated: a resource_patch
+    would write back the whole resource read beforehand, racing with the
+    edits of the users, and run the package hooks and activities for each
+    report of the progress.'''
+    # Read the committed state, not the one of the previous update
+    model.Session.remove()
+    resource = model.Resource.get(resource_id)
+    if resource is None or resource.state == 'deleted':
+        log.warning('Resource {0} was deleted during its upload'
+                    .format(resource_id))
+        return False
+    if os.path.basename(resource.url or '') != filename:
+        log.info('Resource {0} has another file, dropping the status of '
+                 '{1}'.format(resource_id, filename))
+        return False
+    extras = dict(resource.extras or {})
+    for field, value in fields.items():
+        if hasattr(model.Resource, field):
+            setattr(resource, field, value)
+        else:
+            extras[field] = str(value)
+    # The extras are only saved when assigned a new dict
+    resource.extras = extras
+    package_id = resource.package_id
+    model.repo.commit()
+    if reindex:
+        from ckan.lib.search import rebuild
+        from ckanext.s3filestore.helpers import invalidate_package_cache
+
+        rebuild(package_id)
+        invalidate_package_cache({'id': package_id})
+    return True
+
+
+def _wait_for_resource(resource_id, filename):
+    '''Wait up to ``async_upload_wait`` seconds for the resource to be
+    committed with the file `filename`, returning False if it isn't.'''
+    deadline = time.time() + float(config.get(
+        'ckanext.s3filestore.async_upload_wait', 60))
+    while True:
+        # Read the committed state, not the one of the previous poll
+        model.Session.remove()
+        resource = model.Resource.get(resource_id)
+        if resource is not None and resource.state == 'active' and \
+                os.path.basename(resource.url or '') == filename:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(1)
+
+
+def upload_resource_file(resource_id, target, key, path, filename,
+                         mimetype, encoding=None):
+    '''Upload the staged file at `path` to `key` in the bucket of the routing
+    `target`, with its `encoding` compressed variant, and report the
+    progress and outcome on the resource. The staged file is removed once
+    done.'''
+    if not _wait_for_resource(resource_id, filename):
+        # The request staging the file failed, or another file was uploaded
+        log.warning('Resource {0} was not saved with {1}, dropping its '
+                    'upload'.format(resource_id, filename))
+        os.remove(path)
+        return
+
+    upload = S3ResourceUploader({})
+    upload.use_target(target)
+    size = os.path.getsize(path)
+    interval = float(config.get(
+        'ckanext.s3filestore.async_upload_progress_interval', 30))
+    sent = [0]
+    lock = threading.Lock()
+
+    def progress(amount):
+        # Called by the threads of the transfer
+        with lock:
+            sent[0] += amount
+
+    def transfer():
+        with metrics.timed('upload_file'):
+            upload.get_s3_client().upload_file(
+                path, upload.bucket_name, key,
+                ExtraArgs={'ACL': upload.acl,
+                           'ContentType': mimetype or 'text/plain'},
+                Callback=progress,
+                Config=TransferConfig(
+                    max_concurrency=upload.copy_workers))
+        metrics.add_uploaded_bytes(size)
+        upload.invalidate(key)
+        if encoding:
+            try:
+                with open(path, 'rb') as upload_file:
+                    upload.upload_compressed_variant(
+                        key, upload_file, encoding, mimetype)
+            except Exception as e:
+                # Downloads fall back to the original object
+                log.error('Could not upload the compressed variant of '
+                          '{0}: {1}'.format(key, e))
+
+    start = time.time()
+    try:
+        # The resource is updated from this thread only, as the database
+        # session is not thread-safe
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(transfer)
+            while not wait([future], timeout=interval).done:
+                _update_resource(resource_id, filename,
+                                 s3_upload_progress=int(
+                                     100 * sent[0] / (size or 1)))
+            future.result()
+    except Exception as e:
+        log.error('Upload of {0} to {1} failed: {2}'.format(path, key, e))
+        _update_resource(resource_id, filename,
+                         reindex=True, s3_upload_status=UPLOAD_FAILED,
+                         s3_upload_error=str(e))
+        raise
+    finally:
+        os.remove(path)
+
+    log.info('Uploaded {0} ({1} bytes) to {2} in {3:.1f}s'.format(
+        filename, size, key, time.time() - start))
+    _update_resource(resource_id, filename, reindex=True,
+                     s3_upload_status=UPLOAD_COMPLETE,
+                     s3_upload_progress=100, s3_upload_error='', size=size)
@@ -0,0 +1,138 @@
+# encoding: utf-8
+'''Prometheus instrumentation for S3 operations and the download views.
+
+Metrics are only collected when the optional ``prometheus_client`` package
+is installed, otherwise every helper in this module is a no-op. When the
+``PROMETHEUS_MULTIPROC_DIR`` environment variable is set (e.g. when running
+under gunicorn with several workers) the samples of all worker processes are
+aggregated when the metrics are exposed.
+'''
+import os
+import time
+import logging
+import functools
+import contextlib
+
+from botocore.exceptions import ClientError
+from werkzeug.exceptions import HTTPException
+
+from ckanext.s3filestore import profiling
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0)
+
+if prometheus_client is not None:
+    S3_OPERATION_SECONDS = prometheus_client.Histogram(
+        's3filestore_s3_operation_duration_seconds',
+        'Time spent in S3 operations',
+        ['operation'],
+        buckets=LATENCY_BUCKETS)
+    S3_OPERATION_ERRORS = prometheus_client.Counter(
+        's3filestore_s3_operation_errors_total',
+        'S3 operations that failed, by S3 error code',
+        ['operation', 'code'])
+    S3_UPLOADED_BYTES = prometheus_client.Counter(
+        's3filestore_s3_uploaded_bytes_total',
+        'Bytes uploaded to S3 by CKAN')
+    VIEW_SECONDS = prometheus_client.Histogram(
+        's3filestore_view_duration_seconds',
+        'Time spent serving download and redirect views',
+        ['view', 'status'],
+        buckets=LATENCY_BUCKETS)
+    CACHE_REQUESTS = prometheus_client.Counter(
+        's3filestore_cache_requests_total',
+        'Cache lookups, by cache name and result (hit or miss)',
+        ['cache', 'result'])
+
+
+def is_available():
+    '''Return True if the prometheus_client package is installed.'''
+    return prometheus_client is not None
+
+
+def error_code(exc):
+    '''Return the S3 error code of `exc`, or its class name for errors
+    raised before a response was received (timeouts, connection errors).'''
+    if isinstance(exc, ClientError):
+        return exc.response.get('Error', {}).get('Code') or 'Unknown'
+    return type(exc).__name__
+
+
+@contextlib.contextmanager
+def timed(operation, s3_call=True):
+    '''Context manager recording the latency and the errors of the S3
+    `operation` executed within it. `s3_call` is False for operations which
+    do not send a request to S3, e.g. presigning.'''
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        if prometheus_client is not None:
+            S3_OPERATION_ERRORS.labels(operation, error_code(e)).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if prometheus_client is not None:
+            S3_OPERATION_SECONDS.labels(operation).observe(elapsed)
+        profiling.record(operation, elapsed, s3_call)
+
+
+def add_uploaded_bytes(size):
+    if prometheus_client is not None and size:
+        S3_UPLOADED_BYTES.inc(size)
+
+
+def record_cache_lookup(cache, hit):
+    '''Count a lookup in the `cache` named cache. The hit ratio is
+    ``hit / (hit + miss)`` of ``s3filestore_cache_requests_total``.'''
+    if prometheus_client is not None:
+        CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def timed_view(name):
+    '''Decorator recording the latency and response status of a view.'''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = view(*args, **kwargs)
+                status = getattr(response, 'status_code', 200)
+                return response
+            except HTTPException as e:
+                status = e.code
+                raise
+            finally:
+                if prometheus_client is not None:
+                    VIEW_SECONDS.labels(name, str(status)).observe(
+                        time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def generate_latest():
+    '''Return the exposition payload and its content type.'''
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (prometheus_client.generate_latest(registry),
+            prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead(pid):
+    '''Remove the samples of a dead worker. Call it from gunicorn's
+    ``child_exit`` server hook when running in multiprocess mode.'''
+    if prometheus_client is not None and \
+            os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -1,23 +1,43 @@
 # encoding: utf-8
+# The actions, uploaders, views and commands are imported when CKAN asks for
+# them, and boto3 and magic on their first use, so that loading the plugin
+# stays cheap for the CKAN commands and workers which don't touch S3.
 import ckan.plugins as plugins
 import ckantoolkit as toolkit
 
-from ckanext.s3filestore.helpers import get_or_create_user_api_key_safe, get_package_by_name
-from ckanext.s3filestore.actions import (
-    get_signed_url,
-    create_multipart_upload,
-    prepare_upload_parts,
-    complete_multipart_upload,
-    resource_create,
-    list_parts,
-    abort_multipart_upload,
-    sign_part,
+from ckanext.s3filestore.helpers import (
+    evict_changed_packages,
+    get_or_create_user_api_key_safe,
+    get_package_by_name,
+    invalidate_package_cache,
 )
-import ckanext.s3filestore.uploader
-from ckanext.s3filestore.views import resource, uploads
-from ckanext.s3filestore.click_commands import upload_resources
 from ckan.types import Action, AuthFunction, Context, DataDict, AuthResult
 
+# Actions allowed to the users who may create datasets
+PACKAGE_CREATE_ACTIONS = (
+    "get_signed_url",
+    "get_signed_urls",
+    "create_multipart_upload",
+    "prepare_upload_parts",
+    "complete_multipart_upload",
+    "list_parts",
+    "abort_multipart_upload",
+    "sign_part",
+    "handle_upload_endpoint",
+    "copy_resource",
+    "clone_package",
+    "finalize_upload",
+)
+
+
+def _package_create_auth(context: Context, data_dict: DataDict) -> AuthResult:
+    return toolkit.check_access("package_create", context, data_dict)
+
+
+def _allow_auth(context: Context, data_dict: DataDict) -> AuthResult:
+    return {"success": True}
+
+
 class S3FileStorePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IConfigurable)
@@ -28,6 +48,8 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IBlueprint)
     plugins.implements(plugins.IClick)
     plugins.implements(plugins.IResourceController)
+    plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     # IConfigurer
     def update_config(self, config_):
@@ -58,70 +80,73 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         if toolkit.asbool(
                 config.get('ckanext.s3filestore.check_access_on_startup',
                            True)):
+            import ckanext.s3filestore.uploader
             ckanext.s3filestore.uploader.BaseS3Uploader().get_s3_bucket(
                 config.get('ckanext.s3filestore.aws_bucket_name'))
 
     # IUploader
     def get_resource_uploader(self, data_dict):
         '''Return an uploader object used to upload resource files.'''
+        import ckanext.s3filestore.uploader
         return ckanext.s3filestore.uploader.S3ResourceUploader(data_dict)
 
     def get_uploader(self, upload_to, old_filename=None):
         '''Return an uploader object used to upload general files.'''
+        import ckanext.s3filestore.uploader
         return ckanext.s3filestore.uploader.S3Uploader(upload_to,
                                                        old_filename)
 
     # IBlueprint
     def get_blueprint(self):
+        from ckanext.s3filestore.views import (
+            resource, uploads, dataset, metrics, profiling)
+
         blueprints = resource.get_blueprints() +\
-            uploads.get_blueprints()
+            uploads.get_blueprints() +\
+            dataset.get_blueprints() +\
+            metrics.get_blueprints() +\
+            profiling.get_blueprints()
         return blueprints
 
     # IClick
     def get_commands(self):
-        return [upload_resources]
+        from ckanext.s3filestore.click_commands import (
+            upload_resources, s3filestore)
+
+        return [upload_resources, s3filestore]
 
     # IAuthFunctions
     def get_auth_functions(self) -> dict[str, AuthFunction]:
-        def get_signed_url_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        def create_multipart_upload_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        def prepare_upload_parts_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        def complete_multipart_upload_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        def list_parts_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        def abort_multipart_upload_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        def sign_part_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        def handle_upload_endpoint_auth(context: Context, data_dict: DataDict) -> AuthResult:
-            return toolkit.check_access("package_create", context, data_dict)
-        
-        return {
-            "get_signed_url": get_signed_url_auth,
-            "create_multipart_upload": create_multipart_upload_auth,
-            "prepare_upload_parts": prepare_upload_parts_auth,
-            "complete_multipart_upload": complete_multipart_upload_auth,
-            "list_parts": list_parts_auth,
-            "abort_multipart_upload": abort_multipart_upload_auth,
-            "sign_part": sign_part_auth,
-            "handle_upload_endpoint": handle_upload_endpoint_auth,
-        }
+        auth_functions = dict(
+            (name, _package_create_auth) for name in PACKAGE_CREATE_ACTIONS)
+        # Access is checked by package_show for each package, and by
+        # resource_show
+        auth_functions["get_download_urls"] = _allow_auth
+        auth_functions["get_resource_preview"] = _allow_auth
+        return auth_functions
 
     # IActions
     def get_actions(self):
+        from ckanext.s3filestore.actions import (
+            get_signed_url,
+            get_signed_urls,
+            create_multipart_upload,
+            prepare_upload_parts,
+            complete_multipart_upload,
+            resource_create,
+            list_parts,
+            abort_multipart_upload,
+            sign_part,
+            get_download_urls,
+            copy_resource,
+            clone_package,
+            get_resource_preview,
+            finalize_upload,
+        )
+
         return {
             'get_signed_url': get_signed_url,
+            'get_signed_urls': get_signed_urls,
             'create-multipart-upload': create_multipart_upload,
             'prepare-upload-parts': prepare_upload_parts,
             'resource_create': resource_create,
@@ -129,6 +154,11 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
             'list-parts': list_parts,
             'abort-multipart-upload': abort_multipart_upload,
             'sign-part': sign_part,
+            'get_download_urls': get_download_urls,
+            'copy_resource': copy_resource,
+            'clone_package': clone_package,
+            'get_resource_preview': get_resource_preview,
+            'finalize_upload': finalize_upload,
         } 
     
     # ITemplateHelpers
@@ -156,8 +186,10 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         pass
 
     def after_resource_create(self, context, resource_dict):
-        '''Required by IResourceController'''
-        pass
+        from ckanext.s3filestore.uploader import enqueue_staged_upload
+
+        # The resource is committed, its background upload can start
+        enqueue_staged_upload(resource_dict['id'])
 
     def after_create(self, context, resource_dict):
         '''Required by IResourceController'''
@@ -172,16 +204,22 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         pass
 
     def before_resource_update(self, context, current, resource_dict):
-        '''Required by IResourceController'''
-        pass
+        from ckanext.s3filestore.uploader import TARGET_FIELD
+
+        # Keep the resource pinned to the bucket of its file when the
+        # update doesn't carry the field
+        if current.get(TARGET_FIELD) is not None and \
+                resource_dict.get(TARGET_FIELD) is None:
+            resource_dict[TARGET_FIELD] = current[TARGET_FIELD]
 
     def before_update(self, context, current, resource_dict):
         '''Required by IResourceController'''
         pass
 
     def after_resource_update(self, context, resource_dict):
-        '''Required by IResourceController'''
-        pass
+        from ckanext.s3filestore.uploader import enqueue_staged_upload
+
+        enqueue_staged_upload(resource_dict['id'])
 
     def after_update(self, context, resource_dict):
         '''Required by IResourceController'''
@@ -191,8 +229,76 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         # Delete the resource from the storage
         for rs in resources:
             if rs.get('id') == resource.get('id'):
+                import ckanext.s3filestore.uploader
                 ckanext.s3filestore.uploader.delete_from_bucket(rs)
 
     def before_resource_delete(self, context, resource, resources):
         '''Required by IResourceController'''
-        pass
\ No newline at end of file
+        pass
+
+    # IPackageController
+    def after_dataset_update(self, context, pkg_dict):
+        from ckanext.s3filestore.uploader import forget_package_target
+
+        # Also called when its resources are changed
+        invalidate_package_cache(pkg_dict)
+        # The package may have moved to another organization
+        forget_package_target(pkg_dict.get('id'), pkg_dict.get('name'))
+
+    def after_dataset_delete(self, context, pkg_dict):
+        invalidate_package_cache(pkg_dict)
+
+    # IMiddleware
+    def make_middleware(self, app, config):
+        if hasattr(app, 'teardown_request'):
+            app.before_request(_stage_resource_files)
+            app.teardown_request(_teardown_request)
+        return app
+
+
+# Actions of the API receiving the files of resources
+RESOURCE_FILE_ACTIONS = ('resource_create', 'resource_update', 'resource_patch')
+
+
+def _receives_resource_files(request):
+    '''Return True if `request` is sent to the resource form or to an API
+    action which may be given the file of a resource.'''
+    endpoint = request.endpoint or ''
+    if endpoint.endswith(('_resource.new', '_resource.edit')):
+        return True
+    return endpoint == 'api.action' and (request.view_args or {}).get(
+        'logic_function') in RESOURCE_FILE_ACTIONS
+
+
+def _stage_resource_files():
+    '''Receive the files uploaded to resources which may be sent to S3 in
+    the background straight in the staging directory, where they are then
+    linked instead of copied.'''
+    import flask
+    from ckanext.s3filestore.uploader import staging_file_stream
+
+    request = flask.request._get_current_object()
+    if not _receives_resource_files(request):
+        return
+    get_file_stream = request._get_file_stream
+
+    def _get_file_stream(total_content_length, content_type, filename=None,
+                         content_length=None):
+        return staging_file_stream(total_content_length) or get_file_stream(
+            total_content_length, content_type, filename, content_length)
+    request._get_file_stream = _get_file_stream
+
+
+def _teardown_request(exception=None):
+    '''Enqueue the uploads staged by actions which don't run the resource
+    hooks, e.g. package_create with uploaded files, and evict the packages
+    changed by the request, now committed.'''
+    from ckanext.s3filestore.uploader import (
+        discard_staged_upload, enqueue_staged_upload)
+
+    if exception is not None:
+        # Nothing was committed
+        discard_staged_upload()
+        return
+    enqueue_staged_upload()
+    evict_changed_packages()
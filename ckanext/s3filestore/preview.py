@@ -0,0 +1,98 @@
+# encoding: utf-8
+'''Samples of the first records of uploaded text files, for previews.
+
+Only a leading byte range of the object is fetched, cut after its last
+complete line (or CSV record, whose quoted fields may span lines). Samples
+are cached per key along with the ETag of the object, and revalidated with a
+conditional ranged GET, so that an unchanged object costs a single request
+without a body.
+'''
+import logging
+
+from botocore.exceptions import ClientError
+
+from ckanext.s3filestore import metrics
+from ckanext.s3filestore.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+_samples = LRUCache('preview', max_size=1024)
+
+
+def _record_ends(data, quoted=False):
+    '''Generate the offsets following each complete line of `data`, not
+    counting the line breaks within double quotes when `quoted` is set.'''
+    newline = b'\n' if isinstance(data, bytes) else u'\n'
+    quote = b'"' if isinstance(data, bytes) else u'"'
+    offset = 0
+    in_quotes = False
+    for line in data.split(newline)[:-1]:
+        offset += len(line) + 1
+        # Escaped quotes ("") toggle twice
+        if quoted and line.count(quote) % 2:
+            in_quotes = not in_quotes
+        if not in_quotes:
+            yield offset
+
+
+def cut_at_record(data, quoted=False):
+    '''Return `data` up to its last complete line or record.'''
+    end = 0
+    for end in _record_ends(data, quoted):
+        pass
+    return data[:end]
+
+
+def first_records(text, count, quoted=False):
+    '''Return the first `count` lines or records of `text`.'''
+    for i, end in enumerate(_record_ends(text, quoted), 1):
+        if i == count:
+            return text[:end]
+    return text
+
+
+def _fetch(upload, key, max_bytes, etag=None):
+    params = {'Bucket': upload.bucket_name, 'Key': key,
+              'Range': 'bytes=0-{0}'.format(max_bytes - 1)}
+    if etag:
+        params['IfNoneMatch'] = etag
+    client = upload.get_s3_client(read_only=True)
+    try:
+        with metrics.timed('get_object'):
+            response = client.get_object(**params)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return None
+        raise
+    with response['Body'] as body:
+        data = body.read()
+    if 'ContentRange' in response:
+        size = int(response['ContentRange'].rsplit('/', 1)[1])
+    else:
+        size = response['ContentLength']
+    return response['ETag'], data, size
+
+
+def get_sample(upload, key, max_bytes, quoted=False):
+    '''Return the sample of the first `max_bytes` bytes of `key` as a dict
+    with the `text` of the complete lines, the `size` of the object, its
+    `etag` and whether the sample is `truncated`.'''
+    cache_key = (upload.bucket_name, key, max_bytes, quoted)
+    cached = _samples.get(cache_key)
+    fetched = _fetch(upload, key, max_bytes,
+                     cached['etag'] if cached else None)
+    if fetched is None:
+        return cached
+
+    etag, data, size = fetched
+    truncated = len(data) < size
+    if truncated:
+        data = cut_at_record(data, quoted)
+    sample = {
+        'text': data.decode('utf-8', 'replace'),
+        'size': size,
+        'etag': etag,
+        'truncated': truncated,
+    }
+    _samples.set(cache_key, sample)
+    return sample
@@ -0,0 +1,115 @@
+# encoding: utf-8
+'''Opt-in per-request profiling of the work done to serve a request.
+
+When ``ckanext.s3filestore.profiling_enabled`` is set, every step of a
+request (action calls, client construction, each S3 call and signing) is
+recorded as a timed span on ``flask.g``. At the end of the request the spans
+are emitted in a ``Server-Timing`` response header, slow requests are logged
+with their breakdown and requests making more S3 calls than the configured
+budget are flagged.
+'''
+import time
+import logging
+import contextlib
+from collections import OrderedDict
+
+import flask
+
+import ckantoolkit as toolkit
+
+config = toolkit.config
+log = logging.getLogger(__name__)
+
+SPANS_ATTR = 's3filestore_spans'
+START_ATTR = 's3filestore_request_start'
+
+
+def is_enabled():
+    return toolkit.asbool(
+        config.get('ckanext.s3filestore.profiling_enabled', False))
+
+
+def _current_spans():
+    # Spans are only collected within a request that is being profiled,
+    # e.g. not from CLI commands or worker threads.
+    if not flask.has_request_context():
+        return None
+    return flask.g.get(SPANS_ATTR)
+
+
+def record(name, duration, s3_call=False):
+    '''Record a span of `duration` seconds named `name` on the current
+    request. `s3_call` marks spans which made a request to S3.'''
+    spans = _current_spans()
+    if spans is not None:
+        spans.append((name, duration, s3_call))
+
+
+@contextlib.contextmanager
+def span(name, s3_call=False):
+    '''Context manager recording the time spent within it as a span.'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, s3_call)
+
+
+def start_request():
+    setattr(flask.g, SPANS_ATTR, [])
+    setattr(flask.g, START_ATTR, time.perf_counter())
+
+
+def summarize(spans):
+    '''Aggregate spans by name, returning an ordered mapping of
+    ``name: (count, total seconds)``.'''
+    summary = OrderedDict()
+    for name, duration, _s3_call in spans:
+        count, total = summary.get(name, (0, 0.0))
+        summary[name] = (count + 1, total + duration)
+    return summary
+
+
+def server_timing_header(summary, total):
+    entries = []
+    for name, (count, duration) in summary.items():
+        entry = '{0};dur={1:.1f}'.format(name, duration * 1000)
+        if count > 1:
+            entry += ';desc="{0} calls"'.format(count)
+        entries.append(entry)
+    entries.append('total;dur={0:.1f}'.format(total * 1000))
+    return ', '.join(entries)
+
+
+def finish_request(response):
+    spans = flask.g.get(SPANS_ATTR)
+    start = flask.g.get(START_ATTR)
+    if spans is None or start is None:
+        return response
+    total = time.perf_counter() - start
+    summary = summarize(spans)
+    s3_calls = sum(1 for _name, _duration, s3_call in spans if s3_call)
+
+    response.headers['Server-Timing'] = server_timing_header(summary, total)
+
+    breakdown = ', '.join(
+        '{0}={1}x{2:.1f}ms'.format(name, count, duration * 1000)
+        for name, (count, duration) in summary.items())
+
+    threshold = int(config.get(
+        'ckanext.s3filestore.profiling_slow_request_threshold', 1000))
+    if total * 1000 > threshold:
+        log.warning('Slow request {0} {1} took {2:.1f}ms ({3} S3 calls): {4}'
+                    .format(flask.request.method, flask.request.path,
+                            total * 1000, s3_calls, breakdown))
+
+    budget = int(config.get('ckanext.s3filestore.profiling_s3_call_budget',
+                            0))
+    if budget and s3_calls > budget:
+        response.headers['X-S3filestore-Call-Budget-Exceeded'] = \
+            '{0}/{1}'.format(s3_calls, budget)
+        log.warning('Request {0} {1} made {2} S3 calls, over the budget of '
+                    '{3}: {4}'.format(flask.request.method,
+                                      flask.request.path, s3_calls, budget,
+                                      breakdown))
+    return response
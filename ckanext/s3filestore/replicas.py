@@ -0,0 +1,251 @@
+# encoding: utf-8
+'''Read routing across replicas of the bucket in other regions.
+
+Replicas are listed in ``ckanext.s3filestore.replicas`` and configured with
+``ckanext.s3filestore.replica.<name>.*`` options, any option not set being
+inherited from the primary bucket. Each replica has the locations it serves,
+e.g. country or continent codes, matched against the location of the
+requester: the value of a header set by the CDN or load balancer, or the
+country and continent of the client address in a GeoIP2 database (requires
+the optional ``geoip2`` package).
+
+Downloads are signed for the closest replica holding the object. The HEAD
+request checking that it exists is hedged: when the closest replica hasn't
+answered after ``replica_hedge_delay`` milliseconds the same request is sent
+to the next one, and the replica which finds the object first wins. Replicas
+answering slower than ``replica_slow_threshold`` milliseconds, or failing,
+are skipped for ``replica_cooldown`` seconds.
+'''
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from botocore.exceptions import BotoCoreError, ClientError
+import ckantoolkit as toolkit
+
+from ckanext.s3filestore.breaker import CircuitOpenError
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+try:
+    import geoip2.database
+    import geoip2.errors
+except ImportError:
+    geoip2 = None
+
+config = toolkit.config
+log = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=16,
+                               thread_name_prefix='s3filestore-hedge')
+_geoip_readers = {}
+_geoip_lock = threading.Lock()
+# The replicas, built once for the options they are configured with
+_replicas = {}
+_replicas_lock = threading.Lock()
+
+
+class Replica(BaseS3Uploader):
+    '''A read replica of the bucket, with its own pooled clients.'''
+
+    def __init__(self, name):
+        super(Replica, self).__init__()
+        self.name = name
+        prefix = 'ckanext.s3filestore.replica.{0}.'.format(name)
+        self.apply_options(prefix)
+        self.locations = set(location.upper() for location in toolkit.aslist(
+            config.get(prefix + 'locations', '')))
+
+
+class Health(object):
+    '''Recent health of the replicas of the process.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._down_until = {}
+
+    def record(self, name, elapsed, failed=False):
+        slow_threshold = float(config.get(
+            'ckanext.s3filestore.replica_slow_threshold', 1000)) / 1000
+        if not failed and elapsed <= slow_threshold:
+            return
+        cooldown = float(config.get(
+            'ckanext.s3filestore.replica_cooldown', 30))
+        with self._lock:
+            if name not in self._down_until:
+                log.warning('S3 replica {0} is {1}, skipping it for {2}s'
+                            .format(name, 'failing' if failed else 'slow',
+                                    cooldown))
+            self._down_until[name] = time.time() + cooldown
+
+    def is_healthy(self, name):
+        with self._lock:
+            down_until = self._down_until.get(name)
+            if down_until is None:
+                return True
+            if down_until <= time.time():
+                del self._down_until[name]
+                return True
+            return False
+
+    def reset(self):
+        with self._lock:
+            self._down_until.clear()
+
+
+health = Health()
+
+
+def get_replicas():
+    '''Return the configured replicas.'''
+    names = toolkit.aslist(config.get('ckanext.s3filestore.replicas', ''))
+    if not names:
+        return []
+    # Replicas inherit the options of the primary bucket
+    key = tuple(sorted((option, str(value))
+                       for option, value in config.items()
+                       if option.startswith('ckanext.s3filestore.')))
+    replicas = _replicas.get(key)
+    if replicas is None:
+        with _replicas_lock:
+            replicas = _replicas.get(key)
+            if replicas is None:
+                # Those of former options are never used again
+                _replicas.clear()
+                replicas = _replicas[key] = [Replica(name) for name in names]
+    return replicas
+
+
+def _geoip_reader(path):
+    with _geoip_lock:
+        reader = _geoip_readers.get(path)
+        if reader is None:
+            reader = _geoip_readers[path] = geoip2.database.Reader(path)
+        return reader
+
+
+def locate(request):
+    '''Return the set of location codes of the requester of `request`, empty
+    if it is unknown.'''
+    if request is None:
+        return set()
+    header = config.get('ckanext.s3filestore.replica_location_header')
+    if header and request.headers.get(header):
+        return set(location.strip().upper() for location
+                   in request.headers[header].split(','))
+
+    database = config.get('ckanext.s3filestore.replica_geoip_database')
+    if not database or not request.remote_addr:
+        return set()
+    if geoip2 is None:
+        log.warning('geoip2 is not installed, replicas are not routed '
+                    'by client address')
+        return set()
+    try:
+        country = _geoip_reader(database).country(request.remote_addr)
+    except (ValueError, geoip2.errors.AddressNotFoundError):
+        return set()
+    return set(code for code in (country.country.iso_code,
+                                 country.continent.code) if code)
+
+
+def order(upload, location):
+    '''Return the primary `upload` and the replicas to read from, closest
+    to `location` first, then the primary and the other replicas, the
+    unhealthy ones last.
+
+    Replicas mirror the default bucket, the files of the packages routed to
+    other buckets are only read from their bucket.'''
+    replicas = get_replicas()
+    if not replicas or getattr(upload, 'target', None):
+        return [upload]
+    closest = [r for r in replicas if r.locations & location]
+    others = [r for r in replicas if not r.locations & location]
+    candidates = closest + [upload] + others
+    return sorted(candidates, key=lambda candidate: not health.is_healthy(
+        getattr(candidate, 'name', None)))
+
+
+def _head(candidate, key):
+    start = time.perf_counter()
+    try:
+        # Served from the metadata cache when it is enabled
+        response = candidate.head_object(key)
+    except ClientError as e:
+        # A missing key is a healthy answer
+        health.record(getattr(candidate, 'name', None),
+                      time.perf_counter() - start,
+                      e.response['Error']['Code'] not in ['NoSuchKey', '404'])
+        raise
+    except (BotoCoreError, CircuitOpenError):
+        health.record(getattr(candidate, 'name', None),
+                      time.perf_counter() - start, True)
+        raise
+    health.record(getattr(candidate, 'name', None),
+                  time.perf_counter() - start)
+    return response
+
+
+def hedged_head(candidates, key, delay=None):
+    '''HEAD `key` on the `candidates` in order, sending the request to the
+    next one every `delay` seconds without answer or as soon as one doesn't
+    have it, and return the first candidate which has the object.
+
+    Raises the error of the primary bucket if it failed, else the 404
+    `ClientError` if none has the object, otherwise the last error.
+    '''
+    if delay is None:
+        delay = float(config.get(
+            'ckanext.s3filestore.replica_hedge_delay', 50)) / 1000
+    remaining = iter(candidates)
+    sent = {}
+    not_found = None
+    error = None
+    primary_error = None
+
+    def send_next():
+        candidate = next(remaining, None)
+        if candidate is not None:
+            sent[_executor.submit(_head, candidate, key)] = candidate
+
+    send_next()
+    pending = set(sent)
+    while pending:
+        done, pending = wait(pending, timeout=delay,
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                future.result()
+            except (ClientError, BotoCoreError, CircuitOpenError) as e:
+                if isinstance(e, ClientError) and \
+                        e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                    not_found = e
+                    continue
+                error = e
+                if getattr(sent[future], 'name', None) is None:
+                    # Replicas without the object mustn't hide a failure
+                    # of the primary bucket
+                    primary_error = e
+            else:
+                return sent[future]
+        before = len(sent)
+        send_next()
+        pending |= set(list(sent)[before:])
+    raise primary_error or not_found or error
+
+
+def get_signed_url(upload, key, extra_params={}, read_only=False,
+                   check_exists=True, expires_in=None, request=None):
+    '''Return a URL to `key` signed for the closest replica to the requester
+    of `request` which has the object, see `get_signed_url_to_key`.'''
+    candidates = order(upload, locate(request))
+    if len(candidates) == 1:
+        return upload.get_signed_url_to_key(
+            key, extra_params, read_only=read_only,
+            check_exists=check_exists, expires_in=expires_in)
+    candidate = candidates[0]
+    if check_exists:
+        candidate = hedged_head(candidates, key)
+    return candidate.get_signed_url_to_key(
+        key, extra_params, read_only=read_only, check_exists=False,
+        expires_in=expires_in)
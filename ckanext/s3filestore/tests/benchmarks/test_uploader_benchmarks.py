@@ -0,0 +1,134 @@
+# encoding: utf-8
+'''Performance baselines of the uploader and action hot paths.
+
+These run against moto's in-process S3 mock so that they measure the
+extension (client construction, signing, request serialization) rather than
+the network. Run them with::
+
+    pytest --ckan-ini=test.ini --benchmark-only --benchmark-autosave \\
+        --benchmark-compare ckanext/s3filestore/tests/benchmarks
+
+``--benchmark-autosave`` stores each run under ``.benchmarks/`` and
+``--benchmark-compare`` compares it with the previous one.
+'''
+import io
+
+import pytest
+from botocore.stub import Stubber
+from werkzeug.datastructures import FileStorage
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore.uploader import (
+    BaseS3Uploader,
+    S3ResourceUploader,
+    reset_clients,
+)
+
+
+KEY = u'resources/benchmark/data.csv'
+UPLOAD_ID = u'benchmark-upload-id'
+
+CSV_HEADER = b'SnowCourseName,Number,Elev. metres,DateOfSurvey,Snow Depth cm\n'
+CSV_ROW = b'SKINS LAKE,1B05,890,2015/12/30,34\n'
+
+
+@pytest.fixture
+def uploader(s3_mock):
+    return BaseS3Uploader()
+
+
+@pytest.fixture
+def uploaded_key(uploader):
+    uploader.upload_to_key(KEY, io.BytesIO(CSV_HEADER + CSV_ROW * 100))
+    return KEY
+
+
+def _presign_parts(uploader, count):
+    for part_number in range(1, count + 1):
+        uploader.generate_multipart_presigned_url(
+            KEY, UPLOAD_ID, part_number)
+
+
+def test_client_construction(benchmark, uploader):
+    benchmark.pedantic(uploader.get_s3_client, setup=reset_clients,
+                       rounds=20)
+
+
+def test_pooled_client(benchmark, uploader):
+    benchmark(uploader.get_s3_client)
+
+
+def test_get_signed_url_to_key(benchmark, uploader, uploaded_key):
+    url = benchmark(uploader.get_signed_url_to_key, uploaded_key)
+    assert uploaded_key in url
+
+
+@pytest.mark.parametrize(u'parts', [1, 10000])
+def test_generate_multipart_presigned_url(benchmark, uploader, parts):
+    benchmark.pedantic(_presign_parts, args=(uploader, parts),
+                       rounds=3 if parts > 1 else 100)
+
+
+@pytest.mark.parametrize(u'size', [1024, 1024 ** 2, 16 * 1024 ** 2],
+                         ids=[u'1KB', u'1MB', u'16MB'])
+def test_upload_to_key(benchmark, uploader, size):
+    upload_file = io.BytesIO(b'x' * size)
+    benchmark(uploader.upload_to_key, KEY, upload_file)
+
+
+@pytest.mark.parametrize(u'filename,content', [
+    (u'data.csv', CSV_HEADER + CSV_ROW * 100),
+    (u'data.bin', b'\0\1\2\3' * 1024),
+])
+def test_mime_sniffing(benchmark, s3_mock, filename, content):
+    def sniff():
+        resource = {u'upload': FileStorage(io.BytesIO(content), filename)}
+        return S3ResourceUploader(resource).mimetype
+
+    assert benchmark(sniff)
+
+
+def test_complete_multipart_upload_10000_parts(benchmark, uploader,
+                                               monkeypatch):
+    '''Only the handling of the parts list and the request serialization
+    are measured, S3 itself is stubbed as moto would require 10,000 parts
+    of at least 5MB each to be uploaded first.'''
+    client = uploader.get_s3_client()
+    stubber = Stubber(client)
+    stubber.activate()
+    monkeypatch.setattr(uploader, u'get_s3_client',
+                        lambda *args, **kwargs: client)
+    parts = [{u'number': number, u'etag': u'"etag-{0}"'.format(number)}
+             for number in range(10000, 0, -1)]
+
+    def stub_response():
+        stubber.add_response(u'complete_multipart_upload', {
+            u'Location': u'https://test-bucket.s3.amazonaws.com/' + KEY,
+            u'Bucket': u'test-bucket',
+            u'Key': KEY,
+            u'ETag': u'"etag-10000"',
+        })
+
+    benchmark.pedantic(uploader.complete_multipart_upload,
+                       args=(KEY, UPLOAD_ID, parts),
+                       setup=stub_response, rounds=10)
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.parametrize(u'parts', [1, 10000])
+def test_prepare_upload_parts_action(benchmark, s3_mock, parts):
+    dataset = factories.Dataset()
+    context = {u'user': factories.Sysadmin()[u'name']}
+
+    def prepare():
+        return helpers.call_action(
+            u'prepare-upload-parts', dict(context),
+            package_id=dataset[u'id'],
+            uploadId=UPLOAD_ID,
+            key=KEY,
+            parts=[{u'number': number} for number in range(1, parts + 1)])
+
+    result = benchmark.pedantic(prepare, rounds=3 if parts > 1 else 50)
+    assert len(result[u'presignedUrls']) == parts
@@ -0,0 +1,30 @@
+# encoding: utf-8
+'''Performance baselines of the pages rendered with the extension templates,
+see test_uploader_benchmarks for how to run them.'''
+import pytest
+
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore.cache import reset_metadata_caches
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.parametrize(u'ttl', [u'0', u'60'],
+                         ids=[u'per_request', u'shared'])
+def test_resource_form_render(benchmark, app, s3_mock, ckan_config,
+                              monkeypatch, ttl):
+    monkeypatch.setitem(ckan_config,
+                        u'ckanext.s3filestore.helper_cache_ttl', ttl)
+    reset_metadata_caches()
+    sysadmin = factories.Sysadmin()
+    dataset = factories.Dataset(
+        resources=[{u'url': u'https://example.com/{0}.csv'.format(number)}
+                   for number in range(20)])
+
+    def render():
+        return app.get(u'/dataset/{0}/resource/new'.format(dataset[u'id']),
+                       extra_environ={u'REMOTE_USER': str(sysadmin[u'name'])})
+
+    response = benchmark.pedantic(render, rounds=20)
+    assert response.status_code == 200
+    reset_metadata_caches()
@@ -1,9 +1,10 @@
 # encoding: utf-8
 import pytest
+from moto import mock_aws
 
 import ckan.tests.factories as factories
 
-from ckanext.s3filestore.uploader import BaseS3Uploader
+from ckanext.s3filestore.uploader import BaseS3Uploader, reset_clients
 
 
 @pytest.fixture
@@ -24,6 +25,18 @@ def s3_client(ckan_config, s3_session):
     return base_uploader.get_s3_client()
 
 
+@pytest.fixture
+def s3_mock(ckan_config, monkeypatch):
+    '''Replace the configured S3 service by moto's in-process mock, with the
+    configured bucket already created.'''
+    monkeypatch.setitem(ckan_config, u'ckanext.s3filestore.host_name', None)
+    with mock_aws():
+        BaseS3Uploader().get_s3_client().create_bucket(
+            Bucket=ckan_config[u'ckanext.s3filestore.aws_bucket_name'])
+        yield
+    reset_clients()
+
+
 @pytest.fixture
 def resource_with_upload(create_with_upload):
     content = u"""
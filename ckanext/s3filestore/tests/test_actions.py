@@ -0,0 +1,304 @@
+# encoding: utf-8
+import hashlib
+
+import pytest
+
+from ckantoolkit import config
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.logic import NotFound, ValidationError
+
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestGetSignedUrls(object):
+
+    def test_batch_of_signed_urls(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        result = helpers.call_action(
+            u'get_signed_urls', context,
+            package_id=dataset[u'id'],
+            files=[u'a.csv', {u'filename': u'b.json',
+                              u'content_type': u'application/json'}])
+
+        assert [r[u'filename'] for r in result] == [u'a.csv', u'b.json']
+        assert len(set(r[u'resource_id'] for r in result)) == 2
+        for r in result:
+            assert u'resources/{0}/{1}'.format(
+                r[u'resource_id'], r[u'filename']) in r[u'signed_url']
+        # The content type is part of the signature
+        assert u'content-type' in result[1][u'signed_url']
+
+    def test_invalid_filename(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'get_signed_urls', context,
+                                package_id=dataset[u'id'],
+                                files=[u'a.csv', u'../b.csv'])
+
+    def test_filename_not_a_string(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'get_signed_urls', context,
+                                package_id=dataset[u'id'],
+                                files=[u'a.csv', {u'filename': [u'b.csv']}])
+
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.max_signed_urls_per_request', u'2')
+    def test_batch_size_limit(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'get_signed_urls', context,
+                                package_id=dataset[u'id'],
+                                files=[u'a.csv', u'b.csv', u'c.csv'])
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestGetDownloadUrls(object):
+
+    def test_download_urls_of_uploaded_resources(self, resource_with_upload):
+        factories.Resource(package_id=resource_with_upload[u'package_id'],
+                           url=u'http://example.com/data.csv')
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        result = helpers.call_action(
+            u'get_download_urls', context,
+            ids=[resource_with_upload[u'package_id'], u'not-a-dataset'])
+
+        assert len(result) == 2
+        resources = result[0][u'resources']
+        assert len(resources) == 1
+        assert resources[0][u'id'] == resource_with_upload[u'id']
+        assert u'resources/{0}/{1}'.format(
+            resources[0][u'id'], resources[0][u'filename']) \
+            in resources[0][u'url']
+        assert u'response-content-disposition' in resources[0][u'url']
+        assert result[1] == {u'id': u'not-a-dataset',
+                             u'error': u'Package not found'}
+
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.max_download_url_packages', u'1')
+    def test_package_limit(self):
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'get_download_urls', context,
+                                ids=[u'a', u'b'])
+
+    def test_ids_not_a_list(self):
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'get_download_urls', context, ids=1)
+
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.key_partition_levels', u'2')
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.legacy_key_fallback', u'false')
+    def test_no_head_requests(self, resource_with_upload, monkeypatch):
+        def key_exists(self, key):
+            raise AssertionError(u'HEAD request for ' + key)
+        monkeypatch.setattr(BaseS3Uploader, u'key_exists', key_exists)
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        [result] = helpers.call_action(
+            u'get_download_urls', context,
+            id=resource_with_upload[u'package_id'])
+
+        assert u'/{0}/test.csv'.format(resource_with_upload[u'id']) in \
+            result[u'resources'][0][u'url']
+
+    @pytest.mark.parametrize(u'expires_in', [u'soon', [60], {}, -60, 0])
+    def test_invalid_expiry(self, resource_with_upload, expires_in):
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'get_download_urls', context,
+                                id=resource_with_upload[u'package_id'],
+                                expires_in=expires_in)
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestCopy(object):
+
+    def _bucket(self):
+        return config.get(u'ckanext.s3filestore.aws_bucket_name')
+
+    def _key(self, resource):
+        return u'resources/{0}/test.csv'.format(resource[u'id'])
+
+    def test_copy_resource(self, s3_client, resource_with_upload):
+        target = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        copy = helpers.call_action(u'copy_resource', context,
+                                   id=resource_with_upload[u'id'],
+                                   package_id=target[u'id'])
+
+        assert copy[u'id'] != resource_with_upload[u'id']
+        assert copy[u'package_id'] == target[u'id']
+        assert copy[u'url_type'] == u'upload'
+        assert copy[u'url'].endswith(u'/download/test.csv')
+        assert s3_client.head_object(Bucket=self._bucket(),
+                                     Key=self._key(copy))
+
+    def test_copy_drops_object_fields(self, resource_with_upload):
+        helpers.call_action(u'resource_patch', id=resource_with_upload[u'id'],
+                            s3_etag=u'abc', s3_upload_status=u'complete')
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        copy = helpers.call_action(u'copy_resource', context,
+                                   id=resource_with_upload[u'id'],
+                                   package_id=factories.Dataset()[u'id'])
+
+        assert u's3_etag' not in copy
+        assert u's3_upload_status' not in copy
+
+    def test_clone_package(self, s3_client, resource_with_upload):
+        factories.Resource(package_id=resource_with_upload[u'package_id'],
+                           url=u'http://example.com/data.csv')
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        clone = helpers.call_action(
+            u'clone_package', context,
+            id=resource_with_upload[u'package_id'], name=u'cloned-dataset')
+
+        assert clone[u'name'] == u'cloned-dataset'
+        assert [r[u'url_type'] for r in clone[u'resources']] == \
+            [u'upload', u'']
+        assert clone[u'resources'][1][u'url'] == u'http://example.com/data.csv'
+        assert s3_client.head_object(Bucket=self._bucket(),
+                                     Key=self._key(clone[u'resources'][0]))
+
+    @pytest.mark.ckan_config(u'ckanext.s3filestore.targets', u'remote')
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.target.remote.packages', u'remote-dataset')
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.target.remote.bucket_name', u'remote-bucket')
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.target.remote.aws_access_key_id',
+        u'remote-access-key')
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.target.remote.aws_secret_access_key',
+        u'remote-secret-key')
+    def test_copy_to_target_with_other_credentials(
+            self, s3_mock, resource_with_upload, monkeypatch):
+        remote = BaseS3Uploader(target=u'remote')
+        remote.get_s3_client().create_bucket(Bucket=u'remote-bucket')
+        target = factories.Dataset(name=u'remote-dataset')
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        def copy_key(*args, **kwargs):
+            raise AssertionError(u'Copied server-side')
+        monkeypatch.setattr(BaseS3Uploader, u'copy_key', copy_key)
+
+        copy = helpers.call_action(u'copy_resource', context,
+                                   id=resource_with_upload[u'id'],
+                                   package_id=target[u'id'])
+
+        assert remote.get_s3_client().head_object(Bucket=u'remote-bucket',
+                                                  Key=self._key(copy))
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestFinalizeUpload(object):
+
+    def test_finalize_upload(self, s3_client):
+        context = {u'user': factories.Sysadmin()[u'name']}
+        resource = helpers.call_action(
+            u'resource_create', context,
+            package_id=factories.Dataset()[u'id'],
+            url=u'data.json', url_type=u'upload')
+        # The file is uploaded directly to S3, e.g. with a signed URL
+        s3_client.put_object(
+            Bucket=config.get(u'ckanext.s3filestore.aws_bucket_name'),
+            Key=u'resources/{0}/data.json'.format(resource[u'id']),
+            Body=b'{"a": 1}', ContentType=u'application/json')
+
+        result = helpers.call_action(u'finalize_upload', context,
+                                     id=resource[u'id'])
+
+        assert result[u'size'] == 8
+        assert result[u'mimetype'] == u'application/json'
+        assert result[u'hash'] == \
+            u'md5:' + hashlib.md5(b'{"a": 1}').hexdigest()
+        assert result[u's3_etag'] == hashlib.md5(b'{"a": 1}').hexdigest()
+
+    def test_finalize_missing_upload(self):
+        context = {u'user': factories.Sysadmin()[u'name']}
+        resource = helpers.call_action(
+            u'resource_create', context,
+            package_id=factories.Dataset()[u'id'],
+            url=u'missing.json', url_type=u'upload')
+
+        with pytest.raises(NotFound):
+            helpers.call_action(u'finalize_upload', context,
+                                id=resource[u'id'])
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.ckan_config(u'ckan.max_resource_size', u'10')
+class TestSizeLimits(object):
+
+    def test_signed_url_with_size(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        result = helpers.call_action(u'get_signed_url', context,
+                                     package_id=dataset[u'id'],
+                                     filename=u'a.csv', size=1024)
+
+        # The size is part of the signature
+        assert u'content-length' in result[u'signed_url']
+
+    def test_signed_url_too_large(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'get_signed_url', context,
+                                package_id=dataset[u'id'],
+                                filename=u'a.csv', size=11 * 1024 * 1024)
+
+    def test_multipart_upload_too_large(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'create-multipart-upload', context,
+                                package_id=dataset[u'id'], name=u'a.bin',
+                                size=11 * 1024 * 1024)
+
+    def test_part_number_over_limit(self):
+        dataset = factories.Dataset()
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        # 10 MB fit in two 5 MB parts and a last one
+        helpers.call_action(u'sign-part', context,
+                            package_id=dataset[u'id'], uploadId=u'upload',
+                            key=u'resources/a/a.bin', partNumber=3)
+        with pytest.raises(ValidationError):
+            helpers.call_action(u'sign-part', context,
+                                package_id=dataset[u'id'],
+                                uploadId=u'upload',
+                                key=u'resources/a/a.bin', partNumber=4)
+
+    @pytest.mark.ckan_config(u'ckan.max_resource_size', u'1')
+    def test_resource_upload_too_large(self, s3_client, create_with_upload):
+        dataset = factories.Dataset()
+
+        with pytest.raises(ValidationError):
+            create_with_upload(b'0' * (1024 * 1024 + 1), u'big.bin',
+                               package_id=dataset[u'id'])
+
+        assert not helpers.call_action(
+            u'package_show', id=dataset[u'id'])[u'resources']
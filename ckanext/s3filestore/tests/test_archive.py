@@ -0,0 +1,78 @@
+# encoding: utf-8
+import io
+import zipfile
+
+import pytest
+
+from ckanext.s3filestore import archive
+
+
+RESOURCES = [
+    {u'id': u'r1', u'url': u'http://ckan/download/a.csv',
+     u'url_type': u'upload', u'created': u'2021-03-04T05:06:07.890'},
+    {u'id': u'r2', u'url': u'http://example.com/b.csv', u'url_type': u''},
+    {u'id': u'r3', u'url': u'http://ckan/download/a.csv',
+     u'url_type': u'upload'},
+    {u'id': u'r4', u'url': u'http://ckan/download/c.bin',
+     u'url_type': u'upload'},
+]
+
+DATA = {u'r1': b'a' * 100000, u'r3': b'duplicate', u'r4': b''}
+
+
+class FakeBody(io.BytesIO):
+    closed_count = 0
+
+    def close(self):
+        FakeBody.closed_count += 1
+        super(FakeBody, self).close()
+
+
+def open_entry(resource):
+    data = DATA[resource[u'id']]
+    return len(data), FakeBody(data)
+
+
+class TestArchive(object):
+
+    def test_entries_are_stable_and_unique(self):
+        entries = archive.archive_entries(RESOURCES)
+
+        assert [name for _res, name in entries] == \
+            [u'a.csv', u'a-r3.csv', u'c.bin']
+
+    def test_skip_entries(self):
+        entries = archive.archive_entries(RESOURCES)
+
+        assert [res[u'id'] for res, _name in
+                archive.skip_entries(entries, u'r1')] == [u'r3', u'r4']
+        with pytest.raises(ValueError):
+            archive.skip_entries(entries, u'r2')
+
+    def test_stream_zip(self):
+        entries = archive.archive_entries(RESOURCES)
+
+        chunks = list(archive.stream_zip(entries, open_entry,
+                                         chunk_size=4096))
+
+        # The data is handed out as it is read, not all at once
+        assert len(chunks) > 20
+        result = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        assert result.testzip() is None
+        assert result.read(u'a.csv') == DATA[u'r1']
+        assert result.read(u'a-r3.csv') == DATA[u'r3']
+        assert result.read(u'c.bin') == b''
+        info = result.getinfo(u'a.csv')
+        assert info.compress_type == zipfile.ZIP_STORED
+        assert info.date_time == (2021, 3, 4, 5, 6, 6)
+
+    def test_interrupted_stream_releases_objects(self):
+        FakeBody.closed_count = 0
+        entries = archive.archive_entries(RESOURCES)
+        stream = archive.stream_zip(entries, open_entry, chunk_size=4096)
+
+        next(stream)
+        stream.close()
+
+        # The current object and the prefetched one
+        assert FakeBody.closed_count == 2
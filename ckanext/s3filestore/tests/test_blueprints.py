@@ -1,4 +1,8 @@
 # encoding: utf-8
+import io
+import hashlib
+import zipfile
+
 import six
 import requests
 
@@ -6,6 +10,7 @@ import pytest
 
 from ckantoolkit import config
 import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
 from ckan.lib.helpers import url_for
 
 
@@ -122,3 +127,129 @@ class TestS3Controller(object):
         assert response.location
         image = requests.get(response.location)
         assert image.content == b"\0\0\0"
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestDatasetZipDownload(object):
+
+    def test_dataset_zip_download(self, app, resource_with_upload):
+        user = factories.Sysadmin()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+
+        response = app.get(
+            url_for(u's3_dataset.dataset_zip_download',
+                    id=resource_with_upload[u'package_id']),
+            extra_environ=env)
+
+        assert 200 == response.status_code
+        assert response.headers[u'Content-Type'] == u'application/zip'
+        archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+        assert archive.namelist() == [u'test.csv']
+        assert b'SKINS LAKE' in archive.read(u'test.csv')
+
+    def test_dataset_zip_download_resume(self, app, resource_with_upload):
+        user = factories.Sysadmin()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+
+        response = app.get(
+            url_for(u's3_dataset.dataset_zip_download',
+                    id=resource_with_upload[u'package_id'],
+                    after=resource_with_upload[u'id']),
+            extra_environ=env)
+
+        assert 200 == response.status_code
+        archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+        assert archive.namelist() == []
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestStreamUpload(object):
+
+    def test_stream_upload_creates_resource(self, app, s3_mock, s3_client):
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+        data = b'a,b\n' + b'1,2\n' * 1000
+
+        response = app.put(
+            u'/dataset/{0}/resource/upload/data.csv'.format(dataset[u'id']),
+            data=data, headers={u'Content-Type': u'text/csv'},
+            extra_environ=env)
+
+        assert response.status_code == 200
+        resource = response.json[u'result']
+        assert resource[u'size'] == len(data)
+        assert resource[u'hash'] == \
+            u'sha256:' + hashlib.sha256(data).hexdigest()
+        assert resource[u'mimetype'] == u'text/csv'
+        body = s3_client.get_object(
+            Bucket=config.get(u'ckanext.s3filestore.aws_bucket_name'),
+            Key=u'resources/{0}/data.csv'.format(resource[u'id']))[u'Body']
+        assert body.read() == data
+
+    def test_stream_upload_replaces_variant(self, app, s3_mock, s3_client):
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+        bucket = config.get(u'ckanext.s3filestore.aws_bucket_name')
+        resource = app.put(
+            u'/dataset/{0}/resource/upload/data.csv'.format(dataset[u'id']),
+            data=b'a,b\n', extra_environ=env).json[u'result']
+        key = u'resources/{0}/data.csv'.format(resource[u'id'])
+        # As if uploaded with a gzip variant
+        s3_client.put_object(Bucket=bucket, Key=key + u'.gz', Body=b'old')
+        helpers.call_action(u'resource_patch', id=resource[u'id'],
+                            s3_compression=u'gzip')
+
+        response = app.put(
+            u'/dataset/{0}/resource/{1}/upload/data.csv'.format(
+                dataset[u'id'], resource[u'id']),
+            data=b'c,d\n', extra_environ=env)
+
+        assert response.json[u'result'][u's3_compression'] == u''
+        assert not s3_client.list_objects_v2(
+            Bucket=bucket, Prefix=key + u'.gz').get(u'Contents')
+
+    @pytest.mark.ckan_config(u'ckan.max_resource_size', u'1')
+    def test_stream_upload_too_large(self, app, s3_mock):
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+
+        response = app.put(
+            u'/dataset/{0}/resource/upload/data.bin'.format(dataset[u'id']),
+            data=b'0' * (1024 * 1024 + 1), extra_environ=env)
+
+        assert response.status_code == 413
+
+    def test_stream_upload_unauthorized(self, app, s3_mock):
+        dataset = factories.Dataset()
+        env = {u'REMOTE_USER': six.ensure_str(factories.User()[u'name'])}
+
+        response = app.put(
+            u'/dataset/{0}/resource/upload/data.csv'.format(dataset[u'id']),
+            data=b'a,b\n', extra_environ=env)
+
+        assert response.status_code == 403
+
+    def test_stream_upload_removed_on_error(self, app, s3_mock, s3_client,
+                                            monkeypatch):
+        from ckanext.s3filestore.views import resource as resource_view
+        get_action = resource_view.get_action
+
+        def failing_get_action(name):
+            if name == u'resource_create':
+                raise RuntimeError(u'database gone')
+            return get_action(name)
+        monkeypatch.setattr(resource_view, u'get_action', failing_get_action)
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+
+        with pytest.raises(RuntimeError):
+            app.put(u'/dataset/{0}/resource/upload/data.csv'.format(
+                dataset[u'id']), data=b'a,b\n', extra_environ=env)
+
+        assert not s3_client.list_objects_v2(
+            Bucket=config.get(u'ckanext.s3filestore.aws_bucket_name'),
+            Prefix=u'resources/').get(u'Contents')
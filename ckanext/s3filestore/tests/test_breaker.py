@@ -0,0 +1,104 @@
+# encoding: utf-8
+import time
+
+import six
+import pytest
+
+import ckan.tests.factories as factories
+from ckan.lib.helpers import url_for
+
+from ckanext.s3filestore import breaker
+from ckanext.s3filestore.uploader import BaseS3Uploader, reset_clients
+
+
+@pytest.fixture
+def reset_breakers():
+    # Pooled clients keep a reference to the breaker they report to
+    breaker.reset()
+    reset_clients()
+    yield
+    breaker.reset()
+    reset_clients()
+
+
+class TestCircuitBreaker(object):
+
+    def test_opens_when_failure_rate_crossed(self):
+        circuit = breaker.CircuitBreaker(u'test', failure_rate=0.5,
+                                         min_calls=4)
+        for failed in (False, True, False):
+            circuit.record(failed)
+        assert circuit.state == breaker.CLOSED
+
+        circuit.record(True)
+
+        assert circuit.state == breaker.OPEN
+        assert not circuit.allow()
+
+    def test_probe_closes_breaker(self):
+        circuit = breaker.CircuitBreaker(u'test', min_calls=1,
+                                         reset_timeout=0.01)
+        circuit.record(True)
+        assert not circuit.allow()
+
+        time.sleep(0.02)
+
+        assert circuit.allow()
+        # Only one probe at a time
+        assert not circuit.allow()
+        circuit.record(False)
+        assert circuit.state == breaker.CLOSED
+
+    def test_failed_probe_reopens_breaker(self):
+        circuit = breaker.CircuitBreaker(u'test', min_calls=1,
+                                         reset_timeout=0.01)
+        circuit.record(True)
+        time.sleep(0.02)
+        assert circuit.allow()
+
+        circuit.record(True)
+
+        assert circuit.state == breaker.OPEN
+        assert not circuit.allow()
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index', u'reset_breakers')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.circuit_breaker', u'true')
+class TestCircuitBreakerDownloads(object):
+
+    def _download(self, app, resource):
+        user = factories.Sysadmin()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+        return app.get(
+            url_for(
+                u'dataset_resource.download',
+                id=resource[u'package_id'],
+                resource_id=resource[u'id'],
+            ),
+            extra_environ=env,
+            follow_redirects=False
+        )
+
+    def _open_breaker(self):
+        circuit = BaseS3Uploader().get_breaker()
+        for _ in range(circuit.min_calls):
+            circuit.record(True)
+        assert circuit.state == breaker.OPEN
+
+    def test_download_fails_fast_while_open(self, app, resource_with_upload):
+        self._open_breaker()
+
+        response = self._download(app, resource_with_upload)
+
+        assert 503 == response.status_code
+
+    def test_download_reuses_signed_url_while_open(self, app,
+                                                   resource_with_upload):
+        first = self._download(app, resource_with_upload)
+        assert 302 == first.status_code
+        self._open_breaker()
+
+        response = self._download(app, resource_with_upload)
+
+        assert 302 == response.status_code
+        assert response.location == first.location
@@ -0,0 +1,150 @@
+# encoding: utf-8
+import io
+import time
+
+import fakeredis
+import pytest
+import redis
+from botocore.exceptions import ClientError
+
+from ckanext.s3filestore import cache
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+KEY = u'resources/cached/data.csv'
+
+
+@pytest.fixture(params=[u'memory', u'redis'])
+def backend(request):
+    if request.param == u'memory':
+        return cache.MemoryBackend(u'test')
+    return cache.RedisBackend(u'test', client=fakeredis.FakeStrictRedis())
+
+
+@pytest.fixture
+def metadata_cache(ckan_config, monkeypatch, s3_mock):
+    '''Enable the metadata cache in a fake Redis, and count the HEAD requests
+    sent to S3.'''
+    monkeypatch.setitem(ckan_config, u'ckanext.s3filestore.metadata_cache',
+                        u'redis')
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(u'ckan.lib.redis.connect_to_redis',
+                        lambda: fakeredis.FakeStrictRedis(server=server))
+    cache.reset_metadata_caches()
+    heads = []
+    upload = BaseS3Uploader()
+    for read_only in (True, False):
+        upload.get_s3_client(read_only=read_only).meta.events.register(
+            u'before-parameter-build.s3.HeadObject',
+            lambda **kwargs: heads.append(kwargs[u'params'][u'Key']))
+    upload.upload_to_key(KEY, io.BytesIO(b'a,b\n1,2\n'))
+    yield heads
+    cache.reset_metadata_caches()
+
+
+class TestBackends(object):
+
+    def test_get_set_delete(self, backend):
+        backend.set(u'a', {u'size': 1}, ttl=60)
+        backend.set(u'b', u'url', ttl=60)
+
+        assert backend.get(u'a') == {u'size': 1}
+        backend.delete(u'a', u'b')
+        assert backend.get(u'a') is None
+        assert backend.get(u'b') is None
+
+    def test_expiry(self, backend):
+        backend.set(u'a', 1, ttl=0.01)
+        time.sleep(0.05)
+
+        assert backend.get(u'a') is None
+
+    def test_redis_errors_are_misses(self, monkeypatch):
+        client = fakeredis.FakeStrictRedis()
+        backend = cache.RedisBackend(u'test', client=client)
+
+        def fail(*args, **kwargs):
+            raise redis.ConnectionError(u'down')
+        for method in (u'get', u'set', u'delete'):
+            monkeypatch.setattr(client, method, fail)
+
+        backend.set(u'a', 1, ttl=60)
+        assert backend.get(u'a') is None
+        backend.delete(u'a')
+
+    def test_custom_backend(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, u'ckanext.s3filestore.metadata_cache',
+                            u'ckanext.s3filestore.cache:MemoryBackend')
+        cache.reset_metadata_caches()
+
+        assert isinstance(cache.get_metadata_cache(), cache.MemoryBackend)
+        cache.reset_metadata_caches()
+
+
+class TestMetadataCache(object):
+
+    def test_head_object_cached(self, metadata_cache):
+        upload = BaseS3Uploader()
+
+        assert upload.head_object(KEY)[u'size'] == 8
+        assert upload.head_object(KEY)[u'size'] == 8
+        assert metadata_cache == [KEY]
+
+    def test_shared_between_processes(self, metadata_cache):
+        BaseS3Uploader().head_object(KEY)
+        # Another worker process has its own backend on the same Redis
+        cache.reset_metadata_caches()
+
+        assert BaseS3Uploader().key_exists(KEY)
+        assert metadata_cache == [KEY]
+
+    def test_signed_url_reused(self, metadata_cache):
+        upload = BaseS3Uploader()
+
+        url = upload.get_signed_url_to_key(KEY)
+
+        assert upload.get_signed_url_to_key(KEY) == url
+        assert upload.get_signed_url_to_key(
+            KEY, {u'ResponseContentDisposition': u'attachment'}) != url
+        assert metadata_cache == [KEY]
+
+    def test_invalidated_on_upload(self, metadata_cache):
+        upload = BaseS3Uploader()
+        upload.get_signed_url_to_key(KEY)
+
+        upload.upload_to_key(KEY, io.BytesIO(b'a,b\n1,2\n3,4\n'))
+
+        assert upload.head_object(KEY)[u'size'] == 12
+        assert upload.get_signed_url_to_key(KEY)
+        assert metadata_cache == [KEY, KEY]
+
+    def test_invalidated_on_clear(self, metadata_cache):
+        upload = BaseS3Uploader()
+        upload.get_signed_url_to_key(KEY)
+
+        upload.clear_key(KEY)
+
+        assert not upload.key_exists(KEY)
+        with pytest.raises(ClientError):
+            upload.get_signed_url_to_key(KEY)
+
+    def test_invalidated_on_multipart_completion(self, metadata_cache,
+                                                 s3_client):
+        upload = BaseS3Uploader()
+        upload.head_object(KEY)
+        upload_id = upload.create_multipart_upload(KEY)[u'UploadId']
+        etag = s3_client.upload_part(
+            Bucket=upload.bucket_name, Key=KEY, UploadId=upload_id,
+            PartNumber=1, Body=b'x' * 10)[u'ETag']
+
+        upload.complete_multipart_upload(
+            KEY, upload_id, [{u'PartNumber': 1, u'ETag': etag}])
+
+        assert upload.head_object(KEY)[u'size'] == 10
+
+    def test_missing_objects_not_cached(self, metadata_cache):
+        upload = BaseS3Uploader()
+
+        assert not upload.key_exists(u'missing.csv')
+        assert not upload.key_exists(u'missing.csv')
+        assert metadata_cache.count(u'missing.csv') == 2
@@ -0,0 +1,79 @@
+# encoding: utf-8
+import io
+import gzip
+
+import six
+import pytest
+
+import ckan.tests.factories as factories
+from ckan.lib.helpers import url_for
+
+from ckanext.s3filestore import compression
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+class TestCompression(object):
+
+    @pytest.mark.parametrize(u'header,expected', [
+        (u'gzip, deflate, br', True),
+        (u'deflate;q=1.0, gzip;q=0.5', True),
+        (u'gzip;q=0', False),
+        (u'*', True),
+        (u'*, gzip;q=0', False),
+        (u'identity', False),
+        (None, False),
+    ])
+    def test_accepts(self, header, expected):
+        assert compression.accepts(header, u'gzip') is expected
+
+    def test_should_compress(self):
+        assert compression.should_compress(u'text/csv')
+        assert compression.should_compress(u'application/json; charset=utf-8')
+        assert not compression.should_compress(u'application/zip')
+        assert not compression.should_compress(None)
+
+    def test_compress(self):
+        data = b'a,b\n' + b'1,2\n' * 100000
+
+        compressed = compression.compress(io.BytesIO(data), u'gzip')
+
+        assert gzip.decompress(compressed.read()) == data
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.compression', u'gzip')
+class TestCompressedUploads(object):
+
+    def _download(self, app, resource, accept_encoding=None):
+        user = factories.Sysadmin()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+        headers = {}
+        if accept_encoding:
+            headers[u'Accept-Encoding'] = accept_encoding
+        return app.get(
+            url_for(u'dataset_resource.download',
+                    id=resource[u'package_id'],
+                    resource_id=resource[u'id']),
+            extra_environ=env, headers=headers, follow_redirects=False)
+
+    def test_upload_stores_compressed_variant(self, s3_client,
+                                              resource_with_upload):
+        bucket = BaseS3Uploader().bucket_name
+        key = u'resources/{0}/test.csv'.format(resource_with_upload[u'id'])
+
+        variant = s3_client.get_object(Bucket=bucket, Key=key + u'.gz')
+        original = s3_client.get_object(Bucket=bucket, Key=key)
+
+        assert resource_with_upload[u's3_compression'] == u'gzip'
+        assert variant[u'ContentEncoding'] == u'gzip'
+        assert gzip.decompress(variant[u'Body'].read()) == \
+            original[u'Body'].read()
+
+    def test_download_negotiates_encoding(self, app, resource_with_upload):
+        compressed = self._download(app, resource_with_upload, u'gzip')
+        identity = self._download(app, resource_with_upload)
+
+        assert u'test.csv.gz' in compressed.location
+        assert u'test.csv.gz' not in identity.location
+        assert compressed.headers[u'Vary'] == u'Accept-Encoding'
+        assert identity.headers[u'Vary'] == u'Accept-Encoding'
@@ -0,0 +1,99 @@
+# encoding: utf-8
+import json
+import datetime
+import threading
+
+import pytest
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from ckanext.s3filestore import credentials
+from ckanext.s3filestore.uploader import BaseS3Uploader, reset_clients
+
+
+class FakeMetadataHandler(BaseHTTPRequestHandler):
+    '''Serves role credentials like the EC2 instance metadata service,
+    returning new credentials on each request.'''
+
+    fetches = 0
+
+    def do_PUT(self):
+        # IMDSv2 session token
+        self._respond(b'fake-imds-token')
+
+    def do_GET(self):
+        if self.path.endswith(u'/security-credentials/'):
+            return self._respond(b'test-role')
+        FakeMetadataHandler.fetches += 1
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self._respond(json.dumps({
+            u'Code': u'Success',
+            u'AccessKeyId': u'ROLEKEY{0}'.format(FakeMetadataHandler.fetches),
+            u'SecretAccessKey': u'role-secret',
+            u'Token': u'role-token',
+            u'Expiration': expiration.strftime(u'%Y-%m-%dT%H:%M:%SZ'),
+        }).encode(u'utf-8'))
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def metadata_endpoint():
+    FakeMetadataHandler.fetches = 0
+    server = HTTPServer((u'127.0.0.1', 0), FakeMetadataHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield u'http://127.0.0.1:{0}/'.format(server.server_port)
+    server.shutdown()
+    credentials.reset()
+    reset_clients()
+
+
+def test_role_credentials_fetched_once(metadata_endpoint):
+    cache = credentials.RoleCredentialsCache(metadata_url=metadata_endpoint)
+
+    first = cache.get_credentials().get_frozen_credentials()
+    second = cache.get_credentials().get_frozen_credentials()
+
+    assert first.access_key == second.access_key == u'ROLEKEY1'
+    assert FakeMetadataHandler.fetches == 1
+    cache.stop()
+
+
+def test_role_credentials_refresh(metadata_endpoint):
+    cache = credentials.RoleCredentialsCache(metadata_url=metadata_endpoint)
+    assert cache.get_metadata()[u'access_key'] == u'ROLEKEY1'
+
+    cache.refresh()
+
+    assert cache.get_metadata()[u'access_key'] == u'ROLEKEY2'
+    assert FakeMetadataHandler.fetches == 2
+    cache.stop()
+
+
+@pytest.mark.ckan_config(u'ckanext.s3filestore.aws_use_ami_role', u'true')
+def test_uploaders_share_role_credentials(ckan_config, monkeypatch,
+                                          metadata_endpoint):
+    monkeypatch.setitem(ckan_config,
+                        u'ckanext.s3filestore.aws_access_key_id', None)
+    monkeypatch.setitem(ckan_config,
+                        u'ckanext.s3filestore.aws_secret_access_key', None)
+    monkeypatch.setitem(ckan_config,
+                        u'ckanext.s3filestore.metadata_endpoint',
+                        metadata_endpoint)
+    reset_clients()
+
+    for _ in range(3):
+        session = BaseS3Uploader().get_s3_session()
+        frozen = session.get_credentials().get_frozen_credentials()
+        assert frozen.access_key == u'ROLEKEY1'
+        assert BaseS3Uploader().get_s3_client() is \
+            BaseS3Uploader().get_s3_client()
+
+    assert FakeMetadataHandler.fetches == 1
@@ -0,0 +1,153 @@
+# encoding: utf-8
+import pytest
+
+import ckan.model as model
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore import helpers as s3_helpers
+from ckanext.s3filestore.cache import reset_metadata_caches
+
+
+class _C(object):
+    def __init__(self, userobj):
+        self.userobj = userobj
+
+
+@pytest.fixture
+def signed_in(monkeypatch):
+    '''Sign in a user without a legacy API key.'''
+    user = factories.User()
+    userobj = model.User.get(user[u'id'])
+    userobj.apikey = None
+    monkeypatch.setattr(s3_helpers.toolkit, u'c', _C(userobj))
+    reset_metadata_caches()
+    yield user
+    reset_metadata_caches()
+
+
+def _frontend_tokens(user):
+    return [token for token in helpers.call_action(
+        u'api_token_list', user_id=user[u'name'])
+        if token[u'name'] == s3_helpers.FRONTEND_TOKEN_NAME]
+
+
+@pytest.mark.usefixtures(u'clean_db')
+class TestUserApiKey(object):
+
+    def test_token_reused(self, signed_in):
+        token = s3_helpers.get_or_create_user_api_key_safe()
+
+        assert token
+        assert s3_helpers.get_or_create_user_api_key_safe() == token
+        assert len(_frontend_tokens(signed_in)) == 1
+
+    def test_token_minted_once_expired(self, signed_in, monkeypatch):
+        token = s3_helpers.get_or_create_user_api_key_safe()
+        monkeypatch.setitem(s3_helpers.toolkit.config,
+                            u'ckanext.s3filestore.frontend_token_ttl', u'0')
+        reset_metadata_caches()
+
+        assert s3_helpers.get_or_create_user_api_key_safe() != token
+        # The expired token is revoked, not the new one
+        assert len(_frontend_tokens(signed_in)) == 1
+
+    def test_other_tokens_kept(self, signed_in):
+        token = s3_helpers.get_or_create_user_api_key_safe()
+        # e.g. minted by another worker process
+        reset_metadata_caches()
+
+        assert s3_helpers.get_or_create_user_api_key_safe() != token
+        assert len(_frontend_tokens(signed_in)) == 2
+
+    def test_revoked_token_replaced(self, signed_in):
+        token = s3_helpers.get_or_create_user_api_key_safe()
+        [revoked] = _frontend_tokens(signed_in)
+        helpers.call_action(u'api_token_revoke', jti=revoked[u'id'])
+
+        assert s3_helpers.get_or_create_user_api_key_safe() != token
+        assert len(_frontend_tokens(signed_in)) == 1
+
+    def test_not_signed_in(self, monkeypatch):
+        monkeypatch.setattr(s3_helpers.toolkit, u'c', _C(None))
+
+        assert s3_helpers.get_or_create_user_api_key_safe() is None
+
+
+@pytest.fixture
+def package_shows(monkeypatch):
+    '''Count the package_show calls of the helpers.'''
+    calls = []
+    get_action = s3_helpers.toolkit.get_action
+
+    def counting_get_action(name):
+        action = get_action(name)
+        if name != u'package_show':
+            return action
+
+        def package_show(context, data_dict):
+            calls.append(data_dict[u'id'])
+            return action(context, data_dict)
+        return package_show
+    monkeypatch.setattr(s3_helpers.toolkit, u'get_action',
+                        counting_get_action)
+    reset_metadata_caches()
+    yield calls
+    reset_metadata_caches()
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestGetPackageByName(object):
+
+    def test_memoized_per_request(self, app, package_shows):
+        dataset = factories.Dataset()
+
+        with app.flask_app.test_request_context():
+            for _ in range(3):
+                assert s3_helpers.get_package_by_name(
+                    dataset[u'name'])[u'id'] == dataset[u'id']
+        with app.flask_app.test_request_context():
+            s3_helpers.get_package_by_name(dataset[u'name'])
+
+        assert len(package_shows) == 2
+
+    @pytest.mark.ckan_config(u'ckanext.s3filestore.helper_cache_ttl', u'60')
+    def test_shared_across_requests(self, app, package_shows):
+        dataset = factories.Dataset()
+
+        for _ in range(2):
+            with app.flask_app.test_request_context():
+                s3_helpers.get_package_by_name(dataset[u'name'])
+
+        assert len(package_shows) == 1
+
+    @pytest.mark.ckan_config(u'ckanext.s3filestore.helper_cache_ttl', u'60')
+    def test_invalidated_on_update(self, app, package_shows):
+        dataset = factories.Dataset()
+        with app.flask_app.test_request_context():
+            s3_helpers.get_package_by_name(dataset[u'name'])
+
+        helpers.call_action(u'package_patch', id=dataset[u'id'],
+                            title=u'New title')
+
+        with app.flask_app.test_request_context():
+            assert s3_helpers.get_package_by_name(
+                dataset[u'name'])[u'title'] == u'New title'
+        assert len(package_shows) == 2
+
+    @pytest.mark.ckan_config(u'ckanext.s3filestore.helper_cache_ttl', u'60')
+    def test_other_packages_kept(self, app, package_shows):
+        dataset = factories.Dataset()
+        other = factories.Dataset()
+        with app.flask_app.test_request_context():
+            s3_helpers.get_package_by_name(dataset[u'name'])
+            s3_helpers.get_package_by_name(other[u'name'])
+
+        helpers.call_action(u'package_patch', id=dataset[u'id'],
+                            title=u'New title')
+
+        with app.flask_app.test_request_context():
+            s3_helpers.get_package_by_name(dataset[u'name'])
+            s3_helpers.get_package_by_name(other[u'name'])
+        assert package_shows == [dataset[u'name'], other[u'name'],
+                                 dataset[u'name']]
@@ -0,0 +1,53 @@
+# encoding: utf-8
+'''Keep loading the plugin cheap for the CKAN commands and workers which
+don't touch S3, see the comment at the top of plugin.py.'''
+import sys
+import subprocess
+
+
+# Cumulative import time of the plugin module, CKAN itself being loaded first
+PLUGIN_IMPORT_BUDGET = 0.2  # seconds
+
+# Only loaded on the first S3 request or mimetype sniffing
+HEAVY_MODULES = [u'boto3', u'botocore.session', u'botocore.client', u'magic']
+
+CKAN_IMPORTS = u'import ckan.plugins, ckantoolkit, ckan.types, flask'
+
+
+def _run(code, *options):
+    return subprocess.run([sys.executable] + list(options) + [u'-c', code],
+                          check=True, capture_output=True,
+                          universal_newlines=True)
+
+
+class TestImportTime(object):
+
+    def test_plugin_import_budget(self):
+        result = _run(CKAN_IMPORTS + u'; import ckanext.s3filestore.plugin',
+                      u'-X', u'importtime')
+
+        cumulative = None
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = [field.strip() for field in line.split(u'|')]
+            if len(fields) == 3 and fields[2] == u'ckanext.s3filestore.plugin':
+                cumulative = int(fields[1]) / 1e6
+        assert cumulative is not None
+        assert cumulative < PLUGIN_IMPORT_BUDGET
+
+    def test_heavy_dependencies_loaded_on_first_use(self):
+        result = _run(u'\n'.join([
+            CKAN_IMPORTS,
+            u'import sys',
+            u'from ckanext.s3filestore.plugin import S3FileStorePlugin',
+            u'plugin = S3FileStorePlugin()',
+            u'plugin.get_actions()',
+            u'plugin.get_auth_functions()',
+            u'plugin.get_helpers()',
+            u'plugin.get_blueprint()',
+            u'plugin.get_commands()',
+            u'print(" ".join(m for m in {0!r} if m in sys.modules))'.format(
+                HEAVY_MODULES),
+        ]))
+
+        assert result.stdout.split() == []
@@ -0,0 +1,145 @@
+# encoding: utf-8
+import os
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from ckantoolkit import config
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore import jobs
+from ckanext.s3filestore import uploader as uploader_module
+
+
+@pytest.fixture
+def enqueued(monkeypatch, tmpdir):
+    '''Collect the enqueued jobs instead of sending them to the queue.'''
+    calls = []
+
+    def enqueue_job(fn, args=None, **kwargs):
+        calls.append((fn, args))
+    monkeypatch.setattr(uploader_module.toolkit, u'enqueue_job', enqueue_job)
+    monkeypatch.setitem(config, u'ckanext.s3filestore.async_upload_dir',
+                        str(tmpdir))
+    return calls
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.async_uploads', u'true')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.async_upload_min_size', u'0')
+class TestAsyncUpload(object):
+
+    def test_upload_in_background(self, s3_mock, s3_client, enqueued,
+                                  create_with_upload):
+        resource = create_with_upload(
+            b'a,b\n1,2\n', u'data.csv',
+            package_id=factories.Dataset()[u'id'])
+        key = u'resources/{0}/data.csv'.format(resource[u'id'])
+        bucket = config.get(u'ckanext.s3filestore.aws_bucket_name')
+
+        assert resource[u's3_upload_status'] == u'pending'
+        with pytest.raises(ClientError):
+            s3_client.head_object(Bucket=bucket, Key=key)
+
+        [(fn, args)] = enqueued
+        assert fn is jobs.upload_resource_file
+        staged = args[3]
+        fn(*args)
+
+        assert s3_client.get_object(
+            Bucket=bucket, Key=key)[u'Body'].read() == b'a,b\n1,2\n'
+        assert not os.path.exists(staged)
+        resource = helpers.call_action(u'resource_show', id=resource[u'id'])
+        assert resource[u's3_upload_status'] == u'complete'
+        assert resource[u's3_upload_progress'] == u'100'
+        assert resource[u'size'] == 8
+
+    def test_failure_reported(self, s3_mock, enqueued, create_with_upload,
+                              monkeypatch):
+        resource = create_with_upload(
+            b'a,b\n1,2\n', u'data.csv',
+            package_id=factories.Dataset()[u'id'])
+        [(fn, args)] = enqueued
+        # The bucket of a routing target which doesn't exist
+        monkeypatch.setitem(config, u'ckanext.s3filestore.targets', u'gone')
+        monkeypatch.setitem(config,
+                            u'ckanext.s3filestore.target.gone.bucket_name',
+                            u'missing-bucket')
+        args[1] = u'gone'
+
+        # boto3 wraps the ClientError of managed transfers
+        with pytest.raises(Exception):
+            fn(*args)
+
+        resource = helpers.call_action(u'resource_show', id=resource[u'id'])
+        assert resource[u's3_upload_status'] == u'failed'
+        assert u'NoSuchBucket' in resource[u's3_upload_error']
+
+    def test_progress_keeps_other_fields(self, s3_mock, enqueued,
+                                         create_with_upload):
+        resource = create_with_upload(
+            b'a,b\n1,2\n', u'data.csv',
+            package_id=factories.Dataset()[u'id'])
+        helpers.call_action(u'resource_patch', id=resource[u'id'],
+                            description=u'Edited meanwhile')
+
+        assert jobs._update_resource(resource[u'id'], u'data.csv',
+                                     s3_upload_progress=50)
+
+        resource = helpers.call_action(u'resource_show', id=resource[u'id'])
+        assert resource[u's3_upload_progress'] == u'50'
+        assert resource[u's3_upload_status'] == u'pending'
+        assert resource[u'description'] == u'Edited meanwhile'
+
+    @pytest.mark.ckan_config(u'ckanext.s3filestore.async_upload_wait', u'0')
+    def test_upload_of_failed_request_dropped(self, s3_mock, s3_client,
+                                              enqueued, create_with_upload):
+        resource = create_with_upload(
+            b'a,b\n1,2\n', u'data.csv',
+            package_id=factories.Dataset()[u'id'])
+        [(fn, args)] = enqueued
+        # The job of a resource which was never committed
+        helpers.call_action(u'resource_delete', id=resource[u'id'])
+        staged = args[3]
+
+        fn(*args)
+
+        assert not os.path.exists(staged)
+        with pytest.raises(ClientError):
+            s3_client.head_object(
+                Bucket=config.get(u'ckanext.s3filestore.aws_bucket_name'),
+                Key=u'resources/{0}/data.csv'.format(resource[u'id']))
+
+    def test_small_files_uploaded_inline(self, s3_mock, s3_client, enqueued,
+                                         create_with_upload, monkeypatch):
+        monkeypatch.setitem(
+            config, u'ckanext.s3filestore.async_upload_min_size', u'1')
+        resource = create_with_upload(
+            b'a,b\n1,2\n', u'data.csv',
+            package_id=factories.Dataset()[u'id'])
+
+        assert not enqueued
+        assert u's3_upload_status' not in resource
+        assert s3_client.head_object(
+            Bucket=config.get(u'ckanext.s3filestore.aws_bucket_name'),
+            Key=u'resources/{0}/data.csv'.format(resource[u'id']))
+
+
+def test_staged_file_linked(tmpdir, monkeypatch):
+    monkeypatch.setitem(config, u'ckanext.s3filestore.async_upload_dir',
+                        str(tmpdir))
+    monkeypatch.setitem(config, u'ckanext.s3filestore.async_uploads', u'true')
+    monkeypatch.setitem(config, u'ckanext.s3filestore.async_upload_min_size',
+                        u'0')
+    received = uploader_module.staging_file_stream(8)
+    received.write(b'a,b\n1,2\n')
+    received.seek(0)
+
+    path = uploader_module._stage_file(received, u'resource-')
+
+    assert os.path.samefile(path, received.name)
+    received.close()
+    with open(path, u'rb') as staged:
+        assert staged.read() == b'a,b\n1,2\n'
@@ -0,0 +1,70 @@
+# encoding: utf-8
+import pytest
+
+import ckan.tests.factories as factories
+from ckan.lib.helpers import url_for
+
+from ckanext.s3filestore import metrics
+
+
+pytestmark = pytest.mark.skipif(not metrics.is_available(),
+                                reason=u'prometheus_client not installed')
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.metrics_enabled', u'true')
+class TestS3Metrics(object):
+
+    def test_metrics_endpoint(self, app):
+        response = app.get(u'/s3filestore/metrics')
+        assert 200 == response.status_code
+        assert u's3filestore_s3_operation_duration_seconds' in response.body
+
+    def test_metrics_refused_to_other_hosts(self, app):
+        app.get(u'/s3filestore/metrics',
+                extra_environ={u'REMOTE_ADDR': u'203.0.113.7'}, status=403)
+
+    @pytest.mark.ckan_config(u'ckanext.s3filestore.metrics_allowed_ips',
+                             u'10.0.0.0/8')
+    def test_metrics_allowed_network(self, app):
+        response = app.get(u'/s3filestore/metrics',
+                           extra_environ={u'REMOTE_ADDR': u'10.1.2.3'})
+        assert 200 == response.status_code
+
+    def test_metrics_allowed_to_sysadmins(self, app):
+        sysadmin = factories.Sysadmin()
+        response = app.get(u'/s3filestore/metrics', extra_environ={
+            u'REMOTE_ADDR': u'203.0.113.7',
+            u'REMOTE_USER': str(sysadmin[u'name'])})
+        assert 200 == response.status_code
+
+    def test_download_is_instrumented(self, app, resource_with_upload):
+        app.get(
+            url_for(
+                u'dataset_resource.download',
+                id=resource_with_upload[u'package_id'],
+                resource_id=resource_with_upload[u'id'],
+            ),
+            follow_redirects=False
+        )
+        response = app.get(u'/s3filestore/metrics')
+
+        assert u'operation="put_object"' in response.body
+        assert u'operation="head_object"' in response.body
+        assert u'view="resource_download"' in response.body
+
+    def test_errors_counted_by_code(self):
+        from botocore.exceptions import ClientError
+
+        error = ClientError({u'Error': {u'Code': u'SlowDown'}}, u'PutObject')
+        with pytest.raises(ClientError):
+            with metrics.timed(u'test_operation'):
+                raise error
+
+        assert metrics.S3_OPERATION_ERRORS.labels(
+            u'test_operation', u'SlowDown')._value.get() >= 1
+
+
+def test_metrics_endpoint_disabled_by_default(app):
+    response = app.get(u'/s3filestore/metrics', status=404)
+    assert 404 == response.status_code
@@ -0,0 +1,59 @@
+# encoding: utf-8
+import pytest
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.s3filestore import preview
+
+CSV = u'name,notes\n' + u''.join(
+    u'row {0},"multi\nline"\n'.format(i) for i in range(1000))
+
+
+class TestRecords(object):
+
+    def test_cut_at_record(self):
+        assert preview.cut_at_record(b'a,b\n1,2\n3,') == b'a,b\n1,2\n'
+        assert preview.cut_at_record(b'a,b\n1,"x\ny') == b'a,b\n1,"x\n'
+        assert preview.cut_at_record(b'a,b\n1,"x\ny', quoted=True) == \
+            b'a,b\n'
+        assert preview.cut_at_record(b'no line break') == b''
+
+    def test_first_records(self):
+        assert preview.first_records(u'h\n"1\n2"\n3\n', 2, quoted=True) == \
+            u'h\n"1\n2"\n'
+        assert preview.first_records(u'h\n1', 5) == u'h\n1'
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+class TestGetResourcePreview(object):
+
+    def test_preview_sample(self, create_with_upload):
+        resource = create_with_upload(
+            CSV, u'data.csv', package_id=factories.Dataset()[u'id'])
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        sample = helpers.call_action(u'get_resource_preview', context,
+                                     id=resource[u'id'], bytes=1000)
+
+        assert sample[u'truncated']
+        assert sample[u'size'] == len(CSV)
+        assert len(sample[u'text']) <= 1000
+        assert CSV.startswith(sample[u'text'])
+        assert sample[u'text'].endswith(u'line"\n')
+
+        # Revalidated with the ETag, the object being unchanged
+        assert helpers.call_action(u'get_resource_preview', context,
+                                   id=resource[u'id'], bytes=1000) == sample
+
+    def test_preview_rows(self, create_with_upload):
+        resource = create_with_upload(
+            CSV, u'data.csv', package_id=factories.Dataset()[u'id'])
+        context = {u'user': factories.Sysadmin()[u'name']}
+
+        sample = helpers.call_action(u'get_resource_preview', context,
+                                     id=resource[u'id'], rows=2)
+
+        assert sample[u'text'] == \
+            u'name,notes\nrow 0,"multi\nline"\nrow 1,"multi\nline"\n'
+        assert sample[u'truncated']
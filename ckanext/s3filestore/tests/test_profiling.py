@@ -0,0 +1,70 @@
+# encoding: utf-8
+import six
+import flask
+import pytest
+
+import ckan.tests.factories as factories
+from ckan.lib.helpers import url_for
+
+from ckanext.s3filestore import profiling
+
+
+def test_server_timing_header():
+    summary = profiling.summarize([
+        (u'resource_show', 0.004, False),
+        (u'head_object', 0.010, True),
+        (u'head_object', 0.020, True),
+    ])
+    header = profiling.server_timing_header(summary, 0.05)
+
+    assert header == (u'resource_show;dur=4.0, '
+                      u'head_object;dur=30.0;desc="2 calls", '
+                      u'total;dur=50.0')
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.profiling_enabled', u'true')
+class TestS3Profiling(object):
+
+    def _download(self, app, resource):
+        user = factories.Sysadmin()
+        env = {u'REMOTE_USER': six.ensure_str(user[u'name'])}
+        return app.get(
+            url_for(
+                u'dataset_resource.download',
+                id=resource[u'package_id'],
+                resource_id=resource[u'id'],
+            ),
+            extra_environ=env,
+            follow_redirects=False
+        )
+
+    def test_server_timing_header_on_download(self, app,
+                                              resource_with_upload):
+        response = self._download(app, resource_with_upload)
+
+        server_timing = response.headers[u'Server-Timing']
+        for step in (u'resource_show', u'package_show', u's3_client',
+                     u'head_object', u'presign_get_object', u'total'):
+            assert step in server_timing
+        assert u'X-S3filestore-Call-Budget-Exceeded' not in response.headers
+
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.profiling_s3_call_budget', u'1')
+    def test_s3_call_budget(self, app, resource_with_upload):
+        response = self._download(app, resource_with_upload)
+
+        assert u'X-S3filestore-Call-Budget-Exceeded' not in response.headers
+
+    @pytest.mark.ckan_config(
+        u'ckanext.s3filestore.profiling_s3_call_budget', u'2')
+    def test_s3_call_budget_exceeded(self, app):
+        with app.flask_app.test_request_context(u'/'):
+            profiling.start_request()
+            for _ in range(3):
+                profiling.record(u'head_object', 0.01, s3_call=True)
+            profiling.record(u'presign_get_object', 0.001)
+            response = profiling.finish_request(flask.Response())
+
+        assert response.headers[
+            u'X-S3filestore-Call-Budget-Exceeded'] == u'3/2'
@@ -0,0 +1,152 @@
+# encoding: utf-8
+import time
+
+import pytest
+
+from botocore.exceptions import ClientError
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from ckanext.s3filestore import replicas
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+REPLICAS_CONFIG = [
+    (u'ckanext.s3filestore.replicas', u'eu us'),
+    (u'ckanext.s3filestore.replica.eu.bucket_name', u'replica-eu'),
+    (u'ckanext.s3filestore.replica.eu.locations', u'EU FR'),
+    (u'ckanext.s3filestore.replica.us.bucket_name', u'replica-us'),
+    (u'ckanext.s3filestore.replica.us.locations', u'NA'),
+    (u'ckanext.s3filestore.replica_location_header', u'X-Viewer-Country'),
+]
+
+
+def _request(country=None):
+    headers = {u'X-Viewer-Country': country} if country else {}
+    return Request(EnvironBuilder(headers=headers).get_environ())
+
+
+@pytest.fixture
+def with_replicas(ckan_config, monkeypatch, s3_mock):
+    for option, value in REPLICAS_CONFIG:
+        monkeypatch.setitem(ckan_config, option, value)
+    client = BaseS3Uploader().get_s3_client()
+    for bucket in (u'replica-eu', u'replica-us'):
+        client.create_bucket(Bucket=bucket)
+    replicas.health.reset()
+    yield client
+    replicas.health.reset()
+
+
+class _Candidate(object):
+    '''Stands for a replica answering HEAD requests after `delay`.'''
+
+    def __init__(self, name, delay=0, found=True, error=None):
+        self.name = name
+        self.delay = delay
+        self.found = found
+        self.error = error
+        self.bucket_name = name
+
+    def head_object(self, key, read_only=True):
+        time.sleep(self.delay)
+        if self.error:
+            raise ClientError({u'Error': {u'Code': self.error}}, u'HeadObject')
+        if not self.found:
+            raise ClientError({u'Error': {u'Code': u'404'}}, u'HeadObject')
+        return {}
+
+
+class TestReplicas(object):
+
+    def test_locate_by_header(self, with_replicas):
+        assert replicas.locate(_request(u'fr')) == {u'FR'}
+        assert replicas.locate(_request()) == set()
+
+    def test_replicas_built_once(self, with_replicas, ckan_config,
+                                 monkeypatch):
+        replica = replicas.get_replicas()[0]
+
+        assert replicas.get_replicas()[0] is replica
+        monkeypatch.setitem(ckan_config,
+                            u'ckanext.s3filestore.replica.eu.bucket_name',
+                            u'other-bucket')
+        assert replicas.get_replicas()[0].bucket_name == u'other-bucket'
+
+    def test_order_by_location(self, with_replicas):
+        upload = BaseS3Uploader()
+
+        ordered = replicas.order(upload, {u'FR'})
+
+        assert [getattr(c, u'name', None) for c in ordered] == \
+            [u'eu', None, u'us']
+        assert ordered[0].bucket_name == u'replica-eu'
+
+    def test_unhealthy_replicas_last(self, with_replicas):
+        replicas.health.record(u'eu', 0, failed=True)
+
+        ordered = replicas.order(BaseS3Uploader(), {u'FR'})
+
+        assert [getattr(c, u'name', None) for c in ordered] == \
+            [None, u'us', u'eu']
+
+    def test_hedged_head_fastest_wins(self):
+        slow = _Candidate(u'slow', delay=0.5)
+        fast = _Candidate(u'fast')
+
+        start = time.time()
+        assert replicas.hedged_head([slow, fast], u'key', delay=0.01) is fast
+        assert time.time() - start < 0.4
+
+    def test_hedged_head_next_on_missing(self):
+        missing = _Candidate(u'missing', found=False)
+        other = _Candidate(u'other', delay=0.05)
+
+        assert replicas.hedged_head([missing, other], u'key',
+                                    delay=10) is other
+
+    def test_hedged_head_not_found(self):
+        with pytest.raises(ClientError):
+            replicas.hedged_head([_Candidate(u'a', found=False),
+                                  _Candidate(u'b', found=False)], u'key')
+
+    def test_hedged_head_primary_error(self):
+        primary = _Candidate(None, error=u'InternalError')
+
+        with pytest.raises(ClientError) as e:
+            replicas.hedged_head([_Candidate(u'a', found=False), primary],
+                                 u'key', delay=0)
+        assert e.value.response[u'Error'][u'Code'] == u'InternalError'
+
+    def test_signed_for_closest_replica(self, with_replicas):
+        for bucket in (u'replica-eu', u'replica-us'):
+            with_replicas.put_object(Bucket=bucket, Key=u'a.csv', Body=b'1')
+
+        url = replicas.get_signed_url(BaseS3Uploader(), u'a.csv',
+                                      request=_request(u'FR'))
+
+        assert u'replica-eu' in url
+
+    def test_head_from_metadata_cache(self, with_replicas, ckan_config,
+                                      monkeypatch):
+        monkeypatch.setitem(ckan_config,
+                            u'ckanext.s3filestore.metadata_cache', u'memory')
+        with_replicas.put_object(Bucket=u'replica-eu', Key=u'a.csv',
+                                 Body=b'1')
+        replicas.get_signed_url(BaseS3Uploader(), u'a.csv',
+                                request=_request(u'FR'))
+        with_replicas.delete_object(Bucket=u'replica-eu', Key=u'a.csv')
+
+        url = replicas.get_signed_url(BaseS3Uploader(), u'a.csv',
+                                      request=_request(u'FR'))
+
+        assert u'replica-eu' in url
+
+    def test_failover_when_missing_on_closest(self, with_replicas):
+        with_replicas.put_object(Bucket=u'replica-us', Key=u'a.csv',
+                                 Body=b'1')
+
+        url = replicas.get_signed_url(BaseS3Uploader(), u'a.csv',
+                                      request=_request(u'FR'))
+
+        assert u'replica-us' in url
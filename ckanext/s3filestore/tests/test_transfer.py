@@ -0,0 +1,225 @@
+# encoding: utf-8
+import io
+import os
+import hashlib
+
+import pytest
+
+from ckanext.s3filestore import transfer
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def multipart_object(s3_mock):
+    '''An object uploaded in a 5MB and a 1MB part.'''
+    upload = BaseS3Uploader()
+    client = upload.get_s3_client()
+    data = os.urandom(5 * MB) + os.urandom(MB)
+    key = u'resources/multipart/data.bin'
+    mpu = client.create_multipart_upload(Bucket=upload.bucket_name, Key=key)
+    parts = []
+    for number, chunk in enumerate((data[:5 * MB], data[5 * MB:]), 1):
+        response = client.upload_part(
+            Bucket=upload.bucket_name, Key=key, PartNumber=number,
+            UploadId=mpu[u'UploadId'], Body=chunk)
+        parts.append({u'PartNumber': number, u'ETag': response[u'ETag']})
+    client.complete_multipart_upload(
+        Bucket=upload.bucket_name, Key=key, UploadId=mpu[u'UploadId'],
+        MultipartUpload={u'Parts': parts})
+    return upload, key, data
+
+
+class TestParseHash(object):
+
+    def test_parse_hash(self):
+        digest = hashlib.sha256(b'data').hexdigest()
+
+        assert transfer.parse_hash(u'sha256:' + digest) == \
+            (u'sha256', digest)
+        assert transfer.parse_hash(digest) == (u'sha256', digest)
+        assert transfer.parse_hash(u'') is None
+        assert transfer.parse_hash(u'not a hash') is None
+        # The digest of another algorithm
+        assert transfer.parse_hash(u'md5:' + digest) is None
+
+
+class TestDownload(object):
+
+    def test_download_in_ranges(self, tmpdir, multipart_object):
+        upload, key, data = multipart_object
+        path = str(tmpdir.join(u'data.bin'))
+
+        # The multipart ETag is checked against the downloaded file
+        assert transfer.download(upload, key, path, part_size=MB,
+                                 workers=4)
+
+        with open(path, u'rb') as f:
+            assert f.read() == data
+        assert not os.path.exists(path + transfer.STATE_SUFFIX)
+        # Complete files aren't downloaded again
+        assert not transfer.download(upload, key, path)
+
+    def test_checksum_mismatch(self, tmpdir, multipart_object):
+        upload, key, _data = multipart_object
+        path = str(tmpdir.join(u'data.bin'))
+
+        with pytest.raises(transfer.TransferError):
+            transfer.download(upload, key, path,
+                              expected_hash=hashlib.md5(b'x').hexdigest())
+        assert not os.path.exists(path)
+
+    def test_hash_mismatch_not_strict(self, tmpdir, multipart_object):
+        upload, key, data = multipart_object
+        path = str(tmpdir.join(u'data.bin'))
+
+        # The file is checked against its ETag instead
+        assert transfer.download(upload, key, path,
+                                 expected_hash=hashlib.md5(b'x').hexdigest(),
+                                 strict=False)
+        with open(path, u'rb') as f:
+            assert f.read() == data
+
+    def test_resume(self, tmpdir, monkeypatch, multipart_object):
+        upload, key, data = multipart_object
+        path = str(tmpdir.join(u'data.bin'))
+        fetch_range = transfer._fetch_range
+        fetched = []
+
+        def failing_fetch_range(upload, key, fd, start, end):
+            fetched.append(start)
+            if start >= 3 * MB:
+                raise transfer.TransferError(u'Interrupted')
+            fetch_range(upload, key, fd, start, end)
+
+        monkeypatch.setattr(transfer, u'_fetch_range', failing_fetch_range)
+        with pytest.raises(transfer.TransferError):
+            transfer.download(upload, key, path, part_size=MB, workers=1)
+        assert os.path.exists(path + transfer.STATE_SUFFIX)
+
+        del fetched[:]
+        monkeypatch.setattr(transfer, u'_fetch_range',
+                            lambda *args: fetched.append(args[3]) or
+                            fetch_range(*args))
+        assert transfer.download(upload, key, path, part_size=MB)
+
+        assert sorted(fetched) == [3 * MB, 4 * MB, 5 * MB]
+        with open(path, u'rb') as f:
+            assert f.read() == data
+
+
+@pytest.fixture
+def source(s3_mock):
+    '''A bucket to migrate, with a small object and one uploaded in two
+    parts.'''
+    upload = BaseS3Uploader()
+    upload.bucket_name = u'source-bucket'
+    client = upload.get_s3_client()
+    client.create_bucket(Bucket=upload.bucket_name)
+    client.put_object(Bucket=upload.bucket_name, Key=u'resources/a/a.csv',
+                      Body=b'a,b\n1,2\n', ContentType=u'text/csv')
+    client.put_object(Bucket=upload.bucket_name, Key=u'other/b.csv',
+                      Body=b'b')
+    data = os.urandom(5 * MB) + os.urandom(MB)
+    key = u'resources/b/b.bin'
+    mpu = client.create_multipart_upload(Bucket=upload.bucket_name, Key=key)
+    parts = []
+    for number, chunk in enumerate((data[:5 * MB], data[5 * MB:]), 1):
+        response = client.upload_part(
+            Bucket=upload.bucket_name, Key=key, PartNumber=number,
+            UploadId=mpu[u'UploadId'], Body=chunk)
+        parts.append({u'PartNumber': number, u'ETag': response[u'ETag']})
+    client.complete_multipart_upload(
+        Bucket=upload.bucket_name, Key=key, UploadId=mpu[u'UploadId'],
+        MultipartUpload={u'Parts': parts})
+    return upload
+
+
+class TestMigrate(object):
+
+    def _migrate(self, source, dest, server_side, limiter=None):
+        for page in transfer.list_objects(source, u'resources/'):
+            for obj in page:
+                transfer.copy_object(source, dest, obj, obj[u'Key'],
+                                     server_side=server_side,
+                                     limiter=limiter)
+
+    @pytest.mark.parametrize(u'server_side', [True, False])
+    def test_copies_keep_etags(self, source, server_side):
+        dest = BaseS3Uploader()
+
+        self._migrate(source, dest, server_side,
+                      limiter=transfer.TokenBucket(100 * MB))
+
+        client = dest.get_s3_client()
+        keys = [obj[u'Key'] for page in transfer.list_objects(dest)
+                for obj in page]
+        assert keys == [u'resources/a/a.csv', u'resources/b/b.bin']
+        for key in keys:
+            assert client.head_object(Bucket=dest.bucket_name, Key=key)[
+                u'ETag'] == client.head_object(
+                    Bucket=source.bucket_name, Key=key)[u'ETag']
+        assert client.head_object(Bucket=dest.bucket_name,
+                                  Key=u'resources/a/a.csv')[
+            u'ContentType'] == u'text/csv'
+        assert list(transfer.verify_copies(source, u'resources/', dest,
+                                           u'resources/')) == []
+
+    def test_verify_copies(self, source):
+        dest = BaseS3Uploader()
+        client = dest.get_s3_client()
+        client.put_object(Bucket=dest.bucket_name, Key=u'copy/a/a.csv',
+                          Body=b'a,b\n1,3\n')
+
+        problems = list(transfer.verify_copies(source, u'resources/', dest,
+                                               u'copy/'))
+
+        assert [key for key, _problem in problems] == \
+            [u'resources/a/a.csv', u'resources/b/b.bin']
+        assert problems[0][1].startswith(u'checksum')
+        assert problems[1][1] == u'missing'
+
+    def test_checkpoint(self, tmpdir):
+        path = str(tmpdir.join(u'checkpoint.jsonl'))
+        checkpoint = transfer.Checkpoint(path)
+        checkpoint.add(u'a', u'"etag"', 1)
+        checkpoint.close()
+        with open(path, u'a') as f:
+            f.write(u'{"key": "b", "et')
+
+        checkpoint = transfer.Checkpoint(path)
+
+        assert len(checkpoint) == 1
+        assert checkpoint.is_done(u'a', u'"etag"')
+        # Modified since copied
+        assert not checkpoint.is_done(u'a', u'"other"')
+
+
+class TestStreamUpload(object):
+
+    def test_stream_in_parts(self, s3_mock):
+        upload = BaseS3Uploader()
+        data = os.urandom(11 * MB)
+
+        result = transfer.stream_upload(upload, u'stream/data.bin',
+                                        io.BytesIO(data), part_size=5 * MB)
+
+        obj = upload.get_object(u'stream/data.bin')
+        assert obj[u'Body'].read() == data
+        assert result[u'size'] == len(data)
+        assert result[u'sha256'] == hashlib.sha256(data).hexdigest()
+        assert result[u'etag'].endswith(u'-3')
+
+    def test_too_large_aborted(self, s3_mock):
+        upload = BaseS3Uploader()
+        client = upload.get_s3_client()
+
+        with pytest.raises(transfer.UploadTooLarge):
+            transfer.stream_upload(upload, u'stream/data.bin',
+                                   io.BytesIO(os.urandom(11 * MB)),
+                                   max_size=8 * MB, part_size=5 * MB)
+
+        assert not client.list_multipart_uploads(
+            Bucket=upload.bucket_name).get(u'Uploads')
+        assert not upload.key_exists(u'stream/data.bin')
@@ -9,6 +9,8 @@ from ckantoolkit import config
 import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
 
+from ckanext.s3filestore import uploader as uploader_module
+from ckanext.s3filestore.uploader import BaseS3Uploader
 from ckanext.s3filestore.uploader import S3Uploader
 from ckanext.s3filestore.uploader import S3ResourceUploader
 
@@ -148,3 +150,188 @@ class TestS3ResourceUpload(object):
         # key shouldn't exist, this raises ClientError
         with pytest.raises(ClientError):
             s3_client.head_object(Bucket=self.bucket_name, Key=key)
+
+    def test_not_pinned_without_targets(self, s3_mock, create_with_upload):
+        resource = create_with_upload(
+            b'a,b\n1,2\n', u'data.csv',
+            package_id=factories.Dataset()[u'id'])
+
+        assert u's3_target' not in resource
+
+
+class TestCopyKey(object):
+
+    def test_copy_key(self, s3_mock):
+        uploader = BaseS3Uploader()
+        client = uploader.get_s3_client()
+        client.put_object(Bucket=uploader.bucket_name, Key=u'a/data.csv',
+                          Body=b'a,b\n1,2\n')
+
+        assert uploader.copy_key(u'a/data.csv', u'b/data.csv') == 8
+
+        copy = client.get_object(Bucket=uploader.bucket_name,
+                                 Key=u'b/data.csv')
+        assert copy[u'Body'].read() == b'a,b\n1,2\n'
+
+    @pytest.mark.ckan_config(u'ckanext.s3filestore.copy_part_size', u'5')
+    def test_copy_key_in_parts(self, s3_mock, monkeypatch):
+        # Copy in parts anything larger than 1 byte
+        monkeypatch.setattr(uploader_module, u'MAX_COPY_OBJECT_SIZE', 1)
+        uploader = BaseS3Uploader()
+        client = uploader.get_s3_client()
+        data = os.urandom(6 * 1024 * 1024)
+        client.put_object(Bucket=uploader.bucket_name, Key=u'a/data.bin',
+                          Body=data)
+
+        uploader.copy_key(u'a/data.bin', u'b/data.bin')
+
+        copy = client.get_object(Bucket=uploader.bucket_name,
+                                 Key=u'b/data.bin')
+        assert copy[u'ETag'].strip(u'"').endswith(u'-2')
+        assert copy[u'Body'].read() == data
+
+
+@pytest.mark.ckan_config(u'ckanext.s3filestore.key_partition_levels', u'2')
+class TestPartitionedKeys(object):
+
+    resource_id = u'165900ba-3c60-43c5-9e9c-9f8acd0aa93f'
+
+    def test_resource_get_path(self):
+        shards = uploader_module.partition_prefix(self.resource_id, 2)
+
+        path = S3ResourceUploader({}).get_path(self.resource_id, u'data.csv')
+
+        assert len(shards) == 5
+        assert path == u'resources/{0}/{1}/data.csv'.format(
+            shards, self.resource_id)
+        assert S3ResourceUploader({}).get_paths(
+            self.resource_id, u'data.csv') == [
+            path, u'resources/{0}/data.csv'.format(self.resource_id)]
+
+    def test_uploader_get_keys(self):
+        shards = uploader_module.partition_prefix(u'logo.png', 2)
+
+        assert S3Uploader.get_keys(u'group', u'logo.png') == [
+            u'storage/uploads/group/{0}/logo.png'.format(shards),
+            u'storage/uploads/group/logo.png']
+
+    def test_resolve_path(self, s3_mock):
+        uploader = S3ResourceUploader({})
+        client = uploader.get_s3_client()
+        path, legacy = uploader.get_paths(self.resource_id, u'data.csv')
+
+        # Missing objects resolve to the partitioned key
+        assert uploader.resolve_path(self.resource_id, u'data.csv') == path
+
+        client.put_object(Bucket=uploader.bucket_name, Key=legacy, Body=b'1')
+        assert uploader.resolve_path(self.resource_id, u'data.csv') == legacy
+
+        client.put_object(Bucket=uploader.bucket_name, Key=path, Body=b'1')
+        assert uploader.resolve_path(self.resource_id, u'data.csv') == path
+
+
+@pytest.mark.usefixtures(u'clean_db', u'clean_index')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.targets', u'stats other')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.target.stats.organizations',
+                         u'stats-org')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.target.stats.bucket_name',
+                         u'stats-bucket')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.target.other.packages',
+                         u'other-dataset')
+@pytest.mark.ckan_config(u'ckanext.s3filestore.target.other.bucket_name',
+                         u'other-bucket')
+class TestBucketRouting(object):
+
+    def test_routed_by_organization(self):
+        org = factories.Organization(name=u'stats-org')
+        dataset = factories.Dataset(owner_org=org[u'id'])
+
+        upload = S3ResourceUploader({u'package_id': dataset[u'id']})
+
+        assert upload.target == u'stats'
+        assert upload.bucket_name == u'stats-bucket'
+
+    def test_package_rule_first(self):
+        org = factories.Organization(name=u'stats-org')
+        dataset = factories.Dataset(name=u'other-dataset',
+                                    owner_org=org[u'id'])
+
+        upload = S3ResourceUploader({u'package_id': dataset[u'id']})
+
+        assert upload.bucket_name == u'other-bucket'
+
+    def test_default_bucket(self):
+        dataset = factories.Dataset()
+
+        upload = S3ResourceUploader({u'package_id': dataset[u'id']})
+
+        assert upload.target is None
+        assert upload.bucket_name == \
+            config.get(u'ckanext.s3filestore.aws_bucket_name')
+
+    def test_upload_to_routed_bucket(self, s3_mock, create_with_upload):
+        S3Uploader(u'group').get_s3_client().create_bucket(
+            Bucket=u'stats-bucket')
+        org = factories.Organization(name=u'stats-org')
+        dataset = factories.Dataset(owner_org=org[u'id'])
+
+        resource = create_with_upload(b'a,b\n1,2\n', u'data.csv',
+                                      package_id=dataset[u'id'])
+
+        client = S3Uploader(u'group').get_s3_client()
+        assert client.head_object(
+            Bucket=u'stats-bucket',
+            Key=u'resources/{0}/data.csv'.format(resource[u'id']))
+
+    def test_resource_pinned_to_its_bucket(self, s3_mock, create_with_upload):
+        S3Uploader(u'group').get_s3_client().create_bucket(
+            Bucket=u'stats-bucket')
+        org = factories.Organization(name=u'stats-org')
+        dataset = factories.Dataset(owner_org=org[u'id'])
+        resource = create_with_upload(b'a,b\n1,2\n', u'data.csv',
+                                      package_id=dataset[u'id'])
+        assert resource[u's3_target'] == u'stats'
+
+        # The dataset moves to an organization routed to the default bucket
+        helpers.call_action(u'package_patch', id=dataset[u'id'],
+                            owner_org=factories.Organization()[u'id'])
+        resource = helpers.call_action(u'resource_show', id=resource[u'id'])
+        upload = S3ResourceUploader(dict(resource))
+
+        assert upload.bucket_name == u'stats-bucket'
+        assert upload.key_exists(
+            upload.get_path(resource[u'id'], u'data.csv'))
+        # A new resource of the dataset goes to the default bucket
+        assert S3ResourceUploader(
+            {u'package_id': dataset[u'id']}).target is None
+
+    def test_download_urls_of_pinned_resource(self, s3_mock,
+                                              create_with_upload):
+        S3Uploader(u'group').get_s3_client().create_bucket(
+            Bucket=u'stats-bucket')
+        org = factories.Organization(name=u'stats-org')
+        dataset = factories.Dataset(owner_org=org[u'id'])
+        create_with_upload(b'a,b\n1,2\n', u'data.csv',
+                           package_id=dataset[u'id'])
+        helpers.call_action(u'package_patch', id=dataset[u'id'],
+                            owner_org=factories.Organization()[u'id'])
+
+        [result] = helpers.call_action(
+            u'get_download_urls',
+            {u'user': factories.Sysadmin()[u'name']}, id=dataset[u'id'])
+
+        assert u'stats-bucket' in result[u'resources'][0][u'url']
+
+    def test_pin_kept_on_update(self, s3_mock, create_with_upload):
+        S3Uploader(u'group').get_s3_client().create_bucket(
+            Bucket=u'stats-bucket')
+        org = factories.Organization(name=u'stats-org')
+        dataset = factories.Dataset(owner_org=org[u'id'])
+        resource = create_with_upload(b'a,b\n1,2\n', u'data.csv',
+                                      package_id=dataset[u'id'])
+        resource.pop(u's3_target')
+
+        resource = helpers.call_action(u'resource_update',
+                                       **dict(resource, name=u'renamed'))
+
+        assert resource[u's3_target'] == u'stats'
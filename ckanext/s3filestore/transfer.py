@@ -0,0 +1,557 @@
+# encoding: utf-8
+'''Fast, resumable transfers of S3 objects, to local files or to another
+bucket.
+
+Large objects are split into byte ranges fetched concurrently, each range
+being written at its offset in a file preallocated to the size of the object
+with positioned writes, so that no part is buffered in memory. The completed
+ranges are recorded in a ``.s3part`` state file next to the destination, and
+an interrupted download picks up from there as long as the object hasn't
+changed. Once complete, the file is checked against the resource hash, or
+the ETag of the object when there is no usable hash.
+
+Streams of unknown length, e.g. request bodies, are uploaded part by part as
+they are read, with their checksums computed on the way.
+'''
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ckanext.s3filestore import metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 8
+READ_SIZE = 256 * 1024
+STATE_SUFFIX = '.s3part'
+
+MULTIPART_ETAG = re.compile(r'^([0-9a-f]{32})-(\d+)$')
+HASH_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+class TransferError(Exception):
+    pass
+
+
+class UploadTooLarge(TransferError):
+    '''Raised when a streamed upload crosses its size limit.'''
+    pass
+
+
+def parse_hash(value):
+    '''Return the `(algorithm, hex digest)` of a resource hash such as
+    ``sha256:ab12...`` or a bare MD5 or SHA digest, or None if the hash
+    can't be used to check a file.'''
+    if not value:
+        return None
+    value = value.strip().lower()
+    if ':' in value:
+        algorithm, digest = value.split(':', 1)
+        algorithm = algorithm.replace('-', '')
+    else:
+        digest = value
+        algorithm = HASH_LENGTHS.get(len(digest))
+    if algorithm not in hashlib.algorithms_available or \
+            not re.match(r'^[0-9a-f]+$', digest):
+        return None
+    # e.g. a truncated digest, or one of another algorithm
+    if len(digest) != hashlib.new(algorithm).digest_size * 2:
+        return None
+    return algorithm, digest
+
+
+def file_digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def file_etag(path, part_size=None, parts_count=None):
+    '''Compute the ETag S3 gives to the object at `path` when it is uploaded
+    in one request, or in `parts_count` parts of `part_size` bytes.'''
+    if not parts_count:
+        return file_digest(path, 'md5')
+    digests = []
+    with open(path, 'rb') as f:
+        for _i in range(parts_count):
+            digest = hashlib.md5()
+            remaining = part_size
+            while remaining:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                remaining -= len(data)
+            digests.append(digest.digest())
+    return '{0}-{1}'.format(hashlib.md5(b''.join(digests)).hexdigest(),
+                            parts_count)
+
+
+def verify(path, info, expected_hash=None, strict=True):
+    '''Check the file at `path` against `expected_hash` or, failing that,
+    against the ETag of the object described by `info`. Raises
+    `TransferError` on a mismatch.
+
+    Unless `strict`, a file not matching `expected_hash`, which is only
+    metadata of the resource, is logged and checked against the ETag.'''
+    parsed = parse_hash(expected_hash)
+    if parsed:
+        algorithm, expected = parsed
+        actual = file_digest(path, algorithm)
+        if actual != expected and not strict:
+            log.warning('{0} does not match the hash {1} of its resource, '
+                        'checking its ETag'.format(path, expected_hash))
+            parsed = None
+    if not parsed:
+        expected = info['ETag'].strip('"')
+        match = MULTIPART_ETAG.match(expected)
+        if match:
+            actual = file_etag(path, info['PartSize'], int(match.group(2)))
+        elif re.match(r'^[0-9a-f]{32}$', expected):
+            actual = file_etag(path)
+        else:
+            log.warning('Cannot verify {0}, unknown ETag {1}'.format(
+                path, expected))
+            return
+    if actual != expected:
+        raise TransferError('Checksum mismatch for {0}: expected {1}, got '
+                            '{2}'.format(path, expected, actual))
+
+
+def _head_object(upload, key, **params):
+    client = upload.get_s3_client(read_only=True)
+    with metrics.timed('head_object'):
+        return client.head_object(Bucket=upload.bucket_name, Key=key,
+                                  **params)
+
+
+def _part_size(upload, key, etag):
+    '''Return the size of the parts of `key` if it was uploaded in several
+    parts, as all the parts but the last have the size of the first one.'''
+    if MULTIPART_ETAG.match(etag.strip('"')):
+        return _head_object(upload, key, PartNumber=1)['ContentLength']
+    return None
+
+
+def head(upload, key):
+    '''Return the size, ETag and, for objects uploaded in several parts, the
+    size of the parts of `key`.'''
+    response = _head_object(upload, key)
+    return {'ContentLength': response['ContentLength'],
+            'ETag': response['ETag'],
+            'PartSize': _part_size(upload, key, response['ETag'])}
+
+
+class _State(object):
+    '''The ranges of a download already written to disk.'''
+
+    def __init__(self, path, info, part_size):
+        self.path = path + STATE_SUFFIX
+        self.etag = info['ETag']
+        self.size = info['ContentLength']
+        self.part_size = part_size
+        self.done = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''Restore the completed ranges of a previous attempt, unless the
+        object or part size changed since.'''
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if (saved.get('etag'), saved.get('size'), saved.get('part_size')) \
+                == (self.etag, self.size, self.part_size):
+            self.done = set(saved.get('done', []))
+
+    def mark_done(self, index):
+        with self._lock:
+            self.done.add(index)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'etag': self.etag, 'size': self.size,
+                           'part_size': self.part_size,
+                           'done': sorted(self.done)}, f)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _preallocate(fd, size):
+    os.ftruncate(fd, size)
+    if hasattr(os, 'posix_fallocate') and size:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # e.g. not supported by the file system, the file is sparse
+            pass
+
+
+def _fetch_range(upload, key, fd, start, end):
+    response = upload.get_object(key, (start, end))
+    body = response['Body']
+    offset = start
+    try:
+        for data in iter(lambda: body.read(READ_SIZE), b''):
+            os.pwrite(fd, data, offset)
+            offset += len(data)
+    finally:
+        body.close()
+    if offset != end + 1:
+        raise TransferError('Incomplete range {0}-{1} of {2}'.format(
+            start, end, key))
+
+
+def _download_ranges(upload, key, path, state, workers):
+    '''Fetch the ranges of the object `key` missing from `path` according
+    to `state` with `workers` threads, recording them as they complete.'''
+    size, part_size = state.size, state.part_size
+    ranges = [(i, start, min(start + part_size, size) - 1)
+              for i, start in enumerate(range(0, size, part_size))]
+    if os.path.exists(path):
+        state.load()
+    else:
+        state.remove()
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not state.done:
+            _preallocate(fd, size)
+
+        def fetch(part):
+            index, start, end = part
+            _fetch_range(upload, key, fd, start, end)
+            state.mark_done(index)
+
+        todo = [r for r in ranges if r[0] not in state.done]
+        if todo:
+            log.debug('Fetching {0} of the {1} ranges of {2}'.format(
+                len(todo), len(ranges), key))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            # Raises the first error once all the ranges were tried, the
+            # completed ones being kept for the next attempt
+            list(executor.map(fetch, todo))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def download(upload, key, path, part_size=None, workers=DEFAULT_WORKERS,
+             expected_hash=None, check=True, strict=True):
+    '''Download the object `key` of the bucket of `upload` to `path`.
+
+    Objects larger than `part_size` are fetched in concurrent ranges by
+    `workers` threads, and checked with `verify`. Returns False if `path`
+    was already complete.
+    '''
+    info = head(upload, key)
+    size = info['ContentLength']
+    # Following the upload parts keeps the ranges aligned on what S3 stores
+    part_size = part_size or info['PartSize'] or DEFAULT_PART_SIZE
+    state = _State(path, info, part_size)
+
+    if not os.path.exists(state.path) and os.path.exists(path) and \
+            os.path.getsize(path) == size:
+        try:
+            if check:
+                verify(path, info, expected_hash, strict)
+            return False
+        except TransferError as e:
+            log.warning('{0}, downloading it again'.format(e))
+
+    _download_ranges(upload, key, path, state, workers)
+
+    if check:
+        try:
+            verify(path, info, expected_hash, strict)
+        except TransferError:
+            # Don't resume from corrupted data
+            state.remove()
+            os.remove(path)
+            raise
+    state.remove()
+    return True
+
+
+# Bucket to bucket migrations
+#
+# Objects are copied server-side when both buckets share an endpoint, and
+# otherwise streamed from a GET into a PUT, or a multipart upload, holding at
+# most one part per worker in memory. Objects uploaded in several parts are
+# copied with the same parts so that they keep the same ETag, which is used
+# to check the copies. Other streamed copies record the ETag of their source
+# in their `source-etag` metadata.
+
+STREAM_PART_SIZE = 16 * 1024 * 1024
+MAX_PARTS = 10000
+SOURCE_ETAG = 'source-etag'
+
+
+class TokenBucket(object):
+    '''Limits the rate at which bytes are transferred by all the threads
+    sharing it to `rate` bytes per second.'''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._tokens = self.rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        '''Take `amount` bytes from the bucket, waiting until they are
+        allowed.'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Checkpoint(object):
+    '''Append-only JSON lines file of the objects already copied, so that
+    an interrupted migration skips them when run again, unless they were
+    modified since.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._done = {}
+        self._lock = threading.Lock()
+        line = '\n'
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # e.g. the last line of an interrupted run
+                        continue
+                    self._done[record['key']] = record['etag']
+        self._file = open(path, 'a')
+        if not line.endswith('\n'):
+            self._file.write('\n')
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, key, etag):
+        return self._done.get(key) == etag
+
+    def add(self, key, etag, size):
+        with self._lock:
+            self._done[key] = etag
+            self._file.write(json.dumps(
+                {'key': key, 'etag': etag, 'size': size}) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def list_objects(upload, prefix=''):
+    '''Generate the pages of the `Key`, `Size` and `ETag` of the objects
+    under `prefix`, in key order.'''
+    client = upload.get_s3_client(read_only=True)
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=upload.bucket_name, Prefix=prefix):
+        yield page.get('Contents', [])
+
+
+def _read(body, size, limiter=None):
+    data = bytearray()
+    while len(data) < size:
+        chunk = body.read(min(READ_SIZE, size - len(data)))
+        if not chunk:
+            break
+        if limiter is not None:
+            limiter.consume(len(chunk))
+        data.extend(chunk)
+    return bytes(data)
+
+
+def _stream_copy(source, dest, obj, dest_key, part_size, limiter=None):
+    response = source.get_object(obj['Key'])
+    body = response['Body']
+    size = obj['Size']
+    client = dest.get_s3_client()
+    metadata = dict(response.get('Metadata', {}))
+    metadata[SOURCE_ETAG] = obj['ETag']
+    params = {'Bucket': dest.bucket_name, 'Key': dest_key, 'ACL': dest.acl,
+              'ContentType': response.get('ContentType') or
+              'application/octet-stream',
+              'Metadata': metadata}
+    try:
+        if not part_size and size <= STREAM_PART_SIZE:
+            with metrics.timed('put_object'):
+                client.put_object(Body=_read(body, size, limiter), **params)
+            return
+
+        part_size = part_size or STREAM_PART_SIZE
+        with metrics.timed('create_multipart_upload'):
+            upload_id = client.create_multipart_upload(**params)['UploadId']
+        try:
+            parts = []
+            for number in range(1, -(-size // part_size) + 1):
+                data = _read(body, part_size, limiter)
+                with metrics.timed('upload_part'):
+                    etag = client.upload_part(
+                        Bucket=dest.bucket_name, Key=dest_key,
+                        UploadId=upload_id, PartNumber=number,
+                        Body=data)['ETag']
+                parts.append({'PartNumber': number, 'ETag': etag})
+            with metrics.timed('complete_multipart_upload'):
+                client.complete_multipart_upload(
+                    Bucket=dest.bucket_name, Key=dest_key,
+                    UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            with metrics.timed('abort_multipart_upload'):
+                client.abort_multipart_upload(
+                    Bucket=dest.bucket_name, Key=dest_key,
+                    UploadId=upload_id)
+            raise
+    finally:
+        body.close()
+
+
+def stream_upload(upload, key, stream, content_type=None, max_size=None,
+                  part_size=STREAM_PART_SIZE):
+    '''Upload the data read from `stream`, of unknown length, to `key` in
+    the bucket of `upload`, sending each part of `part_size` bytes as soon as
+    it is read. A single part is read while the previous one is sent, so at
+    most two parts are held in memory, and data fitting in one part is sent
+    with a single request.
+
+    Raises `UploadTooLarge`, aborting the upload, as soon as more than
+    `max_size` bytes are read.
+
+    Returns the `size`, the `md5` and `sha256` hex digests and the `etag`
+    of the uploaded object.
+    '''
+    client = upload.get_s3_client()
+    params = {'Bucket': upload.bucket_name, 'Key': key, 'ACL': upload.acl,
+              'ContentType': content_type or 'application/octet-stream'}
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    read = [0]
+
+    def read_part():
+        limit = part_size
+        if max_size is not None:
+            # Reading a byte past the limit is enough to reject the upload
+            limit = min(limit, max_size - read[0] + 1)
+        data = _read(stream, limit)
+        read[0] += len(data)
+        if max_size is not None and read[0] > max_size:
+            raise UploadTooLarge(
+                'The upload is larger than {0} bytes'.format(max_size))
+        md5.update(data)
+        sha256.update(data)
+        return data
+
+    def result(etag):
+        metrics.add_uploaded_bytes(read[0])
+        return {'size': read[0], 'md5': md5.hexdigest(),
+                'sha256': sha256.hexdigest(), 'etag': etag.strip('"')}
+
+    data = read_part()
+    if len(data) < part_size:
+        with metrics.timed('put_object'):
+            etag = client.put_object(Body=data, **params)['ETag']
+        upload.invalidate(key)
+        return result(etag)
+
+    def send(number, data):
+        with metrics.timed('upload_part'):
+            etag = client.upload_part(
+                Bucket=upload.bucket_name, Key=key, UploadId=upload_id,
+                PartNumber=number, Body=data)['ETag']
+        return {'PartNumber': number, 'ETag': etag}
+
+    with metrics.timed('create_multipart_upload'):
+        upload_id = client.create_multipart_upload(**params)['UploadId']
+    try:
+        parts = []
+        number = 0
+        sending = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while data:
+                number += 1
+                if number > MAX_PARTS:
+                    raise UploadTooLarge(
+                        'The upload has more than {0} parts'.format(
+                            MAX_PARTS))
+                if sending is not None:
+                    parts.append(sending.result())
+                sending = executor.submit(send, number, data)
+                # Read the next part while this one is sent
+                data = read_part()
+            parts.append(sending.result())
+        with metrics.timed('complete_multipart_upload'):
+            response = client.complete_multipart_upload(
+                Bucket=upload.bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+    except Exception:
+        with metrics.timed('abort_multipart_upload'):
+            client.abort_multipart_upload(
+                Bucket=upload.bucket_name, Key=key, UploadId=upload_id)
+        raise
+    upload.invalidate(key)
+    return result(response['ETag'])
+
+
+def copy_object(source, dest, obj, dest_key, server_side=False,
+                limiter=None):
+    '''Copy the object `obj` (a `list_objects` entry) of the bucket of
+    `source` to `dest_key` in the bucket of `dest`. `limiter` only applies
+    to streamed copies, server-side copies not going through this host.'''
+    part_size = _part_size(source, obj['Key'], obj['ETag'])
+    if server_side:
+        dest.copy_key(obj['Key'], dest_key, source_bucket=source.bucket_name,
+                      part_size=part_size)
+    else:
+        _stream_copy(source, dest, obj, dest_key, part_size, limiter)
+        dest.invalidate(dest_key)
+
+
+def verify_copies(source, source_prefix, dest, dest_prefix):
+    '''Compare the objects under `source_prefix` with their copies under
+    `dest_prefix`, generating the `(key, problem)` of the missing or
+    different ones. Both listings are in key order, so they are merged
+    without keeping them in memory.'''
+    def objects(upload, prefix):
+        for page in list_objects(upload, prefix):
+            for obj in page:
+                yield obj['Key'][len(prefix):], obj
+
+    copies = objects(dest, dest_prefix)
+    copy_name, copy = next(copies, (None, None))
+    for name, obj in objects(source, source_prefix):
+        while copy is not None and copy_name < name:
+            copy_name, copy = next(copies, (None, None))
+        if copy is None or copy_name != name:
+            yield obj['Key'], 'missing'
+        elif copy['Size'] != obj['Size']:
+            yield obj['Key'], 'size {0} instead of {1}'.format(
+                copy['Size'], obj['Size'])
+        elif copy['ETag'] != obj['ETag'] and _head_object(
+                dest, copy['Key']).get('Metadata', {}).get(SOURCE_ETAG) \
+                != obj['ETag']:
+            yield obj['Key'], 'checksum {0} instead of {1}'.format(
+                copy['ETag'], obj['ETag'])
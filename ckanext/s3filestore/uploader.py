@@ -1,20 +1,32 @@
 import os
 import re
 import cgi
+import hashlib
+import shutil
 import logging
 import datetime
+import tempfile
 import mimetypes
-import magic
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-import botocore
-from botocore.client import Config as BotoConfig
+# boto3, the botocore session and client machinery and magic are imported on
+# first use, so that loading the plugin doesn't slow down every CKAN command
 from botocore.exceptions import ClientError
 import ckantoolkit as toolkit
 
 import ckan.model as model
 import ckan.lib.munge as munge
 
+from ckanext.s3filestore import compression, metrics, profiling
+from ckanext.s3filestore.breaker import CircuitOpenError, get_breaker
+from ckanext.s3filestore.cache import (
+    LRUCache,
+    get_metadata_cache,
+    reset_metadata_caches,
+)
+
 if toolkit.check_ckan_version(min_version='2.7.0'):
     from werkzeug.datastructures import FileStorage as FlaskFileStorage
     ALLOWED_UPLOAD_TYPES = (cgi.FieldStorage, FlaskFileStorage)
@@ -30,6 +42,56 @@ _max_image_size = None
 
 URL_HOST = re.compile('^https?://[^/]*/')
 
+# s3_upload_status of the resources uploaded by a background job
+UPLOAD_PENDING = 'pending'
+UPLOAD_COMPLETE = 'complete'
+UPLOAD_FAILED = 'failed'
+
+# Largest object copy_object can copy, and most parts of a multipart upload
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+MAX_MULTIPART_PARTS = 10000
+# Smallest part of a multipart upload, but for the last one
+MIN_MULTIPART_PART_SIZE = 5 * 1024 ** 2
+
+# Signed URLs handed out recently, served while the circuit breaker is open
+_signed_urls = LRUCache('signed_url', max_size=10000)
+
+# Objects found at their partitioned key by resolve_key. Objects found at
+# their legacy key aren't cached, as they are about to be moved.
+_resolved_keys = LRUCache('resolved_key', max_size=10000, ttl=300)
+
+# Field of the resources recording the routing target their file was
+# uploaded to, '' for the default bucket
+TARGET_FIELD = 's3_target'
+
+# Files staged for a background upload by each thread, see _staged_uploads
+_staged = threading.local()
+
+# Routing target of each package, '' for the default bucket. Entries only
+# route the files uploaded next, the resources being pinned to their target,
+# so other processes may route them to the previous target until they expire.
+_package_targets = LRUCache('bucket_target', max_size=10000, ttl=300)
+
+# Options of a routing target or replica, defaulting to the attribute of the
+# configured bucket
+TARGET_OPTIONS = {
+    'bucket_name': 'bucket_name',
+    'region_name': 'region',
+    'host_name': 'host_name',
+    'download_proxy': 'download_proxy',
+    'acl': 'acl',
+    'aws_access_key_id': 'p_key',
+    'aws_secret_access_key': 's_key',
+    'aws_access_key_id_readonly': 'p_key_readonly',
+    'aws_secret_access_key_readonly': 's_key_readonly',
+}
+
+# Sessions and clients are expensive to create and clients are thread-safe,
+# so they are shared by the whole process, keyed by their settings.
+_sessions = {}
+_clients = {}
+_pool_lock = threading.Lock()
+
 
 def _get_underlying_file(wrapper):
     if isinstance(wrapper, FlaskFileStorage):
@@ -37,13 +99,259 @@ def _get_underlying_file(wrapper):
     return wrapper.file
 
 
+def _optional(value, type_=int):
+    '''Convert an optional config value, keeping None when it is unset.'''
+    return None if value in (None, '') else type_(value)
+
+
+def get_max_resource_size():
+    '''Return the largest size of resource files in bytes, from
+    `ckan.max_resource_size` in MB.'''
+    return int(config.get('ckan.max_resource_size', 10)) * 1024 * 1024
+
+
+def get_max_image_size():
+    '''Return the largest size of uploaded images in bytes, from
+    `ckan.max_image_size` in MB.'''
+    return int(config.get('ckan.max_image_size', 2)) * 1024 * 1024
+
+
+def check_size(size, max_size, field='upload'):
+    '''Raise a `ValidationError` on `field` if `size` bytes are over
+    `max_size` bytes.'''
+    if max_size is not None and size > max_size:
+        raise toolkit.ValidationError({field: ['File upload too large']})
+
+
+def max_part_number(max_size):
+    '''Return the highest part number of a multipart upload of at most
+    `max_size` bytes, as all the parts but the last one are at least 5 MB.'''
+    return min(MAX_MULTIPART_PARTS, max_size // MIN_MULTIPART_PART_SIZE + 1)
+
+
+def partition_prefix(name, levels):
+    '''Return the `levels` shards of the key prefix of `name`, two hex
+    digits of its MD5 digest each, e.g. ``3f/a2`` for two levels. Spreading
+    the keys over distinct prefixes raises the request rate S3 can sustain
+    before throttling.'''
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return '/'.join(digest[2 * i:2 * i + 2] for i in range(levels))
+
+
+def get_targets():
+    '''Return the names of the configured routing targets.'''
+    return toolkit.aslist(config.get('ckanext.s3filestore.targets', ''))
+
+
+def get_package_target(package_id):
+    '''Return the name of the routing target of the package `package_id`
+    (or name), or None if its files go to the default bucket.
+
+    Targets listing the package in their ``packages`` option take precedence
+    over the ones listing its organization in their ``organizations``
+    option. Lookups are cached for a few minutes.'''
+    targets = get_targets()
+    if not package_id or not targets:
+        return None
+    target = _package_targets.get(package_id)
+    if target is not None:
+        return target or None
+
+    target = ''
+    package = model.Package.get(package_id)
+    if package is not None:
+        names = set([package.id, package.name])
+        org = model.Group.get(package.owner_org) \
+            if package.owner_org else None
+        org_names = set([org.id, org.name]) if org else set()
+        for option, matched in (('packages', names),
+                                ('organizations', org_names)):
+            target = next((name for name in targets if matched & set(
+                toolkit.aslist(config.get('ckanext.s3filestore.target.'
+                                          '{0}.{1}'.format(name, option),
+                                          '')))), '')
+            if target:
+                break
+    _package_targets.set(package_id, target)
+    return target or None
+
+
+def forget_package_target(package_id, name=None):
+    '''Drop the cached routing target of a package, e.g. once it moved to
+    another organization.'''
+    for key in (package_id, name):
+        if key:
+            _package_targets.delete(key)
+
+
+def get_resource_target(resource):
+    '''Return the name of the routing target of the `resource` dict: the
+    target its file was uploaded to, recorded in its `TARGET_FIELD`, so that
+    it is still found once its package is routed elsewhere, else the current
+    target of its package, see `get_package_target`.'''
+    if resource.get(TARGET_FIELD) is not None:
+        return resource[TARGET_FIELD] or None
+    if not get_targets():
+        return None
+    resource_obj = model.Resource.get(resource['id']) \
+        if resource.get('id') else None
+    if resource_obj is not None and \
+            resource_obj.extras.get(TARGET_FIELD) is not None:
+        # The field was dropped by a resource_update or package_update
+        return resource_obj.extras[TARGET_FIELD] or None
+    package_id = resource.get('package_id') or \
+        (resource_obj.package_id if resource_obj else None)
+    return get_package_target(package_id)
+
+
+def resource_uploaders():
+    '''Return a function returning the uploader of the bucket of a resource
+    dict, see `get_resource_target`, creating one per routing target on first
+    use, for the resources of a batch.'''
+    uploaders = {}
+
+    def get_uploader(resource):
+        target = get_resource_target(resource)
+        if target not in uploaders:
+            uploaders[target] = S3ResourceUploader(
+                {TARGET_FIELD: target or ''})
+        return uploaders[target]
+    return get_uploader
+
+
+def _async_upload_min_size():
+    '''Return the size in bytes from which uploads are sent to S3 in the
+    background, None if they never are.'''
+    if not toolkit.asbool(config.get('ckanext.s3filestore.async_uploads',
+                                     False)):
+        return None
+    return float(config.get(
+        'ckanext.s3filestore.async_upload_min_size', 10)) * 1024 * 1024
+
+
+def _staging_dir():
+    '''Return the directory of the files staged for a background upload,
+    shared with the workers running the jobs.'''
+    directory = config.get('ckanext.s3filestore.async_upload_dir') or \
+        os.path.join(config.get('ckan.storage_path') or
+                     tempfile.gettempdir(), 's3filestore-pending')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def staging_file_stream(total_content_length):
+    '''Return a file in the staging directory to receive a file uploaded
+    with a request of `total_content_length` bytes which may be sent to S3
+    in the background, None otherwise.
+
+    The staged file is then a link to it instead of a copy, see
+    `_stage_file`.'''
+    min_size = _async_upload_min_size()
+    if min_size is None or (total_content_length is not None and
+                            total_content_length < min_size):
+        return None
+    return tempfile.NamedTemporaryFile('wb+', prefix='request-',
+                                       dir=_staging_dir())
+
+
+def _stage_file(upload_file, prefix):
+    '''Stage `upload_file` in the staging directory, returning its path.
+
+    A file already on disk on the same filesystem is hard linked rather than
+    copied, keeping the request from writing a large upload twice.'''
+    directory = _staging_dir()
+    source = getattr(upload_file, 'name', None)
+    if isinstance(source, str) and os.path.isfile(source):
+        path = os.path.join(directory, prefix + uuid.uuid4().hex)
+        try:
+            upload_file.flush()
+            os.link(source, path)
+            return path
+        except (OSError, AttributeError):
+            # On another filesystem, or not a writable file
+            pass
+    fd, path = tempfile.mkstemp(prefix=prefix, dir=directory)
+    with os.fdopen(fd, 'wb') as staged:
+        upload_file.seek(0)
+        shutil.copyfileobj(upload_file, staged, 1024 * 1024)
+    return path
+
+
+def _staged_uploads():
+    '''Return the job arguments of the files staged by this thread for a
+    background upload, by resource id.'''
+    if not hasattr(_staged, 'uploads'):
+        _staged.uploads = {}
+    return _staged.uploads
+
+
+def enqueue_staged_upload(resource_id=None):
+    '''Enqueue the background upload of the file staged by this thread for
+    the resource `resource_id`, or of all of them.
+
+    Called once the resource is committed, from the after_resource_create
+    and after_resource_update hooks, so that the job finds it. The files
+    staged by other actions are enqueued at the end of the request, the job
+    waiting for their resource and dropping the file if it never shows up,
+    e.g. as the request failed.'''
+    from ckanext.s3filestore import jobs
+
+    uploads = _staged_uploads()
+    for key in [resource_id] if resource_id else list(uploads):
+        args = uploads.pop(key, None)
+        if args is None:
+            continue
+        toolkit.enqueue_job(
+            jobs.upload_resource_file, args,
+            title='Upload {0} to S3'.format(args[2]),
+            queue=config.get('ckanext.s3filestore.async_upload_queue',
+                             'default'),
+            rq_kwargs={'timeout': int(config.get(
+                'ckanext.s3filestore.async_upload_timeout', 3600))})
+        log.info('Enqueued the upload of {0} to S3'.format(args[2]))
+
+
+def discard_staged_upload(resource_id=None):
+    '''Remove the file staged by this thread for the resource
+    `resource_id`, or all of them, which were not enqueued yet.'''
+    uploads = _staged_uploads()
+    for key in [resource_id] if resource_id else list(uploads):
+        args = uploads.pop(key, None)
+        if args is None:
+            continue
+        try:
+            os.remove(args[3])
+        except OSError:
+            pass
+
+
+def reset_clients():
+    '''Forget the pooled sessions and clients, and the cached metadata of
+    their objects.'''
+    with _pool_lock:
+        _sessions.clear()
+        _clients.clear()
+    reset_metadata_caches()
+
+
+def get_metadata_cache_ttl():
+    '''Return how long in seconds the metadata of objects is cached.
+
+    The memory backends of the other processes keep serving the entries
+    invalidated by this one until they expire, hence a shorter default.'''
+    default = 30 if config.get('ckanext.s3filestore.metadata_cache') == \
+        'memory' else 300
+    return float(config.get('ckanext.s3filestore.metadata_cache_ttl',
+                            default))
+
+
 class S3FileStoreException(Exception):
     pass
 
 
 class BaseS3Uploader(object):
 
-    def __init__(self):
+    def __init__(self, target=None):
         self.bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
         self.p_key = config.get('ckanext.s3filestore.aws_access_key_id')
         self.s_key = config.get('ckanext.s3filestore.aws_secret_access_key')
@@ -62,11 +370,110 @@ class BaseS3Uploader(object):
         self.signed_url_expiry = \
             int(config.get('ckanext.s3filestore.signed_url_expiry', '60'))
         # Keep the default url expiry as 60 so that same URL cannot be reused
+        self.connect_timeout = _optional(
+            config.get('ckanext.s3filestore.connect_timeout'), float)
+        self.read_timeout = _optional(
+            config.get('ckanext.s3filestore.read_timeout'), float)
+        self.retry_mode = config.get('ckanext.s3filestore.retry_mode')
+        self.max_attempts = _optional(
+            config.get('ckanext.s3filestore.max_attempts'))
+        self.circuit_breaker = toolkit.asbool(
+            config.get('ckanext.s3filestore.circuit_breaker', False))
+        self.use_ami_role = toolkit.asbool(
+            config.get('ckanext.s3filestore.aws_use_ami_role', False))
+        self.metadata_endpoint = \
+            config.get('ckanext.s3filestore.metadata_endpoint', None)
+        self.credentials_refresh_margin = int(config.get(
+            'ckanext.s3filestore.credentials_refresh_margin', 1200))
+        self.copy_part_size = int(config.get(
+            'ckanext.s3filestore.copy_part_size', 512)) * 1024 * 1024
+        self.copy_workers = int(config.get(
+            'ckanext.s3filestore.copy_workers', 8))
+        self.key_partition_levels = int(config.get(
+            'ckanext.s3filestore.key_partition_levels', 0))
+        self.use_target(target)
+
+    def apply_options(self, prefix):
+        '''Override the bucket, endpoint and credentials settings by the
+        ones set under `prefix`, e.g. of a routing target or a replica.'''
+        for option, attribute in TARGET_OPTIONS.items():
+            value = config.get(prefix + option)
+            if value:
+                setattr(self, attribute, value)
+
+    def use_target(self, target):
+        '''Switch to the bucket of the routing `target`, or to the default
+        bucket if it is None.'''
+        self.target = target
+        if target:
+            self.apply_options(
+                'ckanext.s3filestore.target.{0}.'.format(target))
 
     def get_directory(self, id, storage_path):
         directory = os.path.join(storage_path, id)
         return directory
 
+    def _metadata_key(self, key):
+        return 'meta:{0}/{1}/{2}'.format(
+            self.host_name or '', self.bucket_name, key)
+
+    def head_object(self, key, read_only=True):
+        '''Return the ``size``, ``etag`` and ``content_type`` of the object
+        at `key`, from the metadata cache when it is enabled.
+
+        Raises the `ClientError` of S3 if there is no object at `key`,
+        missing objects not being cached as they can be uploaded directly
+        to S3 at any time.
+        '''
+        cache = get_metadata_cache()
+        if cache is not None:
+            metadata = cache.get(self._metadata_key(key))
+            if metadata is not None:
+                return metadata
+        with metrics.timed('head_object'):
+            head = self.get_s3_client(read_only=read_only).head_object(
+                Bucket=self.bucket_name, Key=key)
+        metadata = {'size': head['ContentLength'],
+                    'etag': head['ETag'].strip('"'),
+                    'content_type': head.get('ContentType')}
+        if cache is not None:
+            cache.set(self._metadata_key(key), metadata,
+                      get_metadata_cache_ttl())
+        return metadata
+
+    def invalidate(self, *keys):
+        '''Drop the cached metadata, and so the signed URLs, of the objects
+        at `keys` once they are changed or deleted.'''
+        cache = get_metadata_cache()
+        if cache is not None:
+            cache.delete(*[self._metadata_key(key) for key in keys])
+
+    def key_exists(self, key):
+        '''Return True if there is an object at `key`.'''
+        try:
+            self.head_object(key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                return False
+            raise
+        return True
+
+    def resolve_key(self, keys):
+        '''Return the first of the candidate `keys` of an object which
+        exists, e.g. its partitioned and legacy keys while objects are moved
+        from one layout to the other, or the first one if none exists.'''
+        if len(keys) == 1 or not toolkit.asbool(config.get(
+                'ckanext.s3filestore.legacy_key_fallback', True)):
+            # All the objects were moved to their current key
+            return keys[0]
+        cache_key = (self.bucket_name, keys[0])
+        if _resolved_keys.get(cache_key) is not None:
+            return keys[0]
+        if self.key_exists(keys[0]):
+            _resolved_keys.set(cache_key, True)
+            return keys[0]
+        return next((k for k in keys[1:] if self.key_exists(k)), keys[0])
+
     def generate_put_presigned_url(self, key, extra_params={}):
         '''
         Generates a pre-signed URL for HTTP PUT to upload an S3 object.
@@ -76,38 +483,138 @@ class BaseS3Uploader(object):
                 'Key': key
                 }
         params.update(extra_params)
-        url = client.generate_presigned_url(ClientMethod='put_object',
-                                            Params=params,
-                                            ExpiresIn=self.signed_url_expiry)
+        with metrics.timed('presign_put_object', s3_call=False):
+            url = client.generate_presigned_url(
+                ClientMethod='put_object',
+                Params=params,
+                ExpiresIn=self.signed_url_expiry)
         return url
 
-    def get_s3_session(self, read_only=False):
+    def _session_key(self, read_only=False):
         if read_only:
-            return boto3.session.Session(aws_access_key_id=self.p_key_readonly,
-                                         aws_secret_access_key=self.s_key_readonly,
+            keys = (self.p_key_readonly, self.s_key_readonly)
+        else:
+            keys = (self.p_key, self.s_key)
+        return keys + (self.region, self.use_ami_role,
+                       self.metadata_endpoint,
+                       self.credentials_refresh_margin)
+
+    def shares_endpoint(self, other):
+        '''Return True if the bucket of the uploader `other` is on the same
+        endpoint with the same credentials, so that its objects can be copied
+        server-side.'''
+        return (self.host_name, self._session_key()) == \
+            (other.host_name, other._session_key())
+
+    def _create_session(self, access_key, secret_key):
+        import boto3.session
+
+        if self.use_ami_role and not access_key:
+            import botocore.session
+            from ckanext.s3filestore.credentials import (
+                CachedRoleCredentialProvider,
+                get_role_credentials_cache,
+            )
+
+            # Serve the role credentials from the process-wide cache instead
+            # of going through the whole credential chain
+            botocore_session = botocore.session.get_session()
+            cache = get_role_credentials_cache(
+                self.metadata_endpoint, self.credentials_refresh_margin)
+            botocore_session.get_component('credential_provider')\
+                .insert_before('env', CachedRoleCredentialProvider(cache))
+            return boto3.session.Session(botocore_session=botocore_session,
                                          region_name=self.region)
-        return boto3.session.Session(aws_access_key_id=self.p_key,
-                                     aws_secret_access_key=self.s_key,
+        return boto3.session.Session(aws_access_key_id=access_key,
+                                     aws_secret_access_key=secret_key,
                                      region_name=self.region)
 
+    def get_s3_session(self, read_only=False):
+        '''Return the boto3 session shared by the process for the configured
+        credentials.'''
+        key = self._session_key(read_only)
+        with _pool_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = self._create_session(*key[:2])
+        return session
+
+    def get_boto_config(self):
+        '''Return the botocore config of the S3 clients, with the configured
+        timeouts and retry behaviour.'''
+        options = {
+            'signature_version': self.signature,
+            's3': {'addressing_style': self.addressing_style},
+        }
+        if self.connect_timeout is not None:
+            options['connect_timeout'] = self.connect_timeout
+        if self.read_timeout is not None:
+            options['read_timeout'] = self.read_timeout
+        retries = {}
+        if self.retry_mode:
+            retries['mode'] = self.retry_mode
+        if self.max_attempts is not None:
+            retries['max_attempts'] = self.max_attempts
+        if retries:
+            options['retries'] = retries
+        from botocore.client import Config as BotoConfig
+        return BotoConfig(**options)
+
+    def get_breaker(self):
+        '''Return the circuit breaker guarding the configured endpoint, or
+        None if it is disabled.'''
+        if not self.circuit_breaker:
+            return None
+        return get_breaker(
+            self.host_name or self.region,
+            failure_rate=float(config.get(
+                'ckanext.s3filestore.circuit_breaker.failure_rate', 0.5)),
+            min_calls=int(config.get(
+                'ckanext.s3filestore.circuit_breaker.min_calls', 20)),
+            window=float(config.get(
+                'ckanext.s3filestore.circuit_breaker.window', 30)),
+            reset_timeout=float(config.get(
+                'ckanext.s3filestore.circuit_breaker.reset_timeout', 30)))
+
     def get_s3_resource(self):
-        return \
-            self.get_s3_session()\
-                .resource('s3',
-                          endpoint_url=self.host_name,
-                          config=BotoConfig(
-                              signature_version=self.signature,
-                              s3={'addressing_style': self.addressing_style}))
+        '''Return a new boto3 S3 resource. Resources are not thread-safe so,
+        unlike clients, they are not shared.'''
+        with profiling.span('s3_client'):
+            session = self.get_s3_session()
+            # Sessions are not thread-safe either when creating resources
+            with _pool_lock:
+                s3 = session.resource('s3',
+                                      endpoint_url=self.host_name,
+                                      config=self.get_boto_config())
+            breaker = self.get_breaker()
+            if breaker:
+                breaker.register(s3.meta.client.meta.events)
+            return s3
 
     def get_s3_client(self, read_only=False):
-        return \
-            self.get_s3_session(read_only)\
-                .client('s3',
-                        endpoint_url=self.host_name,
-                        config=BotoConfig(
-                            signature_version=self.signature,
-                            s3={'addressing_style': self.addressing_style}),
-                        region_name=self.region)
+        '''Return the S3 client shared by the process for the configured
+        credentials, endpoint and client settings.'''
+        with profiling.span('s3_client'):
+            key = self._session_key(read_only) + (
+                self.host_name, self.signature, self.addressing_style,
+                self.connect_timeout, self.read_timeout, self.retry_mode,
+                self.max_attempts, self.circuit_breaker)
+            client = _clients.get(key)
+            if client is not None:
+                return client
+            session = self.get_s3_session(read_only)
+            with _pool_lock:
+                client = _clients.get(key)
+                if client is None:
+                    client = session.client('s3',
+                                            endpoint_url=self.host_name,
+                                            config=self.get_boto_config(),
+                                            region_name=self.region)
+                    breaker = self.get_breaker()
+                    if breaker:
+                        breaker.register(client.meta.events)
+                    _clients[key] = client
+            return client
 
     def get_s3_bucket(self, bucket_name):
         '''Return a boto bucket, creating it if it doesn't exist.'''
@@ -119,10 +626,11 @@ class BaseS3Uploader(object):
         try:
             # Validate the bucket when key doesn't have list bucket permission
             # By Putting the data into the bucket
-            s3.meta.client.put_object(
-                Bucket=bucket_name, Body='exist', Key='exist.txt')
+            with metrics.timed('put_object'):
+                s3.meta.client.put_object(
+                    Bucket=bucket_name, Body='exist', Key='exist.txt')
             log.debug('Bucket {0} found!'.format(bucket_name))
-        except botocore.exceptions.ClientError as e:
+        except ClientError as e:
             error_code = int(e.response['Error']['Code'])
             if error_code == 404:
                 log.warning('Bucket {0} could not be found, '
@@ -135,7 +643,7 @@ class BaseS3Uploader(object):
                                          })
                     log.info(
                         'Bucket {0} successfully created'.format(bucket_name))
-                except botocore.exceptions.ClientError as e:
+                except ClientError as e:
                     log.warning('Could not create bucket {0}: {1}'.format(
                         bucket_name, str(e)))
             elif error_code == 403:
@@ -155,26 +663,67 @@ class BaseS3Uploader(object):
         s3 = self.get_s3_resource()
 
         try:
-            s3.Object(self.bucket_name, filepath).put(
-                Body=upload_file.read(),
-                ACL='public-read' if make_public else self.acl,
-                ContentType=getattr(self, 'mimetype', '') or 'text/plain')
+            body = upload_file.read()
+            with metrics.timed('put_object'):
+                s3.Object(self.bucket_name, filepath).put(
+                    Body=body,
+                    ACL='public-read' if make_public else self.acl,
+                    ContentType=getattr(self, 'mimetype', '') or 'text/plain')
+            metrics.add_uploaded_bytes(len(body))
+            self.invalidate(filepath)
             log.info("Successfully uploaded {0} to S3!".format(filepath))
         except Exception as e:
             log.error('Something went very very wrong for {0}'.format(str(e)))
             raise e
 
+    def upload_compressed_variant(self, filepath, upload_file, encoding,
+                                  content_type=None):
+        '''Uploads the `encoding` compressed variant of `upload_file` next to
+        `filepath`, compressing it in a temporary file.'''
+
+        upload_file.seek(0)
+        compressed = compression.compress(upload_file, encoding)
+        key = compression.variant_key(filepath, encoding)
+        try:
+            with metrics.timed('put_object'):
+                self.get_s3_client().put_object(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    Body=compressed,
+                    ACL=self.acl,
+                    ContentType=content_type or 'text/plain',
+                    ContentEncoding=encoding)
+            metrics.add_uploaded_bytes(compressed.tell())
+            self.invalidate(key)
+            log.info("Successfully uploaded {0} to S3!".format(key))
+        finally:
+            compressed.close()
+
     def clear_key(self, filepath):
         '''Deletes the contents of the key at `filepath` on `self.bucket`.'''
 
         s3 = self.get_s3_resource()
 
         try:
-            s3.Object(self.bucket_name, filepath).delete()
+            with metrics.timed('delete_object'):
+                s3.Object(self.bucket_name, filepath).delete()
         except Exception as e:
             log.error('Something went very very wrong for {0}'.format(str(e)))
-
-    def get_signed_url_to_key(self, key, extra_params={}, read_only=False):
+        self.invalidate(filepath)
+
+    def get_object(self, key, byte_range=None):
+        '''Returns the S3 `get_object` response for `key`, its `Body` being
+        a stream the caller must read or close. `byte_range` is an optional
+        `(first, last)` tuple of inclusive byte offsets.'''
+        client = self.get_s3_client(read_only=True)
+        params = {'Bucket': self.bucket_name, 'Key': key}
+        if byte_range is not None:
+            params['Range'] = 'bytes={0}-{1}'.format(*byte_range)
+        with metrics.timed('get_object'):
+            return client.get_object(**params)
+
+    def get_signed_url_to_key(self, key, extra_params={}, read_only=False,
+                              check_exists=True, expires_in=None):
         '''Generates a pre-signed URL giving access to an S3 object.
 
         If a download_proxy is configured, then the URL will be
@@ -184,27 +733,76 @@ class BaseS3Uploader(object):
         will fail signature verification; the download_proxy server must
         be configured to set the Host header back to the true value when
         forwarding the request (CloudFront does this automatically).
+
+        While the circuit breaker is open, the URL handed out for the same
+        key in the last `signed_url_expiry` seconds is returned if there is
+        one, otherwise `CircuitOpenError` is raised.
+
+        With the metadata cache enabled, the URLs are reused as long as the
+        object is known to exist, for at most half of `expires_in`.
+
+        Pass `check_exists=False` to skip the HEAD request checking that the
+        object exists, e.g. when signing many keys known from the resources,
+        and `expires_in` to override the configured `signed_url_expiry`.
         '''
+        expires_in = expires_in or self.signed_url_expiry
         if read_only:
             # Use Read Only Key provided so that download can't alter file
             client = self.get_s3_client(read_only=True)
         else:
             client = self.get_s3_client()
-        # check whether the object exists in S3
-        client.head_object(Bucket=self.bucket_name, Key=key)
 
         params = {'Bucket': self.bucket_name,
                   'Key': key
                   }
 
         params.update(extra_params)
+        cache_key = (self.host_name, read_only,
+                     tuple(sorted(params.items())))
+
+        cache = get_metadata_cache()
+        metadata = None
 
-        url = client.generate_presigned_url(ClientMethod='get_object',
-                                            Params=params,
-                                            ExpiresIn=self.signed_url_expiry)
+        # check whether the object exists in S3
+        try:
+            if check_exists:
+                metadata = self.head_object(key, read_only=read_only)
+            elif cache is not None:
+                metadata = cache.get(self._metadata_key(key))
+        except CircuitOpenError:
+            url = _signed_urls.get(cache_key)
+            if url is None:
+                raise
+            log.info('S3 circuit breaker open, reusing the signed URL '
+                     'of {0}'.format(key))
+            return url
+
+        url_key = None
+        if cache is not None and metadata is not None:
+            # A new version of the object gets new URLs
+            url_key = 'url:' + hashlib.sha1(repr(
+                cache_key + (self.bucket_name, self.download_proxy,
+                             metadata['etag'], expires_in)
+            ).encode('utf-8')).hexdigest()
+            url = cache.get(url_key)
+            if url is not None:
+                return url
+
+        with metrics.timed('presign_get_object', s3_call=False):
+            url = client.generate_presigned_url(
+                ClientMethod='get_object',
+                Params=params,
+                ExpiresIn=expires_in)
         if self.download_proxy:
             url = URL_HOST.sub(self.download_proxy + '/', url, 1)
 
+        if self.circuit_breaker:
+            # Keep a safety margin so that a reused URL doesn't expire
+            # before the client follows it
+            _signed_urls.set(cache_key, url, ttl=expires_in * 0.8)
+        if url_key is not None:
+            cache.set(url_key, url, min(get_metadata_cache_ttl(),
+                                        expires_in / 2))
         return url
 
     # =============================================================================
@@ -232,14 +830,16 @@ class BaseS3Uploader(object):
         }
         
         try:
-            response = client.create_multipart_upload(**params)
+            with metrics.timed('create_multipart_upload'):
+                response = client.create_multipart_upload(**params)
             log.info(f"Created multipart upload for key: {key}, UploadId: {response['UploadId']}")
             return response
         except ClientError as e:
             log.error(f"Error creating multipart upload for key {key}: {str(e)}")
             raise e
 
-    def generate_multipart_presigned_url(self, key, upload_id, part_number, expires_in=3600):
+    def generate_multipart_presigned_url(self, key, upload_id, part_number, expires_in=3600,
+                                         content_length=None):
         '''
         Generate a presigned URL for uploading a specific part of a multipart upload.
         
@@ -248,6 +848,7 @@ class BaseS3Uploader(object):
             upload_id (str): The upload ID from create_multipart_upload
             part_number (int): The part number (1-based)
             expires_in (int): URL expiration time in seconds
+            content_length (int): Size of the part, enforced by S3 when set
             
         Returns:
             str: Presigned URL for uploading the part
@@ -260,13 +861,16 @@ class BaseS3Uploader(object):
             'UploadId': upload_id,
             'PartNumber': part_number
         }
+        if content_length is not None:
+            params['ContentLength'] = content_length
         
         try:
-            url = client.generate_presigned_url(
-                ClientMethod='upload_part',
-                Params=params,
-                ExpiresIn=expires_in
-            )
+            with metrics.timed('presign_upload_part', s3_call=False):
+                url = client.generate_presigned_url(
+                    ClientMethod='upload_part',
+                    Params=params,
+                    ExpiresIn=expires_in
+                )
             log.debug(f"Generated presigned URL for part {part_number} of upload {upload_id}")
             return url
         except ClientError as e:
@@ -295,13 +899,29 @@ class BaseS3Uploader(object):
         }
         
         try:
-            response = client.list_parts(**params)
+            with metrics.timed('list_parts'):
+                response = client.list_parts(**params)
             log.debug(f"Listed {len(response.get('Parts', []))} parts for upload {upload_id}")
             return response
         except ClientError as e:
             log.error(f"Error listing parts for upload {upload_id}: {str(e)}")
             raise e
 
+    def uploaded_size(self, key, upload_id):
+        '''Return the total size of the parts uploaded so far to the
+        multipart upload `upload_id`.'''
+        client = self.get_s3_client()
+        params = {'Bucket': self.bucket_name, 'Key': key,
+                  'UploadId': upload_id}
+        size = 0
+        while True:
+            with metrics.timed('list_parts'):
+                response = client.list_parts(**params)
+            size += sum(part['Size'] for part in response.get('Parts', []))
+            if not response.get('IsTruncated'):
+                return size
+            params['PartNumberMarker'] = response['NextPartNumberMarker']
+
     def complete_multipart_upload(self, key, upload_id, parts):
         '''
         Complete a multipart upload by assembling the uploaded parts.
@@ -346,7 +966,9 @@ class BaseS3Uploader(object):
         }
         
         try:
-            response = client.complete_multipart_upload(**params)
+            with metrics.timed('complete_multipart_upload'):
+                response = client.complete_multipart_upload(**params)
+            self.invalidate(key)
             log.info(f"Completed multipart upload for key: {key}, UploadId: {upload_id}")
             return response
         except ClientError as e:
@@ -373,13 +995,81 @@ class BaseS3Uploader(object):
         }
         
         try:
-            response = client.abort_multipart_upload(**params)
+            with metrics.timed('abort_multipart_upload'):
+                response = client.abort_multipart_upload(**params)
             log.info(f"Aborted multipart upload for key: {key}, UploadId: {upload_id}")
             return response
         except ClientError as e:
             log.error(f"Error aborting multipart upload {upload_id}: {str(e)}")
             raise e
 
+    def copy_key(self, source_key, key, source_bucket=None, part_size=None):
+        '''
+        Copy the object at `source_key` to `key` within the bucket, or from
+        another bucket of the same endpoint, without the data going through
+        CKAN.
+
+        Objects up to 5 GB are copied with a single `copy_object` request,
+        larger ones with `upload_part_copy` requests of
+        `ckanext.s3filestore.copy_part_size` MB sent in parallel.
+
+        Args:
+            source_key (str): The S3 key path of the object to copy
+            key (str): The S3 key path of the copy
+            source_bucket (str): Bucket of the object to copy, defaults to
+                the configured bucket
+            part_size (int): Copy in parts of this many bytes whatever the
+                size of the object, e.g. to keep the parts, and so the ETag,
+                of an object uploaded in several parts
+
+        Returns:
+            int: Size of the copied object in bytes
+        '''
+        client = self.get_s3_client()
+        source_bucket = source_bucket or self.bucket_name
+        copy_source = {'Bucket': source_bucket, 'Key': source_key}
+
+        with metrics.timed('head_object'):
+            head = client.head_object(Bucket=source_bucket, Key=source_key)
+        size = head['ContentLength']
+
+        if size <= MAX_COPY_OBJECT_SIZE and not part_size:
+            with metrics.timed('copy_object'):
+                client.copy_object(Bucket=self.bucket_name, Key=key,
+                                   CopySource=copy_source, ACL=self.acl,
+                                   MetadataDirective='COPY')
+            self.invalidate(key)
+            log.info(f"Copied {source_key} to {key}")
+            return size
+
+        # Parts can't be smaller than configured, nor more than 10000
+        part_size = part_size or max(self.copy_part_size,
+                                     -(-size // MAX_MULTIPART_PARTS))
+        upload_id = self.create_multipart_upload(
+            key, head.get('ContentType', 'application/octet-stream'))['UploadId']
+
+        def copy_part(part_number):
+            start = (part_number - 1) * part_size
+            end = min(start + part_size, size) - 1
+            with metrics.timed('upload_part_copy'):
+                response = client.upload_part_copy(
+                    Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                    PartNumber=part_number, CopySource=copy_source,
+                    CopySourceRange=f"bytes={start}-{end}")
+            return {'PartNumber': part_number,
+                    'ETag': response['CopyPartResult']['ETag']}
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.copy_workers) as executor:
+                parts = list(executor.map(
+                    copy_part, range(1, -(-size // part_size) + 1)))
+            self.complete_multipart_upload(key, upload_id, parts)
+        except Exception:
+            self.abort_multipart_upload(key, upload_id)
+            raise
+        log.info(f"Copied {source_key} to {key} in {len(parts)} parts")
+        return size
+
 
 class S3Uploader(BaseS3Uploader):
     '''
@@ -402,14 +1092,44 @@ class S3Uploader(BaseS3Uploader):
         self.filename = None
         self.filepath = None
 
+        self.upload_to = upload_to
         self.old_filename = old_filename
-        if old_filename:
+        if old_filename and not old_filename.startswith('http'):
+            self.old_filepath = self.resolve_key(
+                self.get_keys(upload_to, old_filename))
+        elif old_filename:
             self.old_filepath = os.path.join(self.storage_path, old_filename)
 
     @classmethod
-    def get_storage_path(cls, upload_to):
+    def get_storage_path(cls, upload_to, filename=None, levels=None):
+        '''Return the directory of the files uploaded to `upload_to`:
+        <ckanext.s3filestore.aws_storage_path>/storage/uploads/<upload_to>/
+
+        With `ckanext.s3filestore.key_partition_levels` (or `levels`) set,
+        the directory of `filename` has that many shards derived from the
+        filename appended, e.g. storage/uploads/group/3f/a2/
+        '''
         path = config.get('ckanext.s3filestore.aws_storage_path', '')
-        return os.path.join(path, 'storage', 'uploads', upload_to)
+        directory = os.path.join(path, 'storage', 'uploads', upload_to)
+        if levels is None:
+            levels = int(config.get(
+                'ckanext.s3filestore.key_partition_levels', 0))
+        if filename and levels:
+            directory = os.path.join(directory,
+                                     partition_prefix(filename, levels))
+        return directory
+
+    @classmethod
+    def get_keys(cls, upload_to, filename):
+        '''Return the key of `filename`, followed by its legacy key when the
+        keys are partitioned.'''
+        keys = [os.path.join(cls.get_storage_path(upload_to, filename),
+                             filename)]
+        legacy = os.path.join(cls.get_storage_path(upload_to, levels=0),
+                              filename)
+        if legacy not in keys:
+            keys.append(legacy)
+        return keys
 
     def update_data_dict(self, data_dict, url_field, file_field, clear_field):
         '''Manipulate data from the data_dict. This needs
@@ -439,9 +1159,14 @@ class S3Uploader(BaseS3Uploader):
             self.filename = munge.munge_filename_legacy(self.filename)
             self.mimetype = mimetypes.guess_type(
                 self.filename, strict=False)[0]
-            self.filepath = os.path.join(self.storage_path, self.filename)
+            self.filepath = self.get_keys(self.upload_to, self.filename)[0]
             data_dict[url_field] = self.filename
             self.upload_file = _get_underlying_file(self.upload_field_storage)
+            self.upload_file.seek(0, os.SEEK_END)
+            self.filesize = self.upload_file.tell()
+            self.upload_file.seek(0, os.SEEK_SET)
+            # Reject oversized files before anything is stored
+            check_size(self.filesize, get_max_image_size(), file_field)
         # keep the file if there has been no change
         elif self.old_filename and not self.old_filename.startswith('http'):
             if not self.clear:
@@ -460,6 +1185,8 @@ class S3Uploader(BaseS3Uploader):
         # If a filename has been provided (a file is being uploaded) write the
         # file to the appropriate key in the AWS bucket.
         if self.filename:
+            check_size(self.filesize, max_size * 1024 * 1024,
+                       self.file_field)
             self.upload_to_key(self.filepath, self.upload_file)
             self.clear = True
 
@@ -470,7 +1197,7 @@ class S3Uploader(BaseS3Uploader):
     def delete(self, filename):
         ''' Delete file we are pointing at'''
         filename = munge.munge_filename_legacy(filename)
-        key_path = os.path.join(self.storage_path, filename)
+        key_path = self.resolve_key(self.get_keys(self.upload_to, filename))
         try:
             self.clear_key(key_path)
         except ClientError:
@@ -493,18 +1220,25 @@ class S3ResourceUploader(BaseS3Uploader):
         <ckanext.s3filestore.aws_storage_path>/resources/
         '''
 
-        super(S3ResourceUploader, self).__init__()
+        super(S3ResourceUploader, self).__init__(
+            target=get_resource_target(resource))
+        if get_targets() and (
+                resource.get('url_type') == 'upload' or
+                isinstance(resource.get('upload'), ALLOWED_UPLOAD_TYPES)):
+            # Pin the resource to the bucket of its file
+            resource[TARGET_FIELD] = self.target or ''
 
         path = config.get('ckanext.s3filestore.aws_storage_path', '')
         self.storage_path = os.path.join(path, 'resources')
         self.filename = None
         self.old_filename = None
+        self.compression = None
+        self.old_compression = None
+        self.async_upload = False
 
         upload_field_storage = resource.pop('upload', None)
         self.clear = resource.pop('clear_upload', None)
 
-        mime = magic.Magic(mime=True)
-
         if bool(upload_field_storage) and \
                 isinstance(upload_field_storage, ALLOWED_UPLOAD_TYPES):
             self.filesize = 0  # bytes
@@ -525,10 +1259,16 @@ class S3ResourceUploader(BaseS3Uploader):
             self.filesize = self.upload_file.tell()
             # go back to the beginning of the file buffer
             self.upload_file.seek(0, os.SEEK_SET)
+            # Reject oversized files before anything is stored
+            check_size(self.filesize, get_max_resource_size())
+
+            self._flag_async_upload(resource)
 
             self.mimetype = resource.get('mimetype')
             if not self.mimetype:
+                import magic
                 try:
+                    mime = magic.Magic(mime=True)
                     # Pass 2048 bytes to ensure MS Office file types e.g: XLSX
                     # are not classified as application/zip
                     self.mimetype = \
@@ -547,15 +1287,42 @@ class S3ResourceUploader(BaseS3Uploader):
 
                 except Exception:
                     pass
+
+            self._flag_compression(resource)
         elif self.clear and resource.get('id'):
             # New, not yet created resources can be marked for deletion if the
             # users cancels an upload and enters a URL instead.
             old_resource = model.Session.query(model.Resource) \
                 .get(resource['id'])
             self.old_filename = old_resource.url
+            self.old_compression = old_resource.extras.get('s3_compression')
             resource['url_type'] = ''
-
-    def get_path(self, id, filename):
+            if self.old_compression:
+                resource['s3_compression'] = ''
+
+    def _flag_async_upload(self, resource):
+        '''Flag the resource as pending if its file is large enough to be
+        sent to S3 by a background job.'''
+        min_size = _async_upload_min_size()
+        self.async_upload = min_size is not None and \
+            self.filesize >= min_size
+        if self.async_upload:
+            resource['s3_upload_status'] = UPLOAD_PENDING
+            resource['s3_upload_progress'] = 0
+            resource['s3_upload_error'] = ''
+        elif resource.get('s3_upload_status'):
+            resource['s3_upload_status'] = ''
+
+    def _flag_compression(self, resource):
+        '''Flag the resource if its file gets a compressed variant, clearing
+        the flag of a previous upload.'''
+        encoding = compression.get_encoding()
+        if encoding and compression.should_compress(self.mimetype):
+            self.compression = encoding
+        if encoding or resource.get('s3_compression'):
+            resource['s3_compression'] = self.compression or ''
+
+    def get_path(self, id, filename, levels=None):
         '''Return the key used for this resource in S3.
 
         Keys are in the form:
@@ -563,19 +1330,56 @@ class S3ResourceUploader(BaseS3Uploader):
 
         e.g.:
         my_storage_path/resources/165900ba-3c60-43c5-9e9c-9f8acd0aa93f/data.csv
+
+        With `ckanext.s3filestore.key_partition_levels` (or `levels`) set,
+        that many shards derived from the resource id come first, e.g.:
+        my_storage_path/resources/3f/a2/165900ba-3c60-43c5-9e9c-9f8acd0aa93f/data.csv
         '''
-        directory = self.get_directory(id, self.storage_path)
+        if levels is None:
+            levels = self.key_partition_levels
+        storage_path = self.storage_path
+        if levels:
+            storage_path = os.path.join(storage_path,
+                                        partition_prefix(id, levels))
+        directory = self.get_directory(id, storage_path)
         filepath = os.path.join(directory, filename)
         return filepath
 
+    def get_paths(self, id, filename):
+        '''Return the key of the resource, followed by its legacy key when
+        the keys are partitioned.'''
+        paths = [self.get_path(id, filename)]
+        legacy = self.get_path(id, filename, levels=0)
+        if legacy not in paths:
+            paths.append(legacy)
+        return paths
+
+    def resolve_path(self, id, filename):
+        '''Return the key of the existing object of the resource, which may
+        still be at its legacy key when the keys are partitioned.'''
+        return self.resolve_key(self.get_paths(id, filename))
+
     def upload(self, id, max_size=10):
         '''Upload the file to S3.'''
 
         # If a filename has been provided (a file is being uploaded) write the
         # file to the appropriate key in the AWS bucket.
         if self.filename:
+            check_size(self.filesize, max_size * 1024 * 1024)
+        if self.filename and self.async_upload:
+            self.enqueue_upload(id, self.get_path(id, self.filename))
+        elif self.filename:
             filepath = self.get_path(id, self.filename)
             self.upload_to_key(filepath, self.upload_file)
+            if self.compression:
+                try:
+                    self.upload_compressed_variant(
+                        filepath, self.upload_file, self.compression,
+                        self.mimetype)
+                except Exception as e:
+                    # Downloads fall back to the original object
+                    log.error('Could not upload the compressed variant of '
+                              '{0}: {1}'.format(filepath, e))
 
         # The resource form only sets self.clear (via the input clear_upload)
         # to True when an uploaded file is not replaced by another uploaded
@@ -583,8 +1387,24 @@ class S3ResourceUploader(BaseS3Uploader):
         # replaced by a link, we should remove the previously uploaded file to
         # clean up the file system.
         if self.clear and self.old_filename:
-            filepath = self.get_path(id, self.old_filename)
-            self.clear_key(filepath)
+            for filepath in self.get_paths(id, self.old_filename):
+                self.clear_key(filepath)
+                if self.old_compression:
+                    self.clear_key(compression.variant_key(
+                        filepath, self.old_compression))
+
+    def enqueue_upload(self, id, filepath):
+        '''Stage the uploaded file in the directory shared with the
+        background workers, for the job uploading it to `filepath`. The job
+        is only enqueued once the resource is committed, see
+        `enqueue_staged_upload`.'''
+        path = _stage_file(self.upload_file, id + '-')
+
+        # A file staged earlier for the resource was never committed
+        discard_staged_upload(id)
+        _staged_uploads()[id] = [id, self.target, filepath, path,
+                                 self.filename, self.mimetype,
+                                 self.compression]
 
     def delete(self, id, filename=None):
         ''' Delete file we are pointing at'''
@@ -592,9 +1412,13 @@ class S3ResourceUploader(BaseS3Uploader):
         if filename is None:
             filename = os.path.basename(self.url)
         filename = munge.munge_filename(filename)
-        key_path = self.get_path(id, filename)
+        key_path = self.resolve_path(id, filename)
         try:
             self.clear_key(key_path)
+            if compression.get_encoding():
+                for encoding in compression.EXTENSIONS:
+                    self.clear_key(
+                        compression.variant_key(key_path, encoding))
         except ClientError:
             log.warning('Key {0} not found in bucket {1} for delete'
                         .format(key_path, self.bucket_name))
@@ -605,12 +1429,16 @@ def delete_from_bucket(data_dict):
     filename = os.path.basename(data_dict.get('url'))
     filename = munge.munge_filename(filename)
     _id = data_dict.get('id')
-    key_path = S3ResourceUploader(data_dict).get_path(_id, filename)
+    encoding = data_dict.get('s3_compression')
+    upload = S3ResourceUploader(data_dict)
+    key_path = upload.resolve_path(_id, filename)
     try:
-        S3ResourceUploader(data_dict).clear_key(key_path)
+        upload.clear_key(key_path)
+        if encoding:
+            upload.clear_key(compression.variant_key(key_path, encoding))
     except ClientError:
         log.warning('Key {0} not found in bucket {1} for delete'
-                    .format(key_path, S3ResourceUploader().bucket_name))
+                    .format(key_path, upload.bucket_name))
         pass
     except Exception:
         pass
@@ -0,0 +1,119 @@
+# encoding: utf-8
+import os
+import logging
+
+import flask
+from botocore.exceptions import ClientError
+
+from ckantoolkit import _, request, c
+import ckan.logic as logic
+import ckan.lib.base as base
+
+import ckan.model as model
+
+from ckanext.s3filestore import archive, metrics
+from ckanext.s3filestore.breaker import CircuitOpenError
+from ckanext.s3filestore.uploader import resource_uploaders
+
+log = logging.getLogger(__name__)
+
+Blueprint = flask.Blueprint
+NotFound = logic.NotFound
+NotAuthorized = logic.NotAuthorized
+get_action = logic.get_action
+abort = base.abort
+
+
+s3_dataset = Blueprint(
+    u's3_dataset',
+    __name__,
+    url_prefix=u'/dataset',
+    url_defaults={u'package_type': u'dataset'}
+)
+
+
+def _selected_entries(pkg, after):
+    '''Return the archive entries of the uploaded resources of `pkg`,
+    following the resource `after` if given, aborting if there are none.'''
+    entries = archive.archive_entries(pkg.get('resources', []))
+    if after:
+        try:
+            entries = archive.skip_entries(entries, after)
+        except ValueError:
+            abort(400, _('Resource %s is not part of the dataset') % after)
+    if not entries and not after:
+        abort(404, _('The dataset has no uploaded files'))
+    return entries
+
+
+def _entry_opener(entries):
+    '''Return a function opening the object of a resource of `entries`,
+    returning its size and body.
+
+    The first object is opened right away, aborting before anything is sent
+    if it can't be read.'''
+    # The files stay in the bucket they were uploaded to
+    get_uploader = resource_uploaders()
+
+    def open_entry(resource):
+        upload = get_uploader(resource)
+        response = upload.get_object(upload.resolve_path(
+            resource['id'], os.path.basename(resource['url'])))
+        return response['ContentLength'], response['Body']
+
+    try:
+        first = open_entry(entries[0][0]) if entries else None
+    except CircuitOpenError:
+        abort(503, _('The file storage is temporarily unavailable'))
+    except ClientError as ex:
+        if ex.response['Error']['Code'] in ['NoSuchKey', '404']:
+            abort(404, _('Resource data not found'))
+        raise ex
+
+    def open_prefetched(resource):
+        if first is not None and resource is entries[0][0]:
+            return first
+        return open_entry(resource)
+    return open_prefetched
+
+
+@metrics.timed_view('dataset_zip_download')
+def dataset_zip_download(package_type, id):
+    '''
+    Stream a ZIP archive of all the uploaded resources of the dataset.
+
+    The entries follow the order of the resources, and `?after=<resource id>`
+    only includes the resources following the given one, to resume an
+    interrupted download.
+    '''
+    context = {'model': model, 'session': model.Session,
+               'user': c.user or c.author, 'auth_user_obj': c.userobj}
+
+    try:
+        pkg = get_action('package_show')(context, {'id': id})
+    except NotFound:
+        return abort(404, _('Dataset not found'))
+    except NotAuthorized:
+        return abort(401, _('Unauthorized to read dataset %s') % id)
+
+    after = request.args.get(u'after')
+    entries = _selected_entries(pkg, after)
+    open_entry = _entry_opener(entries)
+
+    filename = u'{0}.zip'.format(pkg['name'])
+    if after:
+        filename = u'{0}-after-{1}.zip'.format(pkg['name'], after)
+    response = flask.Response(
+        flask.stream_with_context(archive.stream_zip(entries, open_entry)),
+        mimetype=u'application/zip')
+    response.headers[u'Content-Disposition'] = \
+        u'attachment; filename="{0}"'.format(filename)
+    return response
+
+
+s3_dataset.add_url_rule(u'/<id>/download.zip',
+                        view_func=dataset_zip_download)
+
+
+def get_blueprints():
+    return [s3_dataset]
@@ -0,0 +1,69 @@
+# encoding: utf-8
+import logging
+import ipaddress
+
+import flask
+
+import ckantoolkit as toolkit
+from ckantoolkit import config as ckan_config
+
+from ckanext.s3filestore import metrics
+
+
+Blueprint = flask.Blueprint
+log = logging.getLogger(__name__)
+
+s3_metrics = Blueprint(
+    u's3_metrics',
+    __name__
+)
+
+
+def _is_allowed(request):
+    '''Return True if the requester may read the metrics: a sysadmin, or a
+    client whose address is in ``ckanext.s3filestore.metrics_allowed_ips``,
+    by default the local host only.'''
+    userobj = toolkit.g.get('userobj')
+    if userobj is not None and userobj.sysadmin:
+        return True
+    if not request.remote_addr:
+        return False
+    try:
+        address = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        return False
+    for network in toolkit.aslist(ckan_config.get(
+            'ckanext.s3filestore.metrics_allowed_ips', '127.0.0.1 ::1')):
+        try:
+            if address in ipaddress.ip_network(network, strict=False):
+                return True
+        except ValueError:
+            log.warning('Invalid network {0} in '
+                        'ckanext.s3filestore.metrics_allowed_ips'.format(
+                            network))
+    return False
+
+
+def metrics_endpoint():
+    '''Expose the collected metrics in the Prometheus text format.'''
+    if not _is_allowed(flask.request):
+        return toolkit.abort(403, toolkit._('Not authorized to see the '
+                                            'metrics'))
+    payload, content_type = metrics.generate_latest()
+    return flask.Response(payload, content_type=content_type)
+
+
+s3_metrics.add_url_rule(u'/s3filestore/metrics',
+                        view_func=metrics_endpoint)
+
+
+def get_blueprints():
+    if not toolkit.asbool(
+            ckan_config.get('ckanext.s3filestore.metrics_enabled', False)):
+        return []
+    if not metrics.is_available():
+        log.warning('ckanext.s3filestore.metrics_enabled is set but '
+                    'prometheus_client is not installed, the metrics '
+                    'endpoint is disabled')
+        return []
+    return [s3_metrics]
@@ -0,0 +1,21 @@
+# encoding: utf-8
+import flask
+
+from ckanext.s3filestore import profiling
+
+
+Blueprint = flask.Blueprint
+
+s3_profiling = Blueprint(
+    u's3_profiling',
+    __name__
+)
+
+s3_profiling.before_app_request(profiling.start_request)
+s3_profiling.after_app_request(profiling.finish_request)
+
+
+def get_blueprints():
+    if not profiling.is_enabled():
+        return []
+    return [s3_profiling]
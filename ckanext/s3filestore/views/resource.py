@@ -1,6 +1,7 @@
 # encoding: utf-8
 import os
 import logging
+import datetime
 import mimetypes
 
 import flask
@@ -12,16 +13,25 @@ from ckantoolkit import _, request, c, g
 import ckantoolkit as toolkit
 import ckan.logic as logic
 import ckan.lib.base as base
+import ckan.lib.munge as munge
 import ckan.lib.uploader as uploader
 from ckan.lib.uploader import get_storage_path
 
 import ckan.model as model
+from ckan.model.types import make_uuid
+
+from ckanext.s3filestore import (
+    compression, metrics, profiling, replicas, transfer)
+from ckanext.s3filestore.breaker import CircuitOpenError
+from ckanext.s3filestore.uploader import (
+    TARGET_FIELD, UPLOAD_PENDING, get_max_resource_size, get_targets)
 
 log = logging.getLogger(__name__)
 
 Blueprint = flask.Blueprint
 NotFound = logic.NotFound
 NotAuthorized = logic.NotAuthorized
+ValidationError = logic.ValidationError
 get_action = logic.get_action
 abort = base.abort
 redirect = toolkit.redirect_to
@@ -35,6 +45,71 @@ s3_resource = Blueprint(
 )
 
 
+def _signed_variant_url(upload, key_path, encoding, params, read_only):
+    '''Return a signed URL to the compressed variant of `key_path`, or None
+    if the variant is missing.'''
+    try:
+        return replicas.get_signed_url(
+            upload, compression.variant_key(key_path, encoding), params,
+            read_only=read_only, request=request)
+    except ClientError as ex:
+        if ex.response['Error']['Code'] in ['NoSuchKey', '404']:
+            log.warning('Compressed variant of {0} not found'
+                        .format(key_path))
+            return None
+        raise ex
+
+
+def _signed_redirect(upload, rsc, key_path, filename, preview):
+    '''Redirect to a signed URL of the object of the resource `rsc`, or of
+    its compressed variant if the client accepts it.'''
+    if preview:
+        params = {}
+    else:
+        params = {
+            'ResponseContentDisposition':
+                'attachment; filename=' + filename,
+        }
+    encoding = rsc.get('s3_compression')
+    url = None
+    if encoding and compression.accepts(
+            request.headers.get('Accept-Encoding'), encoding):
+        url = _signed_variant_url(upload, key_path, encoding, params,
+                                  read_only=not preview)
+    if url is None:
+        url = replicas.get_signed_url(
+            upload, key_path, params, read_only=not preview,
+            request=request)
+    response = redirect(url)
+    if encoding:
+        # The redirect depends on the encodings the client accepts
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def _missing_object(rsc, id, filename, preview):
+    '''Respond to the download of the resource `rsc` whose object is not in
+    the bucket, from the filesystem if the fallback is enabled.'''
+    # attempt fallback
+    if ckan_config.get(
+            'ckanext.s3filestore.filesystem_download_fallback',
+            False):
+        log.info('Attempting filesystem fallback for resource {0}'
+                 .format(rsc['id']))
+        url = toolkit.url_for(
+            u's3_resource.filesystem_resource_download',
+            id=id,
+            resource_id=rsc['id'],
+            filename=filename,
+            preview=preview)
+        return redirect(url)
+
+    if rsc.get('s3_upload_status') == UPLOAD_PENDING:
+        return abort(503, _('The file is still being uploaded'))
+    return abort(404, _('Resource data not found'))
+
+
+@metrics.timed_view('resource_download')
 def resource_download(package_type, id, resource_id, filename=None):
     '''
     Provide a download by either redirecting the user to the url stored or
@@ -44,8 +119,10 @@ def resource_download(package_type, id, resource_id, filename=None):
                'user': c.user or c.author, 'auth_user_obj': c.userobj}
 
     try:
-        rsc = get_action('resource_show')(context, {'id': resource_id})
-        get_action('package_show')(context, {'id': id})
+        with profiling.span('resource_show'):
+            rsc = get_action('resource_show')(context, {'id': resource_id})
+        with profiling.span('package_show'):
+            get_action('package_show')(context, {'id': id})
     except NotFound:
         return abort(404, _('Resource not found'))
     except NotAuthorized:
@@ -58,7 +135,7 @@ def resource_download(package_type, id, resource_id, filename=None):
 
         if filename is None:
             filename = os.path.basename(rsc['url'])
-        key_path = upload.get_path(rsc['id'], filename)
+        key_path = upload.resolve_path(rsc['id'], filename)
         key = filename
 
         if key is None:
@@ -66,40 +143,19 @@ def resource_download(package_type, id, resource_id, filename=None):
                      .format(key_path, upload.bucket_name))
 
         try:
-            if preview:
-                url = upload.get_signed_url_to_key(key_path)
-            else:
-                params = {
-                    'ResponseContentDisposition':
-                        'attachment; filename=' + filename,
-                }
-                url = upload.get_signed_url_to_key(
-                    key_path, params, read_only=True)
-            return redirect(url)
-
+            return _signed_redirect(upload, rsc, key_path, filename, preview)
+        except CircuitOpenError:
+            return abort(503, _('The file storage is temporarily unavailable'))
         except ClientError as ex:
             if ex.response['Error']['Code'] in ['NoSuchKey', '404']:
-                # attempt fallback
-                if ckan_config.get(
-                        'ckanext.s3filestore.filesystem_download_fallback',
-                        False):
-                    log.info('Attempting filesystem fallback for resource {0}'
-                             .format(resource_id))
-                    url = toolkit.url_for(
-                        u's3_resource.filesystem_resource_download',
-                        id=id,
-                        resource_id=resource_id,
-                        filename=filename,
-                        preview=preview)
-                    return redirect(url)
-
-                return abort(404, _('Resource data not found'))
+                return _missing_object(rsc, id, filename, preview)
             else:
                 raise ex
     else:
         return redirect(rsc[u'url'])
 
 
+@metrics.timed_view('filesystem_resource_download')
 def filesystem_resource_download(package_type, id, resource_id, filename=None):
     """
     A fallback view action to download resources from the
@@ -141,12 +197,159 @@ def filesystem_resource_download(package_type, id, resource_id, filename=None):
     return redirect(rsc[u'url'])
 
 
+def _stream_upload_access(context, id, resource_id):
+    '''Check that the user can upload a file to the resource `resource_id`
+    of the package `id`, or to a new resource if it is None, and return the
+    package and resource dicts.'''
+    toolkit.check_access('handle_upload_endpoint', context,
+                         {'package_id': id})
+    pkg = get_action('package_show')(context, {'id': id})
+    if not resource_id:
+        toolkit.check_access('resource_create', context,
+                             {'package_id': pkg['id']})
+        return pkg, None
+    rsc = get_action('resource_show')(context, {'id': resource_id})
+    if rsc['package_id'] != pkg['id']:
+        raise NotFound
+    toolkit.check_access('resource_update', context, {'id': resource_id})
+    return pkg, rsc
+
+
+def _stream_upload_key(pkg, rsc, filename):
+    '''Return the uploader, resource id, key and content type of the file
+    `filename` streamed to the resource `rsc`, or to a new resource of the
+    package `pkg` if it is None.'''
+    content_type = request.mimetype
+    if not content_type or content_type == 'application/octet-stream':
+        content_type = mimetypes.guess_type(filename, strict=False)[0] or \
+            content_type
+    # Existing resources stay in the bucket they are pinned to
+    upload = uploader.get_resource_uploader(
+        dict(rsc, url_type='upload') if rsc else
+        {'package_id': pkg['id'], 'url_type': 'upload'})
+    resource_id = rsc['id'] if rsc else make_uuid()
+    return upload, resource_id, upload.get_path(resource_id, filename), \
+        content_type
+
+
+def _stream_to_s3(upload, key_path, content_type, max_size):
+    '''Stream the request body to `key_path`, see
+    `transfer.stream_upload`.'''
+    part_size = int(ckan_config.get(
+        'ckanext.s3filestore.stream_part_size', 16)) * 1024 * 1024
+    return transfer.stream_upload(
+        upload, key_path, request.stream, content_type,
+        max_size=max_size, part_size=max(part_size, 5 * 1024 * 1024))
+
+
+def _save_streamed_resource(context, pkg, rsc, resource_id, upload, key_path,
+                            filename, content_type, result):
+    '''Record the file streamed to `key_path` on the resource `rsc`, or on a
+    new resource `resource_id` of `pkg`, removing the object if it can't be
+    saved.'''
+    fields = {
+        'url': filename,
+        'url_type': 'upload',
+        'size': result['size'],
+        'hash': 'sha256:' + result['sha256'],
+        's3_etag': result['etag'],
+        # Streamed files get no compressed variant
+        's3_compression': '',
+        'last_modified': datetime.datetime.utcnow().isoformat(),
+    }
+    if get_targets():
+        fields[TARGET_FIELD] = upload.target or ''
+    if content_type:
+        fields['mimetype'] = content_type
+    try:
+        if rsc:
+            fields['id'] = resource_id
+            return get_action('resource_patch')(context, fields)
+        fields.update(id=resource_id, package_id=pkg['id'],
+                      name=request.args.get('name') or filename)
+        return get_action('resource_create')(context, fields)
+    except Exception:
+        # Don't leave the object of a resource which wasn't saved
+        upload.clear_key(key_path)
+        raise
+
+
+def _clear_replaced_file(upload, rsc, key_path):
+    '''Delete the previous file of the resource `rsc` and its compressed
+    variant, unless the file was just overwritten at `key_path`.'''
+    if rsc.get('url_type') != 'upload' or not rsc.get('url'):
+        return
+    for old_path in upload.get_paths(rsc['id'],
+                                     os.path.basename(rsc['url'])):
+        if old_path != key_path:
+            upload.clear_key(old_path)
+        if rsc.get('s3_compression'):
+            upload.clear_key(compression.variant_key(
+                old_path, rsc['s3_compression']))
+
+
+@metrics.timed_view('resource_stream_upload')
+def resource_stream_upload(package_type, id, filename, resource_id=None):
+    '''
+    Upload the request body as the file of a new resource of the dataset, or
+    of the resource `resource_id`, streaming it to S3 part by part as it is
+    received instead of spooling it to a temporary file first.
+
+    The upload is rejected as soon as it gets larger than
+    `ckan.max_resource_size`. The size and SHA-256 checksum of the file are
+    recorded on the resource, which is returned as JSON.
+    '''
+    context = {'model': model, 'session': model.Session,
+               'user': c.user or c.author, 'auth_user_obj': c.userobj}
+
+    # Check everything before reading the body
+    try:
+        pkg, rsc = _stream_upload_access(context, id, resource_id)
+    except NotFound:
+        return abort(404, _('Resource not found'))
+    except NotAuthorized:
+        return abort(403, _('Unauthorized to upload files to dataset %s')
+                     % id)
+
+    max_size = get_max_resource_size()
+    if request.content_length and request.content_length > max_size:
+        return abort(413, _('File upload too large'))
+
+    filename = munge.munge_filename(filename)
+    upload, new_id, key_path, content_type = _stream_upload_key(
+        pkg, rsc, filename)
+    try:
+        result = _stream_to_s3(upload, key_path, content_type, max_size)
+    except transfer.UploadTooLarge:
+        return abort(413, _('File upload too large'))
+    except CircuitOpenError:
+        return abort(503, _('The file storage is temporarily unavailable'))
+
+    try:
+        resource = _save_streamed_resource(
+            context, pkg, rsc, new_id, upload, key_path, filename,
+            content_type, result)
+    except ValidationError as e:
+        return abort(400, str(e.error_dict))
+    if rsc:
+        _clear_replaced_file(upload, rsc, key_path)
+
+    log.info('Streamed {0} bytes to {1}'.format(result['size'], key_path))
+    return flask.jsonify({'success': True, 'result': resource})
+
+
 s3_resource.add_url_rule(u'/<resource_id>/download',
                          view_func=resource_download)
 s3_resource.add_url_rule(u'/<resource_id>/download/<filename>',
                          view_func=resource_download)
 s3_resource.add_url_rule(u'/<resource_id>/fs_download/<filename>',
                          view_func=filesystem_resource_download)
+s3_resource.add_url_rule(u'/upload/<filename>',
+                         view_func=resource_stream_upload,
+                         methods=[u'PUT', u'POST'])
+s3_resource.add_url_rule(u'/<resource_id>/upload/<filename>',
+                         view_func=resource_stream_upload,
+                         methods=[u'PUT', u'POST'])
 
 
 def get_blueprints():
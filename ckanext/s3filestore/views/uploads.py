@@ -1,5 +1,4 @@
 # encoding: utf-8
-import os
 import logging
 
 import flask
@@ -9,6 +8,8 @@ import ckantoolkit as toolkit
 from ckantoolkit import _
 import ckan.lib.base as base
 
+from ckanext.s3filestore import metrics
+from ckanext.s3filestore.breaker import CircuitOpenError
 from ckanext.s3filestore.uploader import S3Uploader, BaseS3Uploader
 
 
@@ -23,15 +24,18 @@ s3_uploads = Blueprint(
 )
 
 
+@metrics.timed_view('uploaded_file_redirect')
 def uploaded_file_redirect(upload_to, filename):
     '''Redirect static file requests to their location on S3.'''
 
-    storage_path = S3Uploader.get_storage_path(upload_to)
-    filepath = os.path.join(storage_path, filename)
     base_uploader = BaseS3Uploader()
 
     try:
+        filepath = base_uploader.resolve_key(
+            S3Uploader.get_keys(upload_to, filename))
         url = base_uploader.get_signed_url_to_key(filepath)
+    except CircuitOpenError:
+        return abort(503, _('The file storage is temporarily unavailable'))
     except ClientError as ex:
         if ex.response['Error']['Code'] in ['NoSuchKey', '404']:
             return abort(404, _('Keys not found on S3'))
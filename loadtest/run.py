@@ -0,0 +1,230 @@
+# encoding: utf-8
+'''Replay a mix of download redirects and upload requests against CKAN.
+
+Each worker thread picks a scenario according to the configured weights and
+records its latency until the duration elapses, then the throughput and the
+p50/p95/p99 latencies are reported per scenario::
+
+    python loadtest/run.py --url http://127.0.0.1:5000 --api-token $TOKEN \\
+        --concurrency 32 --duration 60 \\
+        --mix resource_download=70,uploaded_file_redirect=15,get_signed_url=10,multipart=5
+
+Scenarios:
+
+* ``resource_download``: GET a resource download URL, not following the
+  redirect to S3.
+* ``uploaded_file_redirect``: GET the organization image through
+  ``/uploads/group/<filename>``.
+* ``get_signed_url``: call the ``get_signed_url`` action.
+* ``multipart``: a full multipart upload session, ``create-multipart-upload``,
+  ``sign-part`` and a PUT to S3 for each part then
+  ``complete-multipart-upload``. Each step is also reported on its own.
+'''
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+
+import requests
+
+DEFAULT_MIX = ('resource_download=70,uploaded_file_redirect=15,'
+               'get_signed_url=10,multipart=5')
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, scenario, latency, ok=True):
+        with self.lock:
+            self.latencies[scenario].append(latency)
+            if not ok:
+                self.errors[scenario] += 1
+
+
+def timed(recorder, scenario, func, *args, **kwargs):
+    start = time.perf_counter()
+    ok = False
+    try:
+        response = func(*args, **kwargs)
+        ok = response.status_code < 400
+        return response
+    finally:
+        recorder.record(scenario, time.perf_counter() - start, ok)
+
+
+class Scenarios(object):
+
+    def __init__(self, args, fixtures, recorder):
+        self.url = args.url
+        self.fixtures = fixtures
+        self.recorder = recorder
+        self.parts = args.multipart_parts
+        self.part_body = b'\0' * MIN_PART_SIZE
+        self.api_token = args.api_token
+
+    def session(self):
+        session = requests.Session()
+        session.headers['Authorization'] = self.api_token
+        return session
+
+    def _action(self, session, scenario, name, **data_dict):
+        response = timed(self.recorder, scenario, session.post,
+                         '{0}/api/action/{1}'.format(self.url, name),
+                         json=data_dict)
+        response.raise_for_status()
+        return response.json()['result']
+
+    def resource_download(self, session, rnd):
+        resource_id = rnd.choice(self.fixtures['resource_ids'])
+        timed(self.recorder, 'resource_download', session.get,
+              '{0}/dataset/{1}/resource/{2}/download'.format(
+                  self.url, self.fixtures['package_id'], resource_id),
+              allow_redirects=False)
+
+    def uploaded_file_redirect(self, session, rnd):
+        timed(self.recorder, 'uploaded_file_redirect', session.get,
+              self.url + rnd.choice(self.fixtures['image_urls']),
+              allow_redirects=False)
+
+    def get_signed_url(self, session, rnd):
+        filename = 'upload-{0}.csv'.format(rnd.randint(0, 10 ** 9))
+        self._action(session, 'get_signed_url', 'get_signed_url',
+                     package_id=self.fixtures['package_id'],
+                     filename=filename)
+
+    def multipart(self, session, rnd):
+        start = time.perf_counter()
+        ok = False
+        try:
+            upload = self._action(
+                session, 'multipart.create', 'create-multipart-upload',
+                package_id=self.fixtures['package_id'],
+                name='multipart-{0}.bin'.format(rnd.randint(0, 10 ** 9)))
+            parts = []
+            for number in range(1, self.parts + 1):
+                signed = self._action(
+                    session, 'multipart.sign_part', 'sign-part',
+                    package_id=self.fixtures['package_id'],
+                    uploadId=upload['uploadId'], key=upload['key'],
+                    partNumber=number)
+                response = timed(self.recorder, 'multipart.put_part',
+                                 requests.put, signed['url'],
+                                 data=self.part_body)
+                response.raise_for_status()
+                parts.append({'PartNumber': number,
+                              'ETag': response.headers['ETag']})
+            self._action(session, 'multipart.complete',
+                         'complete-multipart-upload',
+                         package_id=self.fixtures['package_id'],
+                         uploadId=upload['uploadId'], key=upload['key'],
+                         parts=parts)
+            ok = True
+        finally:
+            self.recorder.record('multipart', time.perf_counter() - start, ok)
+
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(','):
+        name, weight = entry.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def worker(number, scenarios, weights, deadline, seed):
+    rnd = random.Random(seed + number)
+    session = scenarios.session()
+    names = list(weights)
+    name_weights = [weights[name] for name in names]
+    while time.time() < deadline:
+        name = rnd.choices(names, weights=name_weights)[0]
+        try:
+            getattr(scenarios, name)(session, rnd)
+        except Exception:
+            # Failures are already recorded with their latency
+            pass
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of sorted `values`.'''
+    if not values:
+        return 0.0
+    rank = max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def report(recorder, elapsed):
+    rows = []
+    for scenario in sorted(recorder.latencies):
+        latencies = sorted(recorder.latencies[scenario])
+        rows.append({
+            'scenario': scenario,
+            'requests': len(latencies),
+            'errors': recorder.errors[scenario],
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--api-token', required=True)
+    parser.add_argument('--fixtures', default='loadtest/fixtures.json')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=60,
+                        help='duration of the run in seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='comma separated scenario=weight pairs')
+    parser.add_argument('--multipart-parts', type=int, default=2,
+                        help='number of 5MB parts per multipart upload')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, for reproducible request mixes')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    with open(args.fixtures) as f:
+        fixtures = json.load(f)
+    weights = parse_mix(args.mix)
+    recorder = Recorder()
+    scenarios = Scenarios(args, fixtures, recorder)
+
+    start = time.time()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=worker,
+                                args=(number, scenarios, weights, deadline,
+                                      args.seed))
+               for number in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rows = report(recorder, time.time() - start)
+
+    print('{0:<24} {1:>9} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for row in rows:
+        print('{scenario:<24} {requests:>9} {errors:>7} {throughput:>9.1f} '
+              '{p50_ms:>9.1f} {p95_ms:>9.1f} {p99_ms:>9.1f}'.format(**row))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'concurrency': args.concurrency,
+                       'duration': args.duration,
+                       'mix': weights,
+                       'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
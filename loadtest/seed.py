@@ -0,0 +1,76 @@
+# encoding: utf-8
+'''Create the data the load generator replays requests against.
+
+Creates an organization with an uploaded image and a dataset with uploaded
+resources through the CKAN API, and writes their identifiers to a fixtures
+file read by ``run.py``::
+
+    python loadtest/seed.py --url http://127.0.0.1:5000 \\
+        --api-token $TOKEN --resources 50 --size 65536
+'''
+import io
+import json
+import uuid
+import argparse
+
+import requests
+
+
+def action(session, url, name, files=None, **data_dict):
+    if files:
+        response = session.post('{0}/api/action/{1}'.format(url, name),
+                                data=data_dict, files=files)
+    else:
+        response = session.post('{0}/api/action/{1}'.format(url, name),
+                                json=data_dict)
+    response.raise_for_status()
+    return response.json()['result']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--api-token', required=True)
+    parser.add_argument('--resources', type=int, default=50,
+                        help='number of uploaded resources to create')
+    parser.add_argument('--size', type=int, default=64 * 1024,
+                        help='size in bytes of each uploaded resource')
+    parser.add_argument('--output', default='loadtest/fixtures.json')
+    args = parser.parse_args()
+
+    session = requests.Session()
+    session.headers['Authorization'] = args.api_token
+    suffix = uuid.uuid4().hex[:8]
+
+    org = action(session, args.url, 'organization_create',
+                 files={'image_upload': ('logo.png',
+                                         io.BytesIO(b'\x89PNG' + b'\0' * 512))},
+                 name='loadtest-org-' + suffix)
+    dataset = action(session, args.url, 'package_create',
+                     name='loadtest-dataset-' + suffix, owner_org=org['id'])
+
+    row = b'station,date,depth,water_equivalent\n'
+    content = row * (args.size // len(row) + 1)
+    resource_ids = []
+    for number in range(args.resources):
+        resource = action(
+            session, args.url, 'resource_create',
+            files={'upload': ('data-{0}.csv'.format(number),
+                              io.BytesIO(content[:args.size]))},
+            package_id=dataset['id'],
+            name='data-{0}.csv'.format(number))
+        resource_ids.append(resource['id'])
+
+    fixtures = {
+        'package_id': dataset['id'],
+        'resource_ids': resource_ids,
+        'image_urls': ['/uploads/group/{0}'.format(org['image_url'])],
+    }
+    with open(args.output, 'w') as f:
+        json.dump(fixtures, f, indent=2)
+    print('Created {0} resources in dataset {1}, fixtures written to {2}'
+          .format(len(resource_ids), dataset['name'], args.output))
+
+
+if __name__ == '__main__':
+    main()
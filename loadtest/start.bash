@@ -0,0 +1,51 @@
+#!/bin/bash
+#
+# Start the load-test stack: a moto server standing in for S3 and CKAN served
+# by gunicorn with the s3filestore plugin. Requires CKAN with its database,
+# Solr and Redis services (see bin/setup-ckan.bash) and:
+#
+#     pip install 'moto[server]' gunicorn requests
+#
+# Once started, seed the data and run the load generator from another shell:
+#
+#     python loadtest/seed.py --api-token $TOKEN
+#     python loadtest/run.py --api-token $TOKEN --concurrency 32 --duration 60
+#
+set -e
+
+HERE=$(cd "$(dirname "$0")" && pwd)
+MOTO_PORT=${MOTO_PORT:-5001}
+CKAN_PORT=${CKAN_PORT:-5000}
+WORKERS=${WORKERS:-4}
+export CKAN_INI=${CKAN_INI:-$HERE/loadtest.ini}
+
+echo "Starting the moto S3 server on port $MOTO_PORT..."
+moto_server -H 127.0.0.1 -p "$MOTO_PORT" > /tmp/s3filestore-loadtest-moto.log 2>&1 &
+MOTO_PID=$!
+trap 'kill $MOTO_PID' EXIT
+
+until curl -s "http://127.0.0.1:$MOTO_PORT" > /dev/null; do
+    sleep 0.5
+done
+
+python - <<EOF
+import boto3
+boto3.client('s3', endpoint_url='http://127.0.0.1:$MOTO_PORT',
+             region_name='us-east-1',
+             aws_access_key_id='loadtest-access-key',
+             aws_secret_access_key='loadtest-secret-key')\
+    .create_bucket(Bucket='loadtest-bucket')
+EOF
+
+echo "Initialising the database and creating the loadtest sysadmin..."
+ckan -c "$CKAN_INI" db init
+ckan -c "$CKAN_INI" user show loadtest > /dev/null 2>&1 || \
+    ckan -c "$CKAN_INI" user add loadtest \
+        email=loadtest@example.com password=loadtest-password
+ckan -c "$CKAN_INI" sysadmin add loadtest
+TOKEN=$(ckan -c "$CKAN_INI" user token add loadtest loadtest | tail -n 1 | tr -d '[:space:]')
+echo "API token of the loadtest sysadmin: $TOKEN"
+
+echo "Starting CKAN with $WORKERS gunicorn workers on port $CKAN_PORT..."
+gunicorn --workers "$WORKERS" --bind "127.0.0.1:$CKAN_PORT" \
+    --chdir "$HERE" wsgi:application
@@ -0,0 +1,13 @@
+# encoding: utf-8
+'''WSGI entry point serving CKAN for the load-test harness, e.g.::
+
+    CKAN_INI=loadtest/loadtest.ini gunicorn --workers 4 \\
+        --chdir loadtest wsgi:application
+'''
+import os
+
+from ckan.cli import CKANConfigLoader
+from ckan.config.middleware import make_app
+
+config = CKANConfigLoader(os.environ['CKAN_INI']).get_config()
+application = make_app(config)
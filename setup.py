@@ -60,6 +60,14 @@ setup(
     # https://packaging.python.org/en/latest/technical.html#install-requires-vs-requirements-files
     install_requires=['boto3>=1.4.4', 'ckantoolkit'],
 
+    # Optional dependencies, installed with e.g.
+    # pip install ckanext-s3filestore[metrics]
+    extras_require={
+        'metrics': ['prometheus_client'],
+        'zstd': ['zstandard'],
+        'geoip': ['geoip2'],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.